@@ -10,11 +10,18 @@ SHARE_DIR = os.path.join(BASE_DIR, 'share')
 RP_PREP_LOGGING_CONFIG = os.path.join(CONF_DIR, 'rp-prep.logging.config')
 RP_RUN_LOGGING_CONFIG = os.path.join(CONF_DIR, 'rp-run.logging.config')
 RP_TRANSFER_LOGGING_CONFIG = os.path.join(CONF_DIR, 'rp-transfer.logging.config')
+RP_HARVEST_LOGGING_CONFIG = os.path.join(CONF_DIR, 'rp-harvest.logging.config')
 
 # the dir/file names used running rp-prep gen-csv
 HTML_OUTDIR_BASENAME = 'html'
 SPECIES_CSV_BASENAME = 'GSE_species_GSM.csv'
 NO_SPECIES_CSV_BASENAME = 'GSE_no_species_GSM.csv'
+# the GSMs resolved so far by an unfinished run of gen-csv
+GEN_CSV_JOURNAL_BASENAME = 'GSE_species_GSM.journal'
+# the packed alternative to HTML_OUTDIR_BASENAME, see packed_cache.py
+HTML_CACHE_BASENAME = 'html_cache.db'
+# where the esummary of batches of GSMs are cached with --backend eutils
+ESUMMARY_OUTDIR_BASENAME = 'esummary'
 
 # the dir/file names used running rp-prep get-soft
 SOFT_OUTDIR_BASENAME = 'soft'
@@ -22,6 +29,16 @@ SOFT_OUTDIR_BASENAME = 'soft'
 # the qsub script name used for submission to remote cluster
 QSUB_SUBMIT_SCRIPT_BASENAME = '0_submit.sh'
 
+# the template for submitting all transferred GSMs as a single array job
+ARRAY_SUBMIT_TEMPLATE = os.path.join(TEMPLATES_DIR, 'array_submit.jinja2')
+
+# the template for running multiple GSMs within one job
+BUNDLE_SUBMIT_TEMPLATE = os.path.join(TEMPLATES_DIR, 'bundle_submit.jinja2')
+
+# the agent executed on remote host by rp-transfer to summarize the state of
+# GSMs and disk usage
+REMOTE_AGENT_SCRIPT = os.path.join(BASE_DIR, 'utils', 'remote_agent.py')
+
 # the name of the file that stores information about sra files of a GSM
 SRA_INFO_FILE_BASENAME = 'sras_info.yaml'
 
@@ -38,5 +55,27 @@ RSEM_OUTPUT_DIR_RE = r'(.*)/(?P<GSE>GSE\d+)/(?P<species>\S+)/(?P<GSM>GSM\d+)'
 # where scripts are saved for transferring fastq files to remote HPC host
 TRANSFER_SCRIPTS_DIR_BASENAME = 'transfer_scripts'
 
-# the file name that records all transferred GSMs
+# the file name that records all transferred GSMs, superseded by the ledger,
+# and only imported into it when the ledger is created
 TRANSFERRED_GSMS_RECORD_BASENAME = 'transferred_GSMs.txt'
+
+# the SQLite database recording the lifecycle of each GSM after processed
+# locally, from selected for transfer to local cleanup
+TRANSFER_LEDGER_BASENAME = 'transfer_ledger.db'
+
+# the cache of the state of remote hosts kept between invocations of
+# rp-transfer, and how long (in minutes) an entry in it is valid unless
+# REMOTE_STATE_TTL is configured
+REMOTE_STATE_CACHE_BASENAME = 'remote_state_cache.yaml'
+REMOTE_STATE_TTL = 30
+
+# the name of the file in a GSM directory that records the resources (cpu,
+# memory and io) used by each command run for the GSM, one record per line
+METRICS_FILE_BASENAME = 'metrics.yaml'
+
+# the lease file in a GSM directory held by the rp-run processing it, how long
+# (in minutes) a lease that isn't renewed is valid unless RP_RUN_LEASE_TTL is
+# configured, and how often (in seconds) leases are renewed
+LEASE_BASENAME = '.rp-run.lease'
+LEASE_TTL = 30
+LEASE_HEARTBEAT = 60
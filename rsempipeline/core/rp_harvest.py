@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+
+"""
+This script brings the results of GSMs analyzed on remote cluster back home.
+The scheduler is polled with a single qstat for all submitted GSMs as
+recorded in the transfer ledger, the results of those finished with
+rsem.COMPLETE are fetched with one rsync driven by a manifest, verified, and
+then removed from remote host to free space for the next transfers
+"""
+
+import os
+import sys
+sys.stdout.flush()              # flush print outputs to screen
+import datetime
+import logging.config
+
+from rsempipeline.utils import misc
+misc.mkdir('log')
+from rsempipeline.utils import qsub
+from rsempipeline.utils import ledger as LG
+from rsempipeline.utils import targets as TG
+from rsempipeline.utils.state_cache import StateCache
+from rsempipeline.parsers.args_parser import parse_args_for_rp_harvest
+from rsempipeline.conf.settings import (RP_HARVEST_LOGGING_CONFIG,
+                                        TRANSFER_SCRIPTS_DIR_BASENAME,
+                                        TRANSFERRED_GSMS_RECORD_BASENAME,
+                                        TRANSFER_LEDGER_BASENAME,
+                                        REMOTE_STATE_CACHE_BASENAME,
+                                        REMOTE_STATE_TTL)
+
+
+logging.config.fileConfig(RP_HARVEST_LOGGING_CONFIG)
+logger = logging.getLogger('rp_harvest')
+
+# the results to fetch per GSM, {gsm} is replaced by the GSM, e.g.
+# GSMxxxxxxx.stat is a directory
+RESULT_FILES = [
+    '{gsm}.genes.results',
+    '{gsm}.isoforms.results',
+    '{gsm}.stat',
+    '{gsm}.time',
+    'rsem.log',
+    'align.stats',
+    'rsem.COMPLETE',
+]
+
+# the first column of the header of results files as output by rsem
+RESULT_HEADERS = {
+    '{gsm}.genes.results': 'gene_id',
+    '{gsm}.isoforms.results': 'transcript_id',
+}
+
+
+def poll_jobs(r_host, r_username):
+    """
+    :returns: a set of the ids of jobs that are still queued or running on
+    remote host with a single call of qstat
+    """
+    output = misc.sshexec('qstat -u {0}'.format(r_username), r_host, r_username)
+    if output is None:
+        raise ValueError('failed to execute qstat on {0}'.format(r_host))
+    job_ids = qsub.parse_qstat(output)
+    logger.info('{0} jobs queued or running on {1}'.format(len(job_ids), r_host))
+    return job_ids
+
+
+def find_finished(submitted, active_job_ids):
+    """
+    :param submitted: a dict of {gsm_id: job_id}
+    :returns: gsm_ids whose jobs are no longer known to the scheduler
+    """
+    return sorted(gsm_id for gsm_id, job_id in submitted.items()
+                  if job_id not in active_job_ids)
+
+
+def check_completed(r_host, r_username, r_top_outdir, gsm_ids):
+    """
+    check which of gsm_ids have rsem.COMPLETE on remote host with a single
+    ssh call
+
+    :returns: a list of gsm_ids completed successfully
+    """
+    if not gsm_ids:
+        return []
+    flags = ' '.join(os.path.join(_, 'rsem.COMPLETE') for _ in gsm_ids)
+    cmd = 'cd {0} && ls -d {1} 2>/dev/null; true'.format(r_top_outdir, flags)
+    output = misc.sshexec(cmd, r_host, r_username) or []
+    found = set(os.path.dirname(_.strip()) for _ in output)
+    return [_ for _ in gsm_ids if _ in found]
+
+
+def list_result_files(gsm_id):
+    gsm = os.path.basename(gsm_id)
+    return [os.path.join(gsm_id, _.format(gsm=gsm)) for _ in RESULT_FILES]
+
+
+def write_results_manifest(gsm_ids, manifest):
+    with open(manifest, 'wb') as opf:
+        for gsm_id in gsm_ids:
+            for _ in list_result_files(gsm_id):
+                opf.write('{0}\n'.format(_))
+
+
+def fetch_results(r_host, r_username, r_top_outdir, l_top_outdir, gsm_ids):
+    """
+    fetch the results of gsm_ids with one rsync, the paths of results are
+    listed in a manifest so no remote directory is scanned
+
+    :returns: the returncode of rsync
+    """
+    tf_dir = os.path.join(l_top_outdir, TRANSFER_SCRIPTS_DIR_BASENAME)
+    misc.mkdir(tf_dir)
+    now = datetime.datetime.now().strftime('%y-%m-%d_%H:%M:%S')
+    manifest = os.path.join(tf_dir, 'harvest.{0}.files'.format(now))
+    write_results_manifest(gsm_ids, manifest)
+    # -r is needed for GSMxxxxxxx.stat since --files-from doesn't imply it
+    cmd = ('rsync -a -r -v -h --stats --files-from={0} '
+           '{1}@{2}:{3}/ {4}/'.format(
+               manifest, r_username, r_host, r_top_outdir, l_top_outdir))
+    return misc.execute_log_stdout_stderr(cmd)
+
+
+def verify_results(gsm_dir):
+    """
+    check the results are fetched completely, i.e. the files exist and the
+    results files start with the header as output by rsem
+    """
+    gsm = os.path.basename(gsm_dir)
+    for _ in RESULT_FILES:
+        path = os.path.join(gsm_dir, _.format(gsm=gsm))
+        if not os.path.exists(path):
+            logger.error('{0} not found'.format(path))
+            return False
+    for basename, header in RESULT_HEADERS.items():
+        path = os.path.join(gsm_dir, basename.format(gsm=gsm))
+        with open(path) as inf:
+            if not inf.readline().startswith(header):
+                logger.error('{0} is truncated or corrupted'.format(path))
+                return False
+    return True
+
+
+def free_remote_space(r_host, r_username, r_top_outdir, gsm_ids):
+    """remove the GSM dirs on remote host with a single ssh call"""
+    if not gsm_ids:
+        return
+    cmd = 'cd {0} && rm -rf {1}'.format(r_top_outdir, ' '.join(gsm_ids))
+    misc.sshexec(cmd, r_host, r_username)
+    logger.info('removed {0} GSM dirs from {1} on {2}'.format(
+        len(gsm_ids), r_top_outdir, r_host))
+
+
+def clean_local(gsm_dir):
+    """
+    remove the sra and fastq.gz files that are left locally, they are normally
+    removed by the transfer script already
+    """
+    for dirpath, _, filenames in os.walk(gsm_dir):
+        for f in filenames:
+            if f.endswith('.sra') or f.endswith('.fastq.gz'):
+                path = os.path.join(dirpath, f)
+                logger.info('removing {0}'.format(path))
+                os.remove(path)
+
+
+def harvest(ledger, r_host, r_username, r_top_outdir, l_top_outdir,
+            keep_remote=False, target=None):
+    """
+    :param target: the name of the target, only GSMs placed on it are
+    harvested if specified
+    """
+    submitted = dict((_, ledger.get(_)['job_id'])
+                     for _ in ledger.get_gsm_ids(LG.SUBMITTED, target))
+    logger.info('{0} GSMs submitted and not completed yet'.format(len(submitted)))
+    if submitted:
+        finished = find_finished(submitted, poll_jobs(r_host, r_username))
+        completed = check_completed(r_host, r_username, r_top_outdir, finished)
+        failed = sorted(set(finished) - set(completed))
+        for _ in failed:
+            logger.error('job {0} of {1} finished without rsem.COMPLETE, '
+                         'please check'.format(submitted[_], _))
+        # so they are neither reported again nor counted as in flight
+        ledger.record(failed, LG.FAILED)
+        ledger.record(completed, LG.COMPLETED)
+
+    # including those fetched unsuccessfully last time
+    to_fetch = ledger.get_gsm_ids(LG.COMPLETED, target)
+    if not to_fetch:
+        logger.info('no results to fetch')
+        return []
+    logger.info('fetching results of {0} GSMs'.format(len(to_fetch)))
+    rcode = fetch_results(r_host, r_username, r_top_outdir, l_top_outdir, to_fetch)
+    if rcode != 0:
+        # e.g. 23 if some files are missing, the others are still fetched
+        logger.warning('rsync returncode: {0}'.format(rcode))
+
+    fetched = [_ for _ in to_fetch
+               if verify_results(os.path.join(l_top_outdir, _))]
+    ledger.record(fetched, LG.FETCHED)
+    logger.info('{0}/{1} GSMs fetched and verified'.format(
+        len(fetched), len(to_fetch)))
+
+    for _ in fetched:
+        clean_local(os.path.join(l_top_outdir, _))
+    if not keep_remote:
+        free_remote_space(r_host, r_username, r_top_outdir, fetched)
+        # cleaned up both locally and remotely
+        ledger.record(fetched, LG.CLEANED)
+    return fetched
+
+
+@misc.lockit(os.path.expanduser('~/.rp-harvest'))
+def main():
+    options = parse_args_for_rp_harvest()
+    config = misc.get_config(options.config_file)
+
+    l_top_outdir = config['LOCAL_TOP_OUTDIR']
+
+    ledger = LG.open_ledger(
+        os.path.join(l_top_outdir, TRANSFER_LEDGER_BASENAME),
+        os.path.join(l_top_outdir, TRANSFERRED_GSMS_RECORD_BASENAME))
+    # shared with rp-transfer, the usage cached is outdated once remote space
+    # is freed
+    cache = StateCache(
+        os.path.join(l_top_outdir, REMOTE_STATE_CACHE_BASENAME),
+        config.get('REMOTE_STATE_TTL', REMOTE_STATE_TTL) * 60)
+    targets = TG.get_targets(config)
+    ledger.set_default_target(targets[0]['NAME'])
+    for target in targets:
+        logger.info('harvesting {0}'.format(target['NAME']))
+        try:
+            fetched = harvest(ledger, target['REMOTE_HOST'], target['USERNAME'],
+                              target['REMOTE_TOP_OUTDIR'], l_top_outdir,
+                              options.keep_remote, target['NAME'])
+        except Exception, err:
+            # e.g. the target is down, the others are still harvested
+            logger.exception(err)
+            continue
+        if fetched and not options.keep_remote:
+            cache.invalidate(target['REMOTE_HOST'])
+    ledger.log_summary()
+
+
+if __name__ == "__main__":
+    main()
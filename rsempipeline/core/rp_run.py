@@ -8,22 +8,28 @@ on them, either on local system or on remote cluster.
 
 import os
 import re
+import glob
+import hashlib
 import logging.config
 
 import urlparse
 
 import ruffus as R
 
-from jinja2 import Environment, FileSystemLoader
-
 from rsempipeline.utils import misc
 misc.mkdir('log')
 from rsempipeline.utils import pre_pipeline_run as PPR
+from rsempipeline.utils import runtime as RT
+from rsempipeline.utils import resources as RES
+from rsempipeline.utils import qsub as QS
+from rsempipeline.utils import lease as LS
+from rsempipeline.utils import runner
 from rsempipeline.utils.download import gen_orig_params
 from rsempipeline.utils.rsem import gen_fastq_gz_input
 from rsempipeline.parsers.args_parser import parse_args_for_rp_run
 from rsempipeline.conf.settings import (
-    RP_RUN_LOGGING_CONFIG, TEMPLATES_DIR, QSUB_SUBMIT_SCRIPT_BASENAME)
+    RP_RUN_LOGGING_CONFIG, QSUB_SUBMIT_SCRIPT_BASENAME,
+    LEASE_BASENAME, LEASE_TTL, LEASE_HEARTBEAT)
 # as PATH_RE for backward compatibility
 from rsempipeline.conf.settings import RSEM_OUTPUT_DIR_RE as PATH_RE
 
@@ -39,6 +45,10 @@ logger, logger_mutex = R.proxy_logger.make_shared_logger_and_proxy(
 # pyflakes, they will be assigned in main function
 config, options, samples = None, None, None
 
+# cpu seconds per byte of fastq.gz of historical rsem runs, used for sizing
+# resources in qsub scripts, assigned in main function
+cpu_rates = None
+
 # def execute_mutex(cmd, msg_id='', flag_file=None, debug=False):
 #     """
 #     :param msg_id: id for identifying a message, this prevents parallel
@@ -109,7 +119,34 @@ def sra2fastq(inputs, outputs):
     flag_file = outputs[-1]
     outdir = os.path.dirname(os.path.dirname(os.path.dirname(sra)))
     cmd = config['CMD_FASTQ_DUMP'].format(output_dir=outdir, accession=sra)
-    misc.execute_log_stdout_stderr(cmd, flag_file=flag_file, debug=options.debug)
+    misc.execute_log_stdout_stderr(cmd, flag_file=flag_file, debug=options.debug,
+                                   log_file=gen_output_log(flag_file),
+                                   timeout=get_timeout('SRA2FASTQ_TIMEOUT'))
+
+
+def get_timeout(key):
+    """
+    :returns: the timeout in seconds of a task as configured by key in hours,
+    None if not configured
+    """
+    hours = config.get(key)
+    return hours * 3600 if hours else None
+
+
+def gen_output_log(flag_file):
+    """
+    where the stdout and stderr of the task go instead of the shared log,
+    e.g. SRR999999.sra.sra2fastq.COMPLETE => SRR999999.sra.sra2fastq.out
+    """
+    return '{0}.out'.format(os.path.splitext(flag_file)[0])
+
+
+def get_qsub_resource_limits():
+    """
+    floors and ceilings of resources for the qsub template in use, None if
+    not configured
+    """
+    return config.get('QSUB_RESOURCES', {}).get(options.qsub_template)
 
 
 @R.collate(
@@ -121,29 +158,10 @@ def gen_qsub_script(inputs, outputs):
     inputs = [_ for _ in inputs if not _.endswith('.sra2fastq.COMPLETE')]
     # SHOULD DO TRY EXCEPT IN CASE THE PREVIOUS STEP DIDN'T FINISH SUCCESSFULLY
     outdir = os.path.dirname(inputs[0])
-
-    # only need the basename since the 0_submit.sh will be executed in the
-    # GSM dir
-    fastq_gz_input = gen_fastq_gz_input(
-        [os.path.basename(_) for _ in inputs])
-    res = re.search(PATH_RE, outdir)
-    gse = res.group('GSE')
-    species = res.group('species')
-    gsm = res.group('GSM')
-    reference_name = config['REMOTE_REFERENCE_NAMES'][species]
-    sample_name = '{gsm}'.format(gsm=gsm)
-
-    qsub_script = os.path.join(outdir, '0_submit.sh')
-
-    # TEMPLATES_DIR: the standard templates directory
-    # os.getcwd(): the current working directory
-    # use both for looking for the template
-    jinja2_env = Environment(loader=FileSystemLoader([TEMPLATES_DIR, os.getcwd()]))
-    template = jinja2_env.get_template(options.qsub_template)
-    with open(qsub_script, 'wb') as opf:
-        content = template.render(**locals())
-        opf.write(content)
-        logger.info('templated {0}'.format(qsub_script))
+    QS.render_qsub_script(
+        outdir, inputs, options.qsub_template,
+        config['REMOTE_REFERENCE_NAMES'], get_qsub_resource_limits(),
+        cpu_rates)
 
 
 @R.collate(
@@ -207,7 +225,9 @@ def rsem(inputs, outputs):
         reference_name=reference_name,
         sample_name=sample_name,
         output_dir=outdir)
-    misc.execute_log_stdout_stderr(cmd, flag_file=flag_file, debug=options.debug)
+    misc.execute_log_stdout_stderr(cmd, flag_file=flag_file, debug=options.debug,
+                                   log_file=gen_output_log(flag_file),
+                                   timeout=get_timeout('RSEM_TIMEOUT'))
 
 
 def calc_local_free_space_to_use(top_outdir, cmd_df, min_free, max_usage):
@@ -234,7 +254,45 @@ def calc_local_free_space_to_use(top_outdir, cmd_df, min_free, max_usage):
     return free_to_use
 
 
-@misc.lockit(os.path.expanduser('~/.rp-run'))
+def get_lease_file(sample):
+    return os.path.join(sample.outdir, LEASE_BASENAME)
+
+
+def lease_samples(samples, keeper):
+    """
+    :returns: the samples whose leases are acquired, the others are being
+    processed by another rp-run
+    """
+    leased = []
+    for sample in samples:
+        if keeper.acquire(get_lease_file(sample)):
+            leased.append(sample)
+        else:
+            logger.info('{0} is leased by another rp-run, skipped'.format(sample))
+    return leased
+
+
+def release_samples_not_fitting(samples, free_to_use, top_outdir, keeper):
+    """
+    rp-run processes started at the same time all select GSMs before any of
+    them has leased one, so the selection is checked again against the
+    leases taken by the others since. Of any two processes, the one checking
+    later sees the leases of the other, so together they don't exceed
+    free_to_use
+
+    :param samples: those leased by keeper
+    :returns: the samples still fitting, the leases of the others are released
+    """
+    free_to_use = deduct_leased_usage(free_to_use, top_outdir, keeper)
+    fitting = PPR.select_gsms_to_process(samples, free_to_use)
+    for sample in samples:
+        if sample not in fitting:
+            logger.info('{0} no longer fits with the GSMs leased by other '
+                        'rp-run processes, released'.format(sample))
+            keeper.release(get_lease_file(sample))
+    return fitting
+
+
 def main():
     # because of ruffus, have to use some global variables
     # global variables: options, config, samples, env, logger, logger_mutex
@@ -243,10 +301,72 @@ def main():
     options = parse_args_for_rp_run()
     config = misc.get_config(options.config_file)
 
+    # instead of a global locker, GSMs are leased so that concurrent rp-run
+    # processes work on disjoint GSMs
+    keeper = LS.LeaseKeeper(config.get('RP_RUN_LEASE_TTL', LEASE_TTL) * 60,
+                            LEASE_HEARTBEAT)
+    keeper.start()
+    runner.exit_on_sigterm()
+    try:
+        run(keeper)
+    finally:
+        # otherwise the next rp-run would take over GSMs that fastq-dump or
+        # rsem left running are still writing to
+        runner.kill_all()
+        keeper.release_all()
+
+
+def calc_leased_usage(top_outdir, keeper):
+    """
+    the space still to be taken by GSMs being processed by other rp-run
+    processes, which isn't reflected by du and df yet
+    """
+    pattern = os.path.join(PPR.get_rsem_outdir(top_outdir),
+                           'GSE*', '*', 'GSM*', LEASE_BASENAME)
+    usage = 0
+    for lease_file in glob.glob(pattern):
+        if not keeper.is_held_by_others(lease_file):
+            continue
+        gsm_dir = os.path.dirname(lease_file)
+        try:
+            estimated = PPR.estimate_sra2fastq_usage(gsm_dir)
+        except (IOError, OSError):
+            # no sras_info.yaml
+            continue
+        usage += max(0, estimated - PPR.disk_used(gsm_dir))
+    return usage
+
+
+def deduct_leased_usage(free_to_use, top_outdir, keeper):
+    leased_usage = calc_leased_usage(top_outdir, keeper)
+    if leased_usage:
+        logger.info('space to be used by GSMs leased by other rp-run '
+                    'processes: {0}'.format(misc.pretty_usage(leased_usage)))
+    return max(0, free_to_use - leased_usage)
+
+
+def gen_history_file(samples):
+    """
+    a ruffus history file per set of GSMs, so concurrent rp-run processes
+    don't contend for the same sqlite
+    """
+    names = '_'.join(sorted(_.name for _ in samples))
+    return os.path.join('log', '.ruffus_history_{0}.sqlite'.format(
+        hashlib.md5(names).hexdigest()))
+
+
+def run(keeper):
     global samples
     G = PPR.gen_all_samples_from_soft_and_isamp
     samples = G(options.soft_files, options.isamp, config)
     PPR.init_sample_outdirs(samples, config['LOCAL_TOP_OUTDIR'])
+    # skip early those being processed by others, the lease is not acquired
+    # until selected as the free space is calculated
+    samples = [_ for _ in samples
+               if not keeper.is_held_by_others(get_lease_file(_))]
+    if not samples:
+        logger.info('All GSMs are leased by other rp-run processes')
+        return
     PPR.fetch_sras_info(samples, options.recreate_sras_info)
 
     top_outdir = config['LOCAL_TOP_OUTDIR']
@@ -257,12 +377,29 @@ def main():
         top_outdir, cmd_df, min_free, max_usage)
 
     logger.info('Selecting samples to process based their usage')
-    samples = PPR.select_gsms_to_process(samples, free_to_use)
+    samples = PPR.select_gsms_to_process(
+        samples, deduct_leased_usage(free_to_use, top_outdir, keeper))
 
     if not samples:             # when samples == []
         logger.info('Cannot find a GSM that fits the disk usage rule')
         return 
 
+    samples = lease_samples(samples, keeper)
+    if not samples:
+        logger.info('All GSMs selected are leased by other rp-run processes')
+        return
+    samples = release_samples_not_fitting(samples, free_to_use, top_outdir, keeper)
+    if not samples:
+        logger.info('No GSM leased fits with those leased by other rp-run '
+                    'processes')
+        return
+
+    # start the longest predicted jobs first (LPT scheduling) so that a giant
+    # GSM doesn't leave a long tail on a single core at the end of the run,
+    # ruffus dispatches jobs in the order as yielded by originate_params
+    runtime_model = RT.fit_runtime_model(RT.collect_history(top_outdir))
+    samples = RT.sort_by_predicted_runtime(samples, runtime_model)
+
     logger.info('GSMs to process:')
     for k, gsm in enumerate(samples):
         logger.info('\t{0:3d} {1:30s} {2}'.format(k+1, gsm, gsm.outdir))
@@ -270,6 +407,10 @@ def main():
     if 'gen_qsub_script' in options.target_tasks:
         if not options.qsub_template:
             raise IOError('-t/--qsub_template required when running gen_qsub_script')
+        limits = get_qsub_resource_limits()
+        if limits:
+            global cpu_rates
+            cpu_rates = RES.collect_cpu_rates(top_outdir, limits['ncpus'][1])
 
     R.pipeline_run(
         logger=logger,
@@ -278,10 +419,11 @@ def main():
         multiprocess=options.jobs,
         verbose=options.verbose,
         touch_files_only=options.touch_files_only,
-        # history_file=os.path.join('log', '.{0}.sqlite'.format(
-        #     '_'.join([_.name for _ in sorted(samples, key=lambda x: x.name)])))
+        history_file=gen_history_file(samples),
     )
 
+    RT.log_predicted_vs_actual(samples, runtime_model)
+
 
 if __name__ == "__main__":
     main()
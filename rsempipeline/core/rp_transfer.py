@@ -13,7 +13,11 @@ import sys
 sys.stdout.flush()              # flush print outputs to screen
 import re
 import stat
+import zlib
+import base64
 import datetime
+import threading
+import Queue
 import logging.config
 
 from jinja2 import Template
@@ -21,9 +25,26 @@ from jinja2 import Template
 from rsempipeline.utils import misc
 misc.mkdir('log')
 from rsempipeline.utils import pre_pipeline_run as PPR
+from rsempipeline.utils import qsub
+from rsempipeline.utils import runtime as RT
+from rsempipeline.utils import resources as RES
+from rsempipeline.utils import remote_agent as RA
+from rsempipeline.utils import ledger as LG
+from rsempipeline.utils import targets as TG
+from rsempipeline.utils import runner
+from rsempipeline.utils.remote_tree import RemoteTree
+from rsempipeline.utils.state_cache import StateCache
 from rsempipeline.parsers.args_parser import parse_args_for_rp_transfer
 from rsempipeline.conf.settings import (RP_TRANSFER_LOGGING_CONFIG,
-                                        TRANSFER_SCRIPTS_DIR_BASENAME)
+                                        TRANSFER_SCRIPTS_DIR_BASENAME,
+                                        QSUB_SUBMIT_SCRIPT_BASENAME,
+                                        ARRAY_SUBMIT_TEMPLATE,
+                                        BUNDLE_SUBMIT_TEMPLATE,
+                                        REMOTE_AGENT_SCRIPT,
+                                        TRANSFERRED_GSMS_RECORD_BASENAME,
+                                        TRANSFER_LEDGER_BASENAME,
+                                        REMOTE_STATE_CACHE_BASENAME,
+                                        REMOTE_STATE_TTL)
 
 
 logging.config.fileConfig(RP_TRANSFER_LOGGING_CONFIG)
@@ -36,22 +57,38 @@ def get_remote_free_disk_space(remote, username, df_cmd):
 
     :param df_cmd: should be in the form of df -k -P target_dir
     """
-    output = misc.sshexec(df_cmd, remote, username)
-    # e.g. output:
-    # ['Filesystem         1024-blocks      Used Available Capacity Mounted on\n',
-    #  '/dev/analysis        16106127360 12607690752 3498436608      79% /extscratch\n']
+    return parse_df(misc.sshexec(df_cmd, remote, username))
+
+
+def parse_df(output):
+    """
+    :param output: the output of df -k -P, e.g.
+    ['Filesystem         1024-blocks      Used Available Capacity Mounted on\n',
+     '/dev/analysis        16106127360 12607690752 3498436608      79% /extscratch\n']
+    :returns: the free disk space in byte
+    """
     return int(output[1].split()[3]) * 1024
 
 
-def fetch_remote_file_list(remote, username, r_dir):
+def fetch_remote_tree(remote, username, r_dir):
+    """
+    stream the output of find r_dir on remote host into an indexed tree
+    instead of holding it as a list
+    """
     find_cmd = 'find {0}'.format(r_dir)
-    output = misc.sshexec(find_cmd, remote, username)
-    if output is None:
+    return build_remote_tree(
+        misc.sshexec_iter(find_cmd, remote, username), remote, r_dir)
+
+
+def build_remote_tree(lines, remote, r_dir):
+    """index the output of find r_dir on remote host"""
+    tree = RemoteTree(lines)
+    if not len(tree):
         raise ValueError(
             'cannot estimate current usage on remote host. Please check '
             '{0} exists on {1}, or {1} may be down'.format(r_dir, remote))
-    output = [_.strip() for _ in output] # remote trailing '\n'
-    return output
+    logger.info('{0} paths found in {1} on {2}'.format(len(tree), r_dir, remote))
+    return tree
 
 
 def estimate_current_remote_usage(remote, username, r_dir, l_dir, fastq2rsem_ratio):
@@ -60,36 +97,131 @@ def estimate_current_remote_usage(remote, username, r_dir, l_dir, fastq2rsem_rat
     by walking through each GSM and computing the sum of their estimated usage,
     if rsem.COMPLETE exists for a GSM, then ignore that GSM
 
-    mechanism: fetch the list of files in r_dir, and find the
+    mechanism: fetch the tree of files in r_dir, and find the
     fastq.gz for each GSM, then find the corresponding fastq.gz in
     l_dir, and estimate sizes based on them
 
-    :param find_cmd: should be in the form of find {remote_dir}
     :param r_dir: remote rsem output directory
     :param l_dir: local rsem output directory
 
     """
-    files = fetch_remote_file_list(remote, username, r_dir)
+    tree = fetch_remote_tree(remote, username, r_dir)
+    return estimate_usage_from_tree(tree, r_dir, l_dir, fastq2rsem_ratio)
+
+
+def estimate_usage_from_tree(tree, r_dir, l_dir, fastq2rsem_ratio):
+    """see estimate_current_remote_usage"""
+    usage = 0
+    for dir_ in sorted(tree.gsm_dirs):
+        if (not tree.has_file(dir_, 'rsem.COMPLETE')) and (not tree.is_empty_dir(dir_)):
+            # only count the disk spaces used by those GSMs that are
+            # being processed
+            gsm_dir = dir_.replace(r_dir, l_dir)
+            usage += estimate_rsem_usage(gsm_dir, fastq2rsem_ratio)
+    return usage
+
+
+def gen_agent_cmd(r_top_outdir, r_df_dir, r_python='python'):
+    """
+    generate the command that runs the remote agent with r_python on remote
+    host, the source of the agent is shipped within the command itself so
+    nothing needs to be installed remotely
+    """
+    with open(REMOTE_AGENT_SCRIPT) as inf:
+        payload = base64.b64encode(zlib.compress(inf.read()))
+    return ("{0} -c 'import zlib, base64; "
+            "exec(zlib.decompress(base64.b64decode(\"{1}\")))' {2} {3}".format(
+                r_python, payload, r_top_outdir, r_df_dir))
+
+
+def fetch_remote_status(remote, username, r_top_outdir, r_df_dir,
+                        r_python='python'):
+    """
+    walk r_top_outdir on remote host once with the remote agent, which
+    replaces du -s, find and df with a single ssh call
+
+    :returns: a dict with keys of usage (real usage of r_top_outdir), free
+    (free space of the filesystem where r_df_dir is) and gsms (state and usage
+    per GSM keyed by GSM id, e.g. rsem_output/GSExxxxx/homo_sapiens/GSMxxxxxxx)
+    """
+    cmd = gen_agent_cmd(r_top_outdir, r_df_dir, r_python)
+    output = misc.sshexec(cmd, remote, username)
+    if not output:
+        raise ValueError(
+            'no status returned by the agent on {0}, please check {1} exists '
+            'and {2} is available'.format(remote, r_top_outdir, r_python))
+    try:
+        status = RA.decode(output[-1].strip())
+    except (zlib.error, TypeError, ValueError) as err:
+        raise ValueError('unreadable status returned by the agent on '
+                         '{0}: {1}'.format(remote, err))
+    logger.info('status of {0} GSMs in {1} fetched from {2}'.format(
+        len(status['gsms']), r_top_outdir, remote))
+    return status
+
+
+def estimate_usage_from_status(status, l_top_outdir, fastq2rsem_ratio):
+    """
+    the same estimation as estimate_current_remote_usage, but based on the
+    status returned by the remote agent
+    """
     usage = 0
-    for dir_ in sorted(files):
-        match = re.search(r'(GSM\d+$)', os.path.basename(dir_))
-        if match:
-            rsem_comp = os.path.join(dir_, 'rsem.COMPLETE')
-            if (not rsem_comp in files) and (not misc.is_empty_dir(dir_, files)):
-                # only count the disk spaces used by those GSMs that are
-                # being processed
-                gsm_dir = dir_.replace(r_dir, l_dir)
-                usage += estimate_rsem_usage(gsm_dir, fastq2rsem_ratio)
+    for gsm_id, gsm_status in sorted(status['gsms'].items()):
+        if gsm_status['state'] in (RA.TRANSFERRED, RA.RUNNING):
+            gsm_dir = os.path.join(l_top_outdir, gsm_id)
+            usage += estimate_rsem_usage(gsm_dir, fastq2rsem_ratio)
     return usage
 
 
+def get_remote_usage(r_host, r_username, r_top_outdir, l_top_outdir,
+                     r_cmd_df, fastq2rsem_ratio, r_python='python'):
+    """
+    :returns: a tuple of real current usage, estimated current usage and free
+    disk space on remote host, fetched by the remote agent when possible,
+    otherwise with separate du, find and df calls
+    """
+    r_df_dir = r_cmd_df.split()[-1]
+    try:
+        status = fetch_remote_status(
+            r_host, r_username, r_top_outdir, r_df_dir, r_python)
+    except ValueError as err:
+        logger.warning('{0}, falling back to du, find and df'.format(err))
+        return get_remote_usage_by_du_find_df(
+            r_host, r_username, r_top_outdir, l_top_outdir, r_cmd_df,
+            fastq2rsem_ratio)
+    return (status['usage'],
+            estimate_usage_from_status(status, l_top_outdir, fastq2rsem_ratio),
+            status['free'])
+
+
+def get_remote_usage_by_du_find_df(r_host, r_username, r_top_outdir,
+                                   l_top_outdir, r_cmd_df, fastq2rsem_ratio):
+    """
+    the same as get_remote_usage, with du, find and df executed concurrently
+    over one connection, the output of find is held in memory at once
+    instead of streamed
+    """
+    du_output, find_output, df_output = misc.sshexec_many(
+        ['du -s {0}'.format(r_top_outdir), 'find {0}'.format(r_top_outdir),
+         r_cmd_df], r_host, r_username)
+    tree = build_remote_tree(find_output, r_host, r_top_outdir)
+    return (parse_du(du_output),
+            estimate_usage_from_tree(tree, r_top_outdir, l_top_outdir,
+                                     fastq2rsem_ratio),
+            parse_df(df_output))
+
+
 def get_real_current_usage(remote, username, r_dir):
     """this will return real space consumed currently by rsem analysis"""
-    output = misc.sshexec('du -s {0}'.format(r_dir), remote, username)
-    # e.g. output:
-    # ['3096\t/path/to/top_outdir\n']
-    usage = int(output[0].split('\t')[0]) * 1024 # in KB => byte
-    return usage
+    return parse_du(misc.sshexec('du -s {0}'.format(r_dir), remote, username))
+
+
+def parse_du(output):
+    """
+    :param output: the output of du -s, e.g. ['3096\t/path/to/top_outdir\n']
+    :returns: the usage in byte
+    """
+    return int(output[0].split('\t')[0]) * 1024 # in KB => byte
 
 
 def estimate_rsem_usage(gsm_dir, fastq2rsem_ratio):
@@ -104,33 +236,26 @@ def estimate_rsem_usage(gsm_dir, fastq2rsem_ratio):
     return fastq_usage * fastq2rsem_ratio
 
 
-def get_gsms_transferred(record_file):
-    """
-    fetch the list of GSMs that have already been transferred from record_file
-    """
-    if not os.path.exists(record_file):
-        return []
-    with open(record_file) as inf:
-        return [_.strip() for _ in inf if not _.strip().startswith('#')]
+def get_transfer_sizes(gsms_tf_ids, l_top_outdir):
+    """:returns: a dict of the size of files to transfer per GSM"""
+    return dict(
+        (gsm_id, sum(os.path.getsize(os.path.join(l_top_outdir, _))
+                     for _ in list_files_to_transfer(gsm_id, l_top_outdir)))
+        for gsm_id in gsms_tf_ids)
 
 
-def append_transfer_record(gsms_to_transfer, record_file):
+def find_candidates(samples, transferred_gsms):
     """
-    append the GSMs that have just beened transferred successfully to
-    record_file
-    :param gsms_to_transfer: a list of strings representing the GSMs to be transferred, e.g.
-     ['rsem_output/GSE34736/homo_sapiens/GSM854343',
-      'rsem_output/GSE34736/homo_sapiens/GSM854344']
+    the GSMs processed locally but not transferred yet, which is all local
+    so it's done before probing remote hosts
     """
-    with open(record_file, 'ab') as opf:
-        now = datetime.datetime.now().strftime('%y-%m-%d %H:%M:%S')
-        opf.write('# {0}\n'.format(now))
-        for _ in gsms_to_transfer:
-            opf.write('{0}\n'.format(_))
+    return [_ for _ in samples
+            if _.name not in transferred_gsms and PPR.is_processed(_.outdir)]
 
 
 def select_gsms_to_transfer(samples, transferred_gsms,
-                          l_top_outdir, r_free_to_use, fastq2rsem_ratio):
+                          l_top_outdir, r_free_to_use, fastq2rsem_ratio,
+                          max_num=None):
     """
     select samples to transfer (different from select_samples_to_process in
     utils_pre_pipeline.py, which are to process)
@@ -142,12 +267,18 @@ def select_gsms_to_transfer(samples, transferred_gsms,
     :param samples: a list of Sample instances representing both transferred
                     and non-transferred GSMs
     :param transferred_gsms: a list of string with GSM ids. e.g. [GSM1, GSM2]
+    :param max_num: the max number of GSMs to select, e.g. limited by the
+    queue on remote host
 
     """
     # not yet transferred GSMs
     non_tf_gsms = [_ for _  in samples if _.name not in transferred_gsms]
     gsms_to_transfer = []
     for gsm in non_tf_gsms:
+        if max_num is not None and len(gsms_to_transfer) >= max_num:
+            logger.info('{0} GSMs selected, reaching the max allowed by the '
+                        'queue on remote host'.format(max_num))
+            break
         gsm_id = os.path.relpath(gsm.outdir, l_top_outdir)
 
         if not PPR.is_processed(gsm.outdir):
@@ -176,13 +307,48 @@ def create_transfer_sh_dir(l_top_outdir):
     return d
 
 
-def write_transfer_sh(gsms_tf_ids, rsync_template, l_top_outdir,
-                      r_username, r_host, r_top_outdir):
+def gen_transfer_job_name(target_name=None):
+    """
+    :param target_name: when transferring to multiple targets at the same
+    time, the job names are distinguished by the names of targets
+    """
     now = datetime.datetime.now()
     job_name = 'transfer.{0}'.format(now.strftime('%y-%m-%d_%H:%M:%S'))
+    if target_name is not None:
+        job_name = '{0}.{1}'.format(job_name, target_name)
+    return job_name
+
+
+def write_transfer_sh(gsms_tf_ids, rsync_template, l_top_outdir,
+                      r_username, r_host, r_top_outdir, array_job=False,
+                      bundles=None, bundle_parallel=False, bwlimit=None,
+                      job_name=None):
+    """
+    :param array_job: if True, submit all GSMs as a single array job
+    :param bundles: a list of bundles (lists of gsm ids), GSMs in the same
+    bundle are run within one job
+    :param bwlimit: bandwidth limit of rsync in KB/s
+    """
+    if job_name is None:
+        job_name = gen_transfer_job_name()
     tf_dir = create_transfer_sh_dir(l_top_outdir) # tf: transfer
     tf_script = os.path.join(tf_dir, '{0}.sh'.format(job_name))
 
+    files_from = os.path.join(tf_dir, '{0}.files'.format(job_name))
+    write_files_manifest(gsms_tf_ids, l_top_outdir, files_from)
+    job_ids_file = get_job_ids_file(tf_script)
+
+    submit_params = {}
+    # a single GSM is submitted with its own qsub script as usual, PBS Pro
+    # rejects an array of one (-J 1-1)
+    if array_job and len(gsms_tf_ids) > 1:
+        submit_params = write_array_job(
+            gsms_tf_ids, job_name, tf_dir, l_top_outdir, r_top_outdir)
+    elif bundles:
+        submit_params = write_bundle_jobs(
+            bundles, job_name, tf_dir, l_top_outdir, r_top_outdir,
+            bundle_parallel)
+
     # tf_ids: transfer, e.g. rsem_output/GSExxxxx/homo_sapiens/GSMxxxxxx
     write(tf_script, rsync_template,
           job_name=job_name,
@@ -190,9 +356,265 @@ def write_transfer_sh(gsms_tf_ids, rsync_template, l_top_outdir,
           hostname=r_host,
           gsms_to_transfer=gsms_tf_ids,
           local_top_outdir=l_top_outdir,
-          remote_top_outdir=r_top_outdir)
+          remote_top_outdir=r_top_outdir,
+          bwlimit=bwlimit,
+          files_from=files_from,
+          job_ids_file=job_ids_file,
+          **submit_params)
     return tf_script
-    
+
+
+def get_job_ids_file(tf_script):
+    """the file where the job ids are written by tf_script upon submission"""
+    return '{0}.jobids'.format(os.path.splitext(tf_script)[0])
+
+
+def record_submitted(ledger, job_ids_file):
+    """
+    record the GSMs submitted as written to job_ids_file by the transfer
+    script, e.g.
+
+    submitted: rsem_output/GSE1/homo_sapiens/GSM1 Your job 1234 ("GSM1_GSE1") has been submitted
+
+    :returns: a dict of {gsm_id: job_id}
+    """
+    job_ids = {}
+    if not os.path.exists(job_ids_file):
+        logger.warning('{0} not found, no job id recorded'.format(job_ids_file))
+        return job_ids
+    with open(job_ids_file) as inf:
+        for line in inf:
+            match = re.search(r'^submitted: (\S+) (.*)$', line.strip())
+            if not match:
+                continue
+            gsm_id, output = match.groups()
+            job_id = qsub.parse_job_id(output)
+            if job_id is None:
+                logger.error('failed to submit {0}: {1}'.format(gsm_id, output))
+                continue
+            job_ids[gsm_id] = job_id
+    ledger.record(sorted(job_ids.keys()), LG.SUBMITTED, job_id=job_ids)
+    logger.info('{0} GSMs submitted'.format(len(job_ids)))
+    return job_ids
+
+
+def list_files_to_transfer(gsm_id, l_top_outdir):
+    """
+    list the files of a GSM to transfer, i.e. fastq.gz files and the qsub
+    script, which are all directly under the GSM dir, so there is no need to
+    descend into the SRX/SRR subdirs where the sra files are
+
+    :returns: paths relative to l_top_outdir
+    """
+    gsm_dir = os.path.join(l_top_outdir, gsm_id)
+    return [os.path.join(gsm_id, _) for _ in sorted(os.listdir(gsm_dir))
+            if _.endswith('.fastq.gz') or _ == QSUB_SUBMIT_SCRIPT_BASENAME]
+
+
+def write_files_manifest(gsms_tf_ids, l_top_outdir, manifest):
+    """
+    write the exact list of files to transfer for rsync --files-from, one
+    path relative to l_top_outdir per line
+    """
+    num_files = 0
+    with open(manifest, 'wb') as opf:
+        for gsm_id in gsms_tf_ids:
+            for _ in list_files_to_transfer(gsm_id, l_top_outdir):
+                opf.write('{0}\n'.format(_))
+                num_files += 1
+    logger.info('{0} files of {1} GSMs listed in {2}'.format(
+        num_files, len(gsms_tf_ids), manifest))
+    return num_files
+
+
+def transfer_in_streams(gsms_tf_ids, rsync_template, l_top_outdir,
+                        r_username, r_host, r_top_outdir, ledger,
+                        num_streams, bwlimit=None, job_name=None, timeout=None):
+    """
+    Transfer GSMs over num_streams concurrent rsync processes, one GSM at a
+    time per stream. Each GSM is submitted and recorded in the ledger as soon
+    as its own transfer succeeds, so a failed GSM doesn't hold back or force
+    the retransfer of the others
+
+    :param bwlimit: the aggregate bandwidth limit in KB/s, shared evenly by
+    the streams
+    :param timeout: in seconds, after which the transfer of a GSM is killed
+    :returns: a list of the GSMs transferred successfully
+    """
+    num_streams = min(num_streams, len(gsms_tf_ids))
+    stream_bwlimit = max(1, bwlimit // num_streams) if bwlimit else None
+    if job_name is None:
+        job_name = gen_transfer_job_name()
+
+    queue = Queue.Queue()
+    for _ in gsms_tf_ids:
+        queue.put(_)
+    transferred = []
+    lock = threading.Lock()
+
+    def transfer(gsm_id):
+        tf_script = write_transfer_sh(
+            [gsm_id], rsync_template, l_top_outdir, r_username, r_host,
+            r_top_outdir, bwlimit=stream_bwlimit,
+            job_name='{0}.{1}'.format(job_name, os.path.basename(gsm_id)))
+        os.chmod(tf_script, stat.S_IRUSR | stat.S_IWUSR| stat.S_IXUSR)
+        ledger.record([gsm_id], LG.RSYNC_STARTED,
+                      bytes_=get_transfer_sizes([gsm_id], l_top_outdir))
+        rcode = misc.execute_log_stdout_stderr(tf_script, timeout=timeout)
+        if rcode == 0:
+            ledger.record([gsm_id], LG.TRANSFERRED)
+            record_submitted(ledger, get_job_ids_file(tf_script))
+            with lock:
+                transferred.append(gsm_id)
+        else:
+            logger.error('failed to transfer {0}, returncode: {1}, '
+                         'it will be retried next time'.format(gsm_id, rcode))
+
+    def worker():
+        while True:
+            try:
+                gsm_id = queue.get_nowait()
+            except Queue.Empty:
+                return
+            # an unexpected error with one GSM shouldn't stop the stream from
+            # transferring the rest
+            try:
+                transfer(gsm_id)
+            except Exception, err:
+                logger.exception('failed to transfer {0}: {1}'.format(gsm_id, err))
+
+    logger.info('transferring {0} GSMs over {1} streams'.format(
+        len(gsms_tf_ids), num_streams))
+    threads = [threading.Thread(target=worker) for _ in range(num_streams)]
+    for thrd in threads:
+        thrd.start()
+    for thrd in threads:
+        thrd.join()
+    logger.info('{0}/{1} GSMs transferred successfully'.format(
+        len(transferred), len(gsms_tf_ids)))
+    return transferred
+
+
+def write_array_job(gsms_tf_ids, job_name, tf_dir, l_top_outdir, r_top_outdir):
+    """
+    write a manifest listing the GSMs to transfer and an array job script that
+    covers all of them, so that a single qsub is needed per batch instead of
+    one per GSM
+
+    :returns: the scripts to submit, the GSMs covered by each script and extra
+    files to transfer, with paths relative to l_top_outdir, which are the same
+    relative to r_top_outdir after transfer
+    """
+    manifest = os.path.join(tf_dir, '{0}.manifest'.format(job_name))
+    array_script = os.path.join(tf_dir, '{0}.array.sh'.format(job_name))
+    rel = lambda x: os.path.relpath(x, l_top_outdir)
+
+    qsub.write_manifest(gsms_tf_ids, manifest)
+    # the qsub scripts of all GSMs are templated with the same template, so
+    # borrow the directives from the first one, but the resources are sized
+    # per GSM, and every array task gets the same allocation, so request the
+    # max of them
+    qsub_scripts = [os.path.join(l_top_outdir, _, QSUB_SUBMIT_SCRIPT_BASENAME)
+                    for _ in gsms_tf_ids]
+    params = qsub.gen_array_params(
+        qsub_scripts[0], qsub.gen_job_name(job_name),
+        len(gsms_tf_ids), rel(manifest))
+    params['directives'] = qsub.set_resources(
+        params['directives'], params['scheduler'],
+        **qsub.merge_resources(qsub_scripts))
+    write(array_script, ARRAY_SUBMIT_TEMPLATE,
+          remote_top_outdir=r_top_outdir,
+          qsub_script_basename=QSUB_SUBMIT_SCRIPT_BASENAME,
+          **params)
+    logger.info('written array job script covering {0} GSMs: {1}'.format(
+        len(gsms_tf_ids), array_script))
+    return {'submit_scripts': [rel(array_script)],
+            'submit_gsms': [gsms_tf_ids],
+            'extra_files': [rel(manifest), rel(array_script)]}
+
+
+def write_bundle_jobs(bundles, job_name, tf_dir, l_top_outdir, r_top_outdir,
+                      parallel=False):
+    """
+    write one job script per bundle of multiple GSMs, a bundle of a single
+    GSM is submitted with its own qsub script as usual
+
+    :param parallel: run the GSMs of a bundle in parallel instead of
+    sequentially within the allocation
+    :returns: the same as write_array_job
+    """
+    rel = lambda x: os.path.relpath(x, l_top_outdir)
+    submit_scripts, extra_files = [], []
+    for k, bundle in enumerate(bundles):
+        if len(bundle) == 1:
+            submit_scripts.append(
+                os.path.join(bundle[0], QSUB_SUBMIT_SCRIPT_BASENAME))
+            continue
+        bundle_name = '{0}.bundle{1}'.format(job_name, k + 1)
+        bundle_script = os.path.join(tf_dir, '{0}.sh'.format(bundle_name))
+        qsub_scripts = [os.path.join(l_top_outdir, _, QSUB_SUBMIT_SCRIPT_BASENAME)
+                        for _ in bundle]
+        params = qsub.gen_bundle_params(
+            qsub_scripts[0], qsub.gen_job_name(bundle_name))
+        # sized per GSM, the GSMs of the bundle share one allocation
+        resources = qsub.merge_resources(qsub_scripts, parallel)
+        params['directives'] = qsub.set_resources(
+            params['directives'], params['scheduler'],
+            resources['ncpus'], resources['mem'])
+        walltime = calc_bundle_walltime(bundle, l_top_outdir, parallel)
+        if walltime is not None:
+            params['directives'] = qsub.set_walltime(
+                params['directives'], params['scheduler'], walltime)
+        write(bundle_script, BUNDLE_SUBMIT_TEMPLATE,
+              gsm_dirs=bundle,
+              parallel=parallel,
+              remote_top_outdir=r_top_outdir,
+              qsub_script_basename=QSUB_SUBMIT_SCRIPT_BASENAME,
+              **params)
+        logger.info('written bundle job script for {0} GSMs: {1}'.format(
+            len(bundle), bundle_script))
+        submit_scripts.append(rel(bundle_script))
+        extra_files.append(rel(bundle_script))
+    return {'submit_scripts': submit_scripts, 'submit_gsms': bundles,
+            'extra_files': extra_files}
+
+
+def calc_bundle_walltime(bundle, l_top_outdir, parallel):
+    """
+    The walltime of a bundle is the sum of the walltimes of its GSMs when
+    they run sequentially, or the max when in parallel. Return None if any of
+    the GSMs' qsub scripts doesn't request a walltime
+    """
+    walltimes = [
+        qsub.get_walltime(
+            os.path.join(l_top_outdir, _, QSUB_SUBMIT_SCRIPT_BASENAME))
+        for _ in bundle]
+    if None in walltimes:
+        return
+    seconds = [RES.parse_walltime(_) for _ in walltimes]
+    return RES.format_walltime(max(seconds) if parallel else sum(seconds))
+
+
+def bundle_gsms(gsms_tf_ids, l_top_outdir, max_runtime):
+    """
+    Group GSMs into bundles based on their predicted rsem runtime, return None
+    when there is no historical runtime to predict from
+
+    :param max_runtime: max total predicted runtime of a bundle in seconds
+    """
+    model = RT.fit_runtime_model(RT.collect_history(l_top_outdir))
+    if not model:
+        logger.warning('no historical rsem runtime available in {0}, '
+                       'GSMs will not be bundled'.format(l_top_outdir))
+        return
+    runtimes = [
+        (_, RT.predict_gsm_runtime(model, os.path.join(l_top_outdir, _)))
+        for _ in gsms_tf_ids]
+    bundles = qsub.pack_bundles(runtimes, max_runtime)
+    logger.info('{0} GSMs are packed into {1} bundles'.format(
+        len(gsms_tf_ids), len(bundles)))
+    return bundles
+
 
 def write(transfer_script, template, **params):
     """
@@ -210,22 +632,31 @@ def write(transfer_script, template, **params):
 
 
 def calc_remote_free_space_to_use(r_host, r_username, r_top_outdir, l_top_outdir,
-                                  r_cmd_df, r_max_usage, r_min_free, fastq2rsem_ratio):
+                                  r_cmd_df, r_max_usage, r_min_free, fastq2rsem_ratio,
+                                  r_python='python', cache=None):
+    """
+    :param cache: a StateCache, where the usage is looked up first
+    """
     # r_real_current_usage is just for giving an idea of real usage on remote,
     # and it's not used for calculating free space to use
     P = misc.pretty_usage
 
-    r_real = get_real_current_usage(r_host, r_username, r_top_outdir)
+    fetch = lambda: list(get_remote_usage(
+        r_host, r_username, r_top_outdir, l_top_outdir, r_cmd_df,
+        fastq2rsem_ratio, r_python))
+    if cache is None:
+        usage = fetch()
+    else:
+        usage = cache.get(r_host, 'usage:{0}'.format(r_top_outdir), fetch)
+    r_real, r_estimated_current_usage, r_free_space = usage
+
     r_real_pretty = P(r_real)
     logger.info('real current usage on {r_host} by {r_top_outdir}: '
                 '{r_real_pretty}'.format(**locals()))
 
-    r_estimated_current_usage = estimate_current_remote_usage(
-        r_host, r_username, r_top_outdir, l_top_outdir, fastq2rsem_ratio)
     r_estimated_current_usage_pretty = P(r_estimated_current_usage)
     logger.info('free space on {r_host}: {r_estimated_current_usage_pretty}'.format(**locals()))
 
-    r_free_space = get_remote_free_disk_space(r_host, r_username, r_cmd_df)
     r_free_space_pretty = P(r_free_space)
     logger.info('free space on {r_host}: {r_free_space_pretty}'.format(**locals()))
 
@@ -240,36 +671,279 @@ def calc_remote_free_space_to_use(r_host, r_username, r_top_outdir, l_top_outdir
     return r_free_to_use
 
 
+def get_queue_state(r_host, r_username, cache=None):
+    """
+    :param cache: a StateCache, where the state is looked up first
+    :returns: a dict of the numbers of jobs of r_username pending and running
+    on remote host, with a single call of qstat
+    """
+    if cache is not None:
+        return cache.get(r_host, 'queue:{0}'.format(r_username),
+                         lambda: get_queue_state(r_host, r_username))
+    output = misc.sshexec('qstat -u {0}'.format(r_username), r_host, r_username)
+    if output is None:
+        raise ValueError('failed to execute qstat on {0}'.format(r_host))
+    return qsub.parse_qstat_states(output)
+
+
+def estimate_job_runtime(l_top_outdir):
+    """the median of historical rsem runtime in seconds, None if no history"""
+    seconds = [_[2] for _ in RT.collect_history(l_top_outdir)]
+    if seconds:
+        return RES.median(seconds)
+
+
+def calc_queue_capacity(queue, horizon, runtime, r_host, ceiling=None):
+    """
+    the max number of GSMs to transfer to r_host so that their jobs are
+    expected to start within horizon (hours), None for no limit
+
+    :param queue: as returned by get_queue_state
+    :param ceiling: the REMOTE_QUEUE_CEILING of the target
+    """
+    capacity = TG.calc_capacity(
+        queue['pending'], queue['running'], runtime, horizon, ceiling)
+    logger.info('{0}: {1} jobs pending, {2} running, typical runtime: {3}, '
+                'max GSMs to transfer to start within {4}h: {5}'.format(
+                    r_host, queue['pending'], queue['running'],
+                    RT.pretty_runtime(runtime),
+                    horizon, 'no limit' if capacity is None else capacity))
+    return capacity
+
+
+def survey_targets(targets, l_top_outdir, fastq2rsem_ratio, ledger,
+                   cache=None):
+    """
+    collect the free space to use, queue depth and observed throughput of
+    each target, a target that cannot be reached is skipped this time
+
+    :param cache: a StateCache of the remote hosts
+
+    :returns: a dict of {target name: state}
+    """
+    states = {}
+    runtime = None
+    if any(_.get('REMOTE_QUEUE_HORIZON') for _ in targets):
+        runtime = estimate_job_runtime(l_top_outdir)
+    for target in targets:
+        name = target['NAME']
+        r_host, r_username = target['REMOTE_HOST'], target['USERNAME']
+        try:
+            free_to_use = calc_remote_free_space_to_use(
+                r_host, r_username, target['REMOTE_TOP_OUTDIR'], l_top_outdir,
+                target['REMOTE_CMD_DF'],
+                misc.ugly_usage(target['REMOTE_MAX_USAGE']),
+                misc.ugly_usage(target['REMOTE_MIN_FREE']),
+                fastq2rsem_ratio, target['REMOTE_PYTHON'], cache)
+            queue = get_queue_state(r_host, r_username, cache)
+        except Exception, err:
+            logger.exception(err)
+            logger.error('target {0} is skipped'.format(name))
+            continue
+        capacity = None
+        if target.get('REMOTE_QUEUE_HORIZON'):
+            capacity = calc_queue_capacity(
+                queue, target['REMOTE_QUEUE_HORIZON'], runtime, r_host,
+                target.get('REMOTE_QUEUE_CEILING'))
+        queue_depth = queue['pending'] + queue['running']
+        throughput = ledger.get_throughput(name)
+        states[name] = dict(free_to_use=free_to_use, queue_depth=queue_depth,
+                            throughput=throughput, capacity=capacity)
+        logger.info('target {0}: free_to_use: {1}, queue depth: {2}, '
+                    'throughput: {3}'.format(
+                        name, misc.pretty_usage(free_to_use), queue_depth,
+                        '{0}/s'.format(misc.pretty_usage(throughput))
+                        if throughput else 'unknown'))
+    return states
+
+
+def place_gsms_on_targets(samples, transferred_gsms, l_top_outdir, states,
+                          fastq2rsem_ratio):
+    """
+    the counterpart of select_gsms_to_transfer for multiple targets
+
+    :returns: a dict of {target name: [gsm_ids]}
+    """
+    usages = []
+    for gsm in samples:
+        if gsm.name in transferred_gsms or not PPR.is_processed(gsm.outdir):
+            continue
+        usages.append((os.path.relpath(gsm.outdir, l_top_outdir),
+                       estimate_rsem_usage(gsm.outdir, fastq2rsem_ratio)))
+    return TG.place(usages, states)
+
+
+def retarget_qsub_scripts(gsms_tf_ids, target, l_top_outdir, config):
+    """regenerate 0_submit.sh of gsms_tf_ids for target"""
+    template = target['QSUB_TEMPLATE']
+    limits = config.get('QSUB_RESOURCES', {}).get(template)
+    cpu_rates = None
+    if limits:
+        cpu_rates = RES.collect_cpu_rates(l_top_outdir, limits['ncpus'][1])
+    for gsm_id in gsms_tf_ids:
+        TG.render_qsub_script(
+            os.path.join(l_top_outdir, gsm_id), template,
+            target['REMOTE_REFERENCE_NAMES'], limits, cpu_rates)
+    logger.info('regenerated {0} qsub scripts with {1} for target {2}'.format(
+        len(gsms_tf_ids), template, target['NAME']))
+
+
+def transfer_to_target(gsms_tf_ids, target, options, l_top_outdir, ledger,
+                       bwlimit=None, job_name=None):
+    """
+    transfer gsms_tf_ids to target and submit them, in parallel streams, as
+    an array job, in bundles or one qsub per GSM as specified in options
+    """
+    r_host, r_username = target['REMOTE_HOST'], target['USERNAME']
+    r_top_outdir = target['REMOTE_TOP_OUTDIR']
+    # a hung rsync (e.g. a stalled connection) would otherwise block all
+    # following runs of rp-transfer
+    timeout = options.rsync_timeout * 3600 if options.rsync_timeout else None
+    if options.parallel_streams:
+        transfer_in_streams(
+            gsms_tf_ids, options.rsync_template, l_top_outdir,
+            r_username, r_host, r_top_outdir, ledger,
+            options.parallel_streams, bwlimit, job_name, timeout)
+        return
+
+    bundles = None
+    if options.bundle_runtime:
+        bundles = bundle_gsms(
+            gsms_tf_ids, l_top_outdir, options.bundle_runtime * 3600)
+
+    tf_script = write_transfer_sh(
+        gsms_tf_ids, options.rsync_template, l_top_outdir,
+        r_username, r_host, r_top_outdir, options.array_job,
+        bundles, options.bundle_parallel, bwlimit, job_name)
+
+    os.chmod(tf_script, stat.S_IRUSR | stat.S_IWUSR| stat.S_IXUSR)
+    ledger.record(gsms_tf_ids, LG.RSYNC_STARTED,
+                  bytes_=get_transfer_sizes(gsms_tf_ids, l_top_outdir))
+    rcode = misc.execute_log_stdout_stderr(tf_script, timeout=timeout)
+
+    if rcode == 0:
+        # different from processing in rsempipeline.py, where the completion is
+        # marked by .COMPLETE flags, but by recording the completed GSMs in
+        # the ledger
+        ledger.record(gsms_tf_ids, LG.TRANSFERRED)
+        record_submitted(ledger, get_job_ids_file(tf_script))
+    else:
+        logger.error('failed to transfer to {0}, returncode: {1}'.format(
+            target['NAME'], rcode))
+
+
+def dispatch_to_targets(samples, transferred_gsms, targets, options, config,
+                        ledger, cache=None):
+    """
+    place each GSM on the best target for it and transfer to all targets
+    concurrently, the bandwidth limit is shared evenly by the targets
+    """
+    l_top_outdir = config['LOCAL_TOP_OUTDIR']
+    fastq2rsem_ratio = config['FASTQ2RSEM_RATIO']
+    states = survey_targets(targets, l_top_outdir, fastq2rsem_ratio, ledger,
+                            cache)
+    placement = place_gsms_on_targets(
+        samples, transferred_gsms, l_top_outdir, states, fastq2rsem_ratio)
+    if not placement:
+        logger.info('Cannot find a GSM that fits any target')
+        return
+
+    bwlimit = options.bwlimit
+    if bwlimit:
+        bwlimit = max(1, bwlimit // len(placement))
+    threads, hosts = [], []
+    for target in targets:
+        gsms_tf_ids = placement.get(target['NAME'])
+        if not gsms_tf_ids:
+            continue
+        hosts.append(target['REMOTE_HOST'])
+        logger.info('GSMs to transfer to {0}:'.format(target['NAME']))
+        for k, gsm_id in enumerate(gsms_tf_ids):
+            logger.info('\t{0:3d} {1}'.format(k + 1, gsm_id))
+        ledger.record(gsms_tf_ids, LG.SELECTED, target=target['NAME'])
+        retarget_qsub_scripts(gsms_tf_ids, target, l_top_outdir, config)
+        threads.append(threading.Thread(
+            target=transfer_to_target,
+            args=(gsms_tf_ids, target, options, l_top_outdir, ledger,
+                  bwlimit, gen_transfer_job_name(target['NAME']))))
+    for thrd in threads:
+        thrd.start()
+    for thrd in threads:
+        thrd.join()
+    if cache is not None:
+        for host in hosts:
+            cache.invalidate(host)
+
+
 @misc.lockit(os.path.expanduser('~/.rp-transfer'))
 def main():
     options = parse_args_for_rp_transfer()
     config = misc.get_config(options.config_file)
+    runner.exit_on_sigterm()
+    try:
+        run(options, config)
+    finally:
+        # rsync or ascp left running would be taken as not transferred yet
+        # and transferred again by the next rp-transfer
+        runner.kill_all()
+
 
+def run(options, config):
     # r_: means relevant to remote host, l_: to local host
     l_top_outdir = config['LOCAL_TOP_OUTDIR']
-    r_top_outdir = config['REMOTE_TOP_OUTDIR']
 
     G = PPR.gen_all_samples_from_soft_and_isamp
     samples = G(options.soft_files, options.isamp, config)
     PPR.init_sample_outdirs(samples, l_top_outdir)
 
-    r_host, r_username = config['REMOTE_HOST'], config['USERNAME']
+    # tf: transfer/transferred, GSMs in transferred_GSMs.txt are imported
+    # when the ledger is created for the first time
+    ledger = LG.open_ledger(
+        os.path.join(l_top_outdir, TRANSFER_LEDGER_BASENAME),
+        os.path.join(l_top_outdir, TRANSFERRED_GSMS_RECORD_BASENAME))
+    tf_gsms_bn = ledger.get_gsms(LG.TRANSFERRED)
+
+    # most of the time there is nothing new to transfer, in which case remote
+    # hosts are not bothered at all
+    candidates = find_candidates(samples, tf_gsms_bn)
+    if not candidates:
+        logger.info('No GSM is processed and not transferred yet')
+        return
+    logger.info('{0} GSMs are processed and not transferred yet'.format(
+        len(candidates)))
+
+    cache = StateCache(
+        os.path.join(l_top_outdir, REMOTE_STATE_CACHE_BASENAME),
+        config.get('REMOTE_STATE_TTL', REMOTE_STATE_TTL) * 60)
+    targets = TG.get_targets(config)
+    ledger.set_default_target(targets[0]['NAME'])
+    if len(targets) > 1:
+        dispatch_to_targets(candidates, tf_gsms_bn, targets, options, config,
+                            ledger, cache)
+        ledger.log_summary()
+        return
+
+    target = targets[0]
     fastq2rsem_ratio = config['FASTQ2RSEM_RATIO']
-    r_cmd_df = config['REMOTE_CMD_DF']
-    r_min_free = misc.ugly_usage(config['REMOTE_MIN_FREE'])
-    r_max_usage = misc.ugly_usage(config['REMOTE_MAX_USAGE'])
     r_free_to_use  = calc_remote_free_space_to_use(
-        r_host, r_username, r_top_outdir, l_top_outdir,
-        r_cmd_df, r_max_usage, r_min_free, fastq2rsem_ratio)
-
-    # tf: transfer/transferred
-    tf_record = os.path.join(l_top_outdir, 'transferred_GSMs.txt')
-    tf_gsms = get_gsms_transferred(tf_record)
-    tf_gsms_bn = map(os.path.basename, tf_gsms)
+        target['REMOTE_HOST'], target['USERNAME'], target['REMOTE_TOP_OUTDIR'],
+        l_top_outdir, target['REMOTE_CMD_DF'],
+        misc.ugly_usage(target['REMOTE_MAX_USAGE']),
+        misc.ugly_usage(target['REMOTE_MIN_FREE']),
+        fastq2rsem_ratio, target['REMOTE_PYTHON'], cache)
+
+    # don't transfer more GSMs than the cluster will start within the horizon
+    max_num = None
+    if target['REMOTE_QUEUE_HORIZON']:
+        max_num = calc_queue_capacity(
+            get_queue_state(target['REMOTE_HOST'], target['USERNAME'], cache),
+            target['REMOTE_QUEUE_HORIZON'], estimate_job_runtime(l_top_outdir),
+            target['REMOTE_HOST'], target.get('REMOTE_QUEUE_CEILING'))
 
     logger.info('Selecting samples to transfer based their estimated remote usage')
     gsms_to_tf = select_gsms_to_transfer(
-        samples, tf_gsms_bn, l_top_outdir, r_free_to_use, fastq2rsem_ratio)
+        candidates, tf_gsms_bn, l_top_outdir, r_free_to_use, fastq2rsem_ratio,
+        max_num)
 
     if not gsms_to_tf:
         logger.info('Cannot find a GSM that fits the current disk usage rule')
@@ -281,18 +955,11 @@ def main():
 
     gsms_to_tf_ids = [os.path.relpath(_.outdir, l_top_outdir)
                       for _ in gsms_to_tf]
-    tf_script = write_transfer_sh(
-        gsms_to_tf_ids, options.rsync_template, l_top_outdir,
-        r_username, r_host, r_top_outdir)
-
-    os.chmod(tf_script, stat.S_IRUSR | stat.S_IWUSR| stat.S_IXUSR)
-    rcode = misc.execute_log_stdout_stderr(tf_script)
-
-    if rcode == 0:
-        # different from processing in rsempipeline.py, where the completion is
-        # marked by .COMPLETE flags, but by writting the completed GSMs to
-        # gsms_transfer_record
-        append_transfer_record(gsms_to_tf_ids, tf_record)
+    ledger.record(gsms_to_tf_ids, LG.SELECTED)
+    transfer_to_target(gsms_to_tf_ids, target, options, l_top_outdir, ledger,
+                       options.bwlimit)
+    cache.invalidate(target['REMOTE_HOST'])
+    ledger.log_summary()
 
 
 if __name__ == "__main__":
@@ -80,5 +80,54 @@ def parse_args_for_rp_transfer():
         help=('template for transferring GSMs from localhost to remote host, '
               'refer to {0} (default template) for an example.'.format(
                   default_rsync_template)))
+    submission = parser.add_mutually_exclusive_group()
+    submission.add_argument(
+        '--array_job', action='store_true',
+        help=('if specified, submit all transferred GSMs as a single array job '
+              '(-t for SGE, -J for PBS) instead of one qsub per GSM. The '
+              'resources requested are taken from the 0_submit.sh of the '
+              'first GSM'))
+    submission.add_argument(
+        '--bundle_runtime', type=float,
+        help=('if specified, pack small GSMs into bundles, each of which is '
+              'run as a single job with a total predicted rsem runtime no '
+              'more than this number of hours. The prediction is based on '
+              'historical rsem runtime under LOCAL_TOP_OUTDIR'))
+    submission.add_argument(
+        '--parallel_streams', type=int,
+        help=('if specified, transfer GSMs over this number of concurrent '
+              'rsync streams, each GSM is submitted and recorded as '
+              'transferred as soon as its own transfer completes'))
+    parser.add_argument(
+        '--bwlimit', type=int,
+        help=('the aggregate bandwidth limit of rsync in KB/s, shared evenly '
+              'by the streams when --parallel_streams is specified'))
+    parser.add_argument(
+        '--rsync_timeout', type=float,
+        help=('if specified, kill the transfer (rsync and qsub) after this '
+              'number of hours, the GSMs not transferred are retried next time'))
+    parser.add_argument(
+        '--bundle_parallel', action='store_true',
+        help=('used with --bundle_runtime, run the GSMs of a bundle in '
+              'parallel instead of sequentially within the allocation, make '
+              'sure the resources requested in the qsub template are enough'))
+
+    return parser.parse_args()
+
+
+def parse_args_for_rp_harvest():
+    """parse command line arguments and return options"""
+    parser = argparse.ArgumentParser(
+        description='rp-harvest',
+        usage='require python-2.7.x',
+        version='0.1')
+
+    parser.add_argument(
+        '-c', '--config_file', default='rp_config.yml',
+        help='a YAML configuration file, the same one used by rp-transfer')
+    parser.add_argument(
+        '--keep_remote', action='store_true',
+        help=('if specified, the GSM dirs on remote host are not removed '
+              'after their results are fetched and verified'))
 
     return parser.parse_args()
@@ -132,3 +132,26 @@ def parse(soft_file, interested_organisms):
                 series.name, series.num_passed_samples(), series.num_samples()))
             logger.info('=' * 30)
             return series
+
+
+def parse_organisms(soft_file):
+    """
+    Get the organisms of every sample in the soft file regardless of whether
+    it's relevant to rsem analysis, e.g.
+
+    ^SAMPLE = GSM1446812
+    !Sample_organism_ch1 = Homo sapiens
+
+    :returns: a dict of {GSM: a list of organisms}, of all channels in the
+    order listed
+    """
+    res, current_sample = {}, None
+    with open(soft_file, 'rb') as inf:
+        for line in inf:
+            if line.startswith('^SAMPLE'):
+                current_sample = line.split('=', 1)[1].strip()
+                res[current_sample] = []
+            elif (line.startswith('!Sample_organism_ch') and
+                  current_sample is not None):
+                res[current_sample].append(line.split('=', 1)[1].strip())
+    return dict((k, v) for k, v in res.items() if v)
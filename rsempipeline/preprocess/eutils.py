@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*
+
+"""
+Resolve the species (organism) of GSMs in batches with esummary of NCBI
+E-utilities instead of downloading and parsing the html page of each GSM,
+i.e. hundreds of GSMs per request rather than one. The UID of a GSM in the gds
+database is its number plus 300000000, e.g. GSM1446812 => 301446812, so no
+esearch is needed.
+
+The response of each batch is cached under the outdir, so rerunning gen-csv
+with the same input doesn't hit NCBI again. GSMs without a summary (e.g.
+private ones) are left for the html scraper.
+"""
+
+import os
+import json
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+import requests
+
+from rsempipeline.utils.misc import mkdir
+from rsempipeline.preprocess.utils import join_species
+from rsempipeline.conf.settings import ESUMMARY_OUTDIR_BASENAME
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+# the number of GSMs per request, which keeps the url well within the limit
+BATCH_SIZE = 200
+GDS_UID_OFFSET = 300000000
+
+
+def gsm2uid(gsm):
+    """e.g. GSM1446812 => 301446812"""
+    return str(GDS_UID_OFFSET + int(gsm[3:]))
+
+
+def gen_esummary_outdir(outdir):
+    d = os.path.join(outdir, ESUMMARY_OUTDIR_BASENAME)
+    mkdir(d)
+    return d
+
+
+def get_cache_file(cache_dir, uids):
+    """the cache file of the batch of uids"""
+    key = hashlib.md5(','.join(uids)).hexdigest()
+    return os.path.join(cache_dir, '{0}.json'.format(key))
+
+
+def fetch_summary(uids, cache_dir, client, url=EUTILS_URL):
+    """:returns: the esummary of uids in json, from the cache if available"""
+    cache_file = get_cache_file(cache_dir, uids)
+    if os.path.exists(cache_file):
+        logger.info('{0} already downloaded'.format(cache_file))
+        with open(cache_file) as inf:
+            return json.load(inf)
+    logger.info('fetching esummary of {0} GSMs to {1}'.format(
+        len(uids), cache_file))
+    response = client.get(
+        '{0}/esummary.fcgi'.format(url),
+        params={'db': 'gds', 'id': ','.join(uids), 'retmode': 'json'})
+    summary = response.json()
+    # a cache left half written would be taken as complete in the next run
+    tmp_file = '{0}.tmp'.format(cache_file)
+    with open(tmp_file, 'wb') as opf:
+        json.dump(summary, opf)
+    os.rename(tmp_file, cache_file)
+    return summary
+
+
+def parse_summary(summary):
+    """
+    :param summary: esummary in json, e.g.
+    {"result": {"uids": ["301446812"],
+                "301446812": {"accession": "GSM1446812", "entrytype": "GSM",
+                              "taxon": "Homo sapiens", ...}}}
+
+    a uid not found comes with an error instead, e.g.
+    "301446813": {"uid": "301446813", "error": "cannot get document summary"}
+
+    the taxon of a GSM of multiple organisms is like "Mus musculus; Homo
+    sapiens", which is formatted by join_species as the other backends
+
+    :returns: a dict of {GSM: species}
+    """
+    result = summary.get('result', {})
+    res = {}
+    for uid in result.get('uids', []):
+        doc = result.get(uid, {})
+        if doc.get('entrytype') == 'GSM' and doc.get('taxon'):
+            res[doc['accession']] = join_species(doc['taxon'].split(';'))
+    return res
+
+
+def find_species(gsms, outdir, client, url=EUTILS_URL, batch_size=BATCH_SIZE):
+    """
+    :returns: a dict of {GSM: species} of the GSMs resolved, a batch that
+    fails is logged and its GSMs are left unresolved
+    """
+    cache_dir = gen_esummary_outdir(outdir)
+    res = {}
+    for k in range(0, len(gsms), batch_size):
+        batch = gsms[k:k + batch_size]
+        try:
+            summary = fetch_summary([gsm2uid(_) for _ in batch], cache_dir,
+                                    client, url)
+        except (requests.RequestException, ValueError), err:
+            logger.exception('failed to fetch esummary of {0}..{1}: {2}'.format(
+                batch[0], batch[-1], err))
+            continue
+        res.update(parse_summary(summary))
+    logger.info('species of {0}/{1} GSMs found in esummary'.format(
+        len(res), len(gsms)))
+    return res
@@ -12,17 +12,24 @@ import re
 import csv
 import threading
 import Queue
+from HTMLParser import HTMLParser
 import logging
 logger = logging.getLogger(__name__)
 
-from bs4 import BeautifulSoup
-import requests
-
-from rsempipeline.preprocess.utils import read
+from rsempipeline.preprocess import eutils, get_soft
+from rsempipeline.parsers.soft_parser import parse_organisms
+from rsempipeline.preprocess.utils import read, gen_outdir, join_species
+from rsempipeline.preprocess.packed_cache import PackedCache, gen_cache_file
 from rsempipeline.utils.misc import backup_file, mkdir
+from rsempipeline.utils.http_client import HTTPClient, NCBI_RATE
 from rsempipeline.conf.settings import (HTML_OUTDIR_BASENAME,
                                         SPECIES_CSV_BASENAME,
-                                        NO_SPECIES_CSV_BASENAME)
+                                        NO_SPECIES_CSV_BASENAME,
+                                        GEN_CSV_JOURNAL_BASENAME)
+
+# where the species of GSMs is looked up, the html page of each GSM is always
+# the fallback
+BACKENDS = ['html', 'eutils', 'soft']
 
 def write_csv(rows, out_csv):
     with open(out_csv, 'wb') as opf:
@@ -32,29 +39,101 @@ def write_csv(rows, out_csv):
             csv_writer.writerow(_)
 
 
-def find_species(gse, gsm, outdir):
-    """functions calling order: find_sepecies -> gen_soup -> download_html"""
-    soup = gen_soup(gse, gsm, outdir)
-    td = soup.find('td', text=re.compile('Organism|Organisms'))
-    if td:
-        species = td.find_next_sibling().text.strip()
-        return species
+# the client shared by all threads unless one is passed in, created lazily
+default_client = None
+
+
+def get_client():
+    global default_client
+    if default_client is None:
+        default_client = HTTPClient()
+    return default_client
+
+
+# the cell labeled Organism(s) followed by the cell of its value in the html of
+# a GSM, e.g.
+# <td nowrap>Organism</td>
+# <td><a href="/Taxonomy/Browser/wwwtax.cgi?mode=Info&amp;id=9606">Homo sapiens</a></td>
+ORGANISM_CELL_RE = re.compile(
+    r'<td[^>]*>[^<]*Organisms?[^<]*</td>\s*<td[^>]*>(.*?)</td>', re.DOTALL)
+# a two-channel sample lists the organism of each channel in its own cell,
+# following the label of the channel
+CHANNEL_RE = re.compile(r'>\s*Channel 1\s*<')
+# in bytes
+HTML_CHUNK_SIZE = 16384
+
+
+def find_species(gse, gsm, outdir, client=None, cache=None):
+    """
+    functions calling order: find_sepecies -> gen_gsm_html -> download_html,
+    the species found, or not found (e.g. private GSMs), is cached in a
+    .species file next to the html so a rerun doesn't parse it again
+
+    :param cache: a PackedCache, if specified, the html and species are
+    cached there instead of in html/<GSE>/
+    """
+    if cache is not None:
+        return find_species_in_cache(gse, gsm, cache, client)
+    species_file = os.path.join(gen_gse_dir(outdir, gse),
+                                '{0}.species'.format(gsm))
+    if os.path.exists(species_file):
+        with open(species_file) as inf:
+            return inf.read().strip() or None
+    gsm_html = gen_gsm_html(outdir, gse, gsm, client)
+    species = extract_species(gsm_html)
+    tmp_file = '{0}.tmp'.format(species_file)
+    with open(tmp_file, 'wb') as opf:
+        opf.write(species.encode('utf-8') if species else '')
+    os.rename(tmp_file, species_file)
+    return species
+
 
+def extract_species(gsm_html):
+    """
+    scan the html for the organism cell instead of building the whole DOM,
+    and stop reading as soon as it's found (the cells of both channels for a
+    two-channel sample), which is in the first part of the page
 
-def gen_soup(gse, gsm, outdir):
-    gsm_html = gen_gsm_html(outdir, gse, gsm)
+    :returns: the species, None if not found
+    """
+    content = ''
     with open(gsm_html) as inf:
-        soup = BeautifulSoup(inf)
-    return soup
+        while True:
+            chunk = inf.read(HTML_CHUNK_SIZE)
+            if not chunk:
+                break
+            content += chunk
+            matches = list(ORGANISM_CELL_RE.finditer(content))
+            if matches and (len(matches) > 1 or
+                            not CHANNEL_RE.search(content, 0, matches[0].start())):
+                break
+    return parse_organism_cells(content)
 
 
-def gen_outdir(options):
-    if options.outdir:
-        d = options.outdir
-        mkdir(d)
-    else:
-        d = os.path.dirname(options.input_csv)
-    return d
+def parse_organism_cells(html):
+    """:returns: the species in all organism cells of html, None if not found"""
+    names = []
+    for match in ORGANISM_CELL_RE.finditer(html):
+        # multiple organisms in a cell are separated by <br>
+        for text in re.split(r'<br\s*/?>', match.group(1)):
+            text = re.sub(r'<[^>]+>', '', text)
+            names.append(HTMLParser().unescape(text.decode('utf-8')))
+    return join_species(names)
+
+
+def find_species_in_cache(gse, gsm, cache, client=None):
+    """the same as find_species, with the html and species in cache"""
+    resolved, species = cache.get_species(gsm)
+    if resolved:
+        return species
+    html = cache.get_html(gsm)
+    if html is None:
+        logger.info('downloading {0} into {1}'.format(gsm, cache.db_file))
+        html = fetch_html(gsm, client)
+        cache.put_html(gse, gsm, html)
+    species = parse_organism_cells(html)
+    cache.put_species(gse, gsm, species)
+    return species
 
 
 def gen_html_outdir(outdir):
@@ -70,50 +149,180 @@ def gen_gse_dir(outdir, gse):
     return gse_dir
 
 
-def gen_gsm_html(outdir, gse, gsm):
+def gen_gsm_html(outdir, gse, gsm, client=None):
     gse_dir = gen_gse_dir(outdir, gse)
     gsm_html = os.path.join(gse_dir, '{0}.html'.format(gsm))
     if not os.path.exists(gsm_html):
         logger.info('downloading {0}'.format(gsm_html))
-        download_html(gsm, gsm_html)
+        download_html(gsm, gsm_html, client)
     else:
         logger.info('{0} already downloaded'.format(gsm_html))        
     return gsm_html
 
 
-def download_html(gsm, out_html):
+def find_species_in_softs(input_csv, gses, outdir, num_workers=1):
+    """
+    look up the species of GSMs in the soft files of gses, which are
+    downloaded as by get-soft unless they already exist, i.e. one request per
+    GSE instead of one per GSM, over num_workers FTP connections
+
+    :returns: a dict of {GSM: species}
+    """
+    soft_outdir = get_soft.gen_soft_outdir(outdir)
+    soft_subsets = [get_soft.get_soft_subset(_, soft_outdir) for _ in gses]
+    if not all(os.path.exists(_) for _ in soft_subsets):
+        get_soft.download_soft(input_csv, soft_outdir, num_workers)
+    res = {}
+    for soft_subset in soft_subsets:
+        if os.path.exists(soft_subset):
+            for gsm, organisms in parse_organisms(soft_subset).items():
+                res[gsm] = join_species(organisms)
+        else:
+            logger.warning('{0} not found'.format(soft_subset))
+    return res
+
+
+def fetch_html(gsm, client=None):
+    """:returns: the html page of gsm encoded in utf-8"""
+    if client is None:
+        client = get_client()
     url = "http://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={0}".format(gsm)
-    response = requests.get(url)
-    with open(out_html, 'wb') as opf:
-        opf.write(response.text.encode('utf-8'))
+    response = client.get(url)
+    return response.text.encode('utf-8')
+
+
+def download_html(gsm, out_html, client=None):
+    html = fetch_html(gsm, client)
+    # a html left half written would be taken as downloaded in the next run
+    tmp_html = '{0}.tmp'.format(out_html)
+    with open(tmp_html, 'wb') as opf:
+        opf.write(html)
+    os.rename(tmp_html, out_html)
 
     
-def generate_csv(input_csv, outdir, num_threads):
-    # Sometimes GSM data could be private, so no species information will be
-    # extracted. e.g. GSE49366 GSM1198168
-    res, res_no_species = [], []
+class Journal(object):
+    """
+    an append-only record of the GSMs resolved, one line per GSM in the same
+    format as GSE_species_GSM.csv, so that an interrupted run can be resumed
+    without looking them up again
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.opf = open(path, 'ab')
+        # the last line left half written by an interrupted run
+        if self.opf.tell() > 0:
+            with open(path, 'rb') as inf:
+                inf.seek(-1, os.SEEK_END)
+                if inf.read() != '\n':
+                    self.opf.write('\n')
+        self.csv_writer = csv.writer(self.opf, lineterminator='\n')
+
+    def record(self, gse, species, gsm):
+        with self.lock:
+            self.csv_writer.writerow(
+                [gse, species.encode('utf-8') if species else '', gsm])
+            self.opf.flush()
+
+    def close(self):
+        with self.lock:
+            self.opf.close()
+
+
+def read_journal(path):
+    """:returns: a dict of {GSM: species} resolved as recorded in the journal"""
+    res = {}
+    if not os.path.exists(path):
+        return res
+    with open(path, 'rb') as inf:
+        for row in csv.reader(inf):
+            # skip those left half written
+            if len(row) == 3 and re.search(r'^GSM\d+$', row[2]):
+                res[row[2]] = row[1] or None
+    return res
+
+
+def generate_csv(input_csv, outdir, num_threads, rate=NCBI_RATE,
+                 backend='html', packed_cache=False):
+    """
+    :param rate: the maximum number of requests per second to NCBI shared by
+    all threads
+    :param backend: one of BACKENDS, with eutils or soft, the species of GSMs
+    are looked up in batches or soft files first, and only those not found
+    are scraped from their html pages
+    :param packed_cache: if True, the html pages are cached in a single
+    SQLite file under outdir instead of one file per GSM
+    """
+    gse_gsms = list(read(input_csv))
+    journal_file = os.path.join(outdir, GEN_CSV_JOURNAL_BASENAME)
+    journaled = read_journal(journal_file)
+    # {GSM: species}, sometimes GSM data could be private, so no species
+    # information will be extracted. e.g. GSE49366 GSM1198168
+    results = dict((gsm, journaled[gsm]) for _, gsm in gse_gsms
+                   if gsm in journaled)
+    if results:
+        logger.info('{0}/{1} GSMs already resolved in {2}'.format(
+            len(results), len(gse_gsms), journal_file))
+    todo = [_ for _ in gse_gsms if _[1] not in results]
+    errors = []
+
+    client = HTTPClient(rate, pool_size=num_threads)
+    cache = PackedCache(gen_cache_file(outdir)) if packed_cache else None
+    journal = Journal(journal_file)
+
+    def resolve(gse, gsm, species):
+        results[gsm] = species
+        journal.record(gse, species, gsm)
 
     # execute in parallel
     queue = Queue.Queue()
     def worker():
         while True:
             GSE, GSM = queue.get()
-            species = find_species(GSE, GSM, outdir)
-            row = [GSE, species, GSM]
-            if species:
-                res.append(row)
-            else:
-                res_no_species.append(row)
-            queue.task_done()
+            try:
+                resolve(GSE, GSM, find_species(GSE, GSM, outdir, client, cache))
+            except Exception, err:
+                # keep the thread alive, otherwise queue.join hangs forever
+                logger.exception('{0} {1}: {2}'.format(GSE, GSM, err))
+                errors.append((GSE, GSM, err))
+            finally:
+                queue.task_done()
 
     for i in range(num_threads):
         thrd = threading.Thread(target=worker)
         thrd.daemon = True
         thrd.start()
 
-    for gse, gsm in read(input_csv):
-        queue.put([gse, gsm])
+    found = {}
+    if backend == 'eutils' and todo:
+        found = eutils.find_species([_[1] for _ in todo], outdir, client)
+    elif backend == 'soft' and todo:
+        gses = sorted(set(_[0] for _ in todo))
+        found = find_species_in_softs(input_csv, gses, outdir, num_threads)
+    for gse, gsm in todo:
+        if gsm in found:
+            resolve(gse, gsm, found[gsm])
+        else:
+            queue.put([gse, gsm])
     queue.join()
+    client.close()
+    journal.close()
+    if cache is not None:
+        cache.close()
+
+    if errors:
+        # no partial csv, the GSMs resolved are kept in the journal, so
+        # rerunning only looks up the failed ones
+        raise RuntimeError('failed to find species for {0} GSMs: {1}'.format(
+            len(errors), ', '.join('{0} {1}'.format(*_[:2]) for _ in errors)))
+
+    res, res_no_species = [], []
+    for gse, gsm in gse_gsms:
+        species = results[gsm]
+        if species:
+            res.append([gse, species, gsm])
+        else:
+            res_no_species.append([gse, species, gsm])
 
     # write output
     out_csv = os.path.join(outdir, SPECIES_CSV_BASENAME)
@@ -124,6 +333,8 @@ def generate_csv(input_csv, outdir, num_threads):
     if res_no_species:
         backup_file(no_species_csv)
         write_csv(res_no_species, no_species_csv)
+    # all merged into the csvs
+    os.remove(journal_file)
 
 
 def main(options):
@@ -137,4 +348,5 @@ def main(options):
     input_csv = options.input_csv
     num_threads = options.nt
     outdir = gen_outdir(options)
-    generate_csv(input_csv, outdir, num_threads)
+    generate_csv(input_csv, outdir, num_threads, options.rate, options.backend,
+                 options.packed_cache)
@@ -6,16 +6,68 @@ where the input csv_file (e.g. GSE_GSM_species.csv) is located
 """
 
 import os
+import time
 import urlparse
-import gzip
+import zlib
+import threading
+import Queue
+import ftplib
 from ftplib import FTP
 import logging
 logger = logging.getLogger(__name__)
 
-from rsempipeline.preprocess.utils import read
-from rsempipeline.utils.misc import mkdir
+from rsempipeline.preprocess.utils import read, gen_outdir
+from rsempipeline.utils.misc import mkdir, pretty_usage
 from rsempipeline.conf.settings import SOFT_OUTDIR_BASENAME
-from rsempipeline.preprocess.gen_csv import gen_outdir
+
+FTP_DOMAIN = 'ftp.ncbi.nlm.nih.gov'
+# in seconds, for the control and data connections
+FTP_TIMEOUT = 60
+# per soft file
+MAX_RETRIES = 3
+# in seconds, doubled after each retry
+BACKOFF = 5
+# the lines of a soft file kept in soft.subset
+SOFT_SUBSET_PREFIXES = ('^SERIES',
+                        '^SAMPLE',
+                        '!Series_sample_id',
+                        '!Sample_organism_ch',
+                        '!Sample_supplementary_file_',
+                        '!Sample_type',
+                        '!Sample_library_strategy',
+                        '!Sample_instrument_model',
+                        '!Sample_library_source')
+
+
+class SOFTSubsetFilter(object):
+    """
+    gunzip a soft.gz fed in chunks as they are downloaded and write the lines
+    of interest to opf, i.e. soft.subset is generated in a single pass without
+    the soft.gz ever written to disk
+    """
+    def __init__(self, opf):
+        self.opf = opf
+        # 16 + MAX_WBITS: expect a gzip header and trailer
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # the last line decompressed so far, which may be incomplete
+        self.pending = ''
+
+    def feed(self, chunk):
+        self.filter(self.decompressor.decompress(chunk))
+
+    def close(self):
+        self.filter(self.decompressor.flush())
+        if self.pending.startswith(SOFT_SUBSET_PREFIXES):
+            self.opf.write(self.pending)
+        self.pending = ''
+
+    def filter(self, data):
+        lines = (self.pending + data).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            if line.startswith(SOFT_SUBSET_PREFIXES):
+                self.opf.write(line + '\n')
+
 
 class SOFTDownloader(object):
     """
@@ -23,11 +75,20 @@ class SOFTDownloader(object):
     file
     """
     def __init__(self):
-        domain = 'ftp.ncbi.nlm.nih.gov'
-        self.ftp_handler = FTP(domain)
+        domain = FTP_DOMAIN
+        self.ftp_handler = FTP(domain, timeout=FTP_TIMEOUT)
         self.ftp_handler.login()
         self.base = 'ftp://{0}'.format(domain)
-        
+        # the bytes downloaded over this connection
+        self.num_bytes = 0
+
+    def close(self):
+        try:
+            self.ftp_handler.quit()
+        except ftplib.all_errors:
+            # e.g. the connection is broken already
+            pass
+
     def gen_soft(self, gse, outdir):
         """
         @param gse: GSE ID, e.g. GSE45284
@@ -37,37 +98,51 @@ class SOFTDownloader(object):
         if os.path.exists(soft_subset):
             logger.info('{0} has already existed'.format(soft_subset))
         else:
-            soft_gz = self.download_soft_gz(gse, outdir)
-            if soft_gz:       # meaning downloading successful
-                self.gunzip_and_extract_soft(soft_gz, soft_subset)
-                logger.info('removing {0}'.format(soft_gz))
-                os.remove(soft_gz)
-                return soft_subset
-
-    def download_soft_gz(self, gse, outdir):
-        """download soft.gzip file"""
+            return self.download_soft_subset(gse, soft_subset)
+
+    def download_soft_subset(self, gse, soft_subset):
+        """download soft.gz and extract soft.subset from it on the fly"""
         remote_path = self.get_remote_path(gse)
         soft_gz = self.get_soft_gz_basename(gse)
-        local_soft_gz = os.path.join(outdir, soft_gz)
         url = self.get_url(gse) # for logging purpose only
         # e.g. ftp://ftp.ncbi.nlm.nih.gov/geo/series/GSE45nnn/GSE45284/soft/GSE45284_family.soft.gz
-        logger.info('downloading {0} from {1} to '
-                    '{2}'.format(soft_gz, url, local_soft_gz))
+        logger.info('downloading {0} from {1} and extracting to '
+                    '{2}'.format(soft_gz, url, soft_subset))
+        # a soft.subset left half written would be taken as done in the next
+        # run or retry
+        tmp_subset = '{0}.tmp'.format(soft_subset)
         try:
-            self.retrieve(remote_path, soft_gz, local_soft_gz)
-            return local_soft_gz
+            self.retrieve(remote_path, soft_gz, tmp_subset)
+            os.rename(tmp_subset, soft_subset)
+            return soft_subset
         except Exception:
-            logger.exception('error when downloading {0}'.format(url))            
+            logger.exception('error when downloading {0}'.format(url))
+            if os.path.exists(tmp_subset):
+                os.remove(tmp_subset)
 
     def retrieve(self, path, filename, out):
+        """retrieve filename, a soft.gz, and write its subset to out"""
         self.ftp_handler.cwd(path)
+        num_bytes = [0]
         with open(out, 'wb') as opf:
+            subset_filter = SOFTSubsetFilter(opf)
+            def write(chunk):
+                subset_filter.feed(chunk)
+                num_bytes[0] += len(chunk)
+                self.num_bytes += len(chunk)
             cmd = 'RETR {0}'.format(filename)
-            self.ftp_handler.retrbinary(cmd, opf.write)
+            self.ftp_handler.retrbinary(cmd, write)
+            subset_filter.close()
+        # unlike gzip.open, the decompressor doesn't complain about a truncated
+        # soft.gz, so check the size instead, in binary mode after RETR
+        size = self.ftp_handler.size(filename)
+        if size is not None and size != num_bytes[0]:
+            raise IOError('{0}: {1} bytes received out of {2}'.format(
+                filename, num_bytes[0], size))
 
     def get_soft_subset(self, gse, outdir):
         """soft.subset with path"""
-        return os.path.join(outdir, '{0}_family.soft.subset'.format(gse))
+        return get_soft_subset(gse, outdir)
 
     def get_soft_gz_basename(self, gse):
         return '{0}_family.soft.gz'.format(gse)
@@ -84,23 +159,10 @@ class SOFTDownloader(object):
         soft_gz = self.get_soft_gz_basename(gse)
         return urlparse.urljoin(self.base, os.path.join(path, soft_gz))
 
-    def gunzip_and_extract_soft(self, soft_gz, soft_subset):
-        """gunzip soft.gzip and extract its content to generate soft.subset"""
-        logger.info('gunziping and extracting from '
-                    '{0} to {1}'.format(soft_gz, soft_subset))
-        with open(soft_subset, 'wb') as opf:
-            with gzip.open(soft_gz, 'rb') as inf:
-                for line in inf:
-                    if (line.startswith('^SERIES') or
-                        line.startswith('^SAMPLE') or
-                        line.startswith('!Series_sample_id') or
-                        line.startswith('!Sample_organism_ch') or
-                        line.startswith('!Sample_supplementary_file_') or
-                        line.startswith('!Sample_type') or
-                        line.startswith('!Sample_library_strategy') or
-                        line.startswith('!Sample_instrument_model') or
-                        line.startswith('!Sample_library_source')):
-                        opf.write(line)
+
+def get_soft_subset(gse, outdir):
+    return os.path.join(outdir, '{0}_family.soft.subset'.format(gse))
+
 
 def gen_soft_outdir(outdir):
     d = os.path.join(outdir, SOFT_OUTDIR_BASENAME)
@@ -108,13 +170,121 @@ def gen_soft_outdir(outdir):
     return d
 
 
-def download_soft(input_csv, soft_outdir): # pragma: no cover
-    ftp = SOFTDownloader()
-    current_gse = None
+class Progress(object):
+    """the progress and throughput of downloading soft files shared by threads"""
+    def __init__(self, total):
+        self.total = total
+        self.num_done = 0
+        self.failed = []
+        self.num_bytes = 0
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, gse, succeeded, num_bytes):
+        with self.lock:
+            self.num_done += 1
+            self.num_bytes += num_bytes
+            if not succeeded:
+                self.failed.append(gse)
+            logger.info('[{0}/{1}] {2} {3}, {4}'.format(
+                self.num_done, self.total, gse,
+                'done' if succeeded else 'failed', self.format_throughput()))
+
+    def format_throughput(self):
+        seconds = max(time.time() - self.started_at, 1e-6)
+        return '{0} downloaded in {1:.0f}s at {2}/s'.format(
+            pretty_usage(self.num_bytes), seconds,
+            pretty_usage(self.num_bytes / seconds))
+
+    def log_summary(self):
+        logger.info('{0}/{1} soft files downloaded, {2}'.format(
+            self.num_done - len(self.failed), self.total,
+            self.format_throughput()))
+        if self.failed:
+            logger.error('failed to download soft files of {0} GSEs: {1}'.format(
+                len(self.failed), ', '.join(self.failed)))
+
+
+def download_softs(gses, soft_outdir, num_workers=1, max_retries=MAX_RETRIES):
+    """
+    download the soft files of gses over a pool of num_workers FTP
+    connections concurrently, each soft file is retried up to max_retries
+    times over a new connection
+
+    :returns: a list of the GSEs failed
+    """
+    queue = Queue.Queue()
+    for _ in gses:
+        queue.put(_)
+    progress = Progress(len(gses))
+
+    def download(der, gse):
+        """:returns: the downloader to use next, None if it's closed"""
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                delay = BACKOFF * 2 ** (attempt - 1)
+                logger.warning('retrying {0} in {1}s ({2}/{3})'.format(
+                    gse, delay, attempt, max_retries))
+                time.sleep(delay)
+            num_bytes = 0
+            try:
+                if der is None:
+                    der = SOFTDownloader()
+                before = der.num_bytes
+                succeeded = der.gen_soft(gse, soft_outdir) is not None
+                num_bytes = der.num_bytes - before
+            except Exception, err:
+                logger.exception('{0}: {1}'.format(gse, err))
+                succeeded = False
+            if succeeded:
+                progress.update(gse, True, num_bytes)
+                return der
+            # the connection may be broken, start over with a new one
+            if der is not None:
+                der.close()
+                der = None
+        progress.update(gse, False, 0)
+        return der
+
+    def worker():
+        der = None
+        try:
+            while True:
+                try:
+                    gse = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                der = download(der, gse)
+        finally:
+            if der is not None:
+                der.close()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(num_workers, len(gses)))]
+    for thrd in threads:
+        thrd.start()
+    for thrd in threads:
+        thrd.join()
+    progress.log_summary()
+    return progress.failed
+
+
+def download_soft(input_csv, soft_outdir, num_workers=1,
+                  max_retries=MAX_RETRIES):
+    """
+    download the soft files of the GSEs in input_csv unless they exist
+
+    :returns: a list of the GSEs failed
+    """
+    gses = []
     for gse, gsm in read(input_csv):
-        if current_gse is None or gse != current_gse:
-            ftp.gen_soft(gse, soft_outdir)
-            current_gse = gse
+        if gse not in gses:
+            gses.append(gse)
+    todo = [_ for _ in gses if not os.path.exists(get_soft_subset(_, soft_outdir))]
+    logger.info('{0}/{1} soft files to download'.format(len(todo), len(gses)))
+    if not todo:
+        return []
+    return download_softs(todo, soft_outdir, num_workers, max_retries)
 
 
 def main(options):
@@ -124,7 +294,7 @@ def main(options):
     input_csv = options.input_csv
     outdir = gen_outdir(options)
     soft_outdir = gen_soft_outdir(outdir)
-    download_soft(input_csv, soft_outdir)
+    download_soft(input_csv, soft_outdir, options.nt, options.retries)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*
+
+"""
+A packed cache (SQLite) of the html pages of GSMs and the species found in
+them, as an alternative to one html/<GSE>/<GSM>.html (and .species) file per
+GSM, which are millions of small files at scale, hard on NFS metadata and
+backups. The html is compressed with zlib, and the cache can be imported
+from or exported to the directory layout, e.g.
+
+rp-prep html-cache import --outdir dir_containing_html
+"""
+
+import os
+import time
+import zlib
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from rsempipeline.utils.misc import mkdir
+from rsempipeline.conf.settings import (HTML_OUTDIR_BASENAME,
+                                        HTML_CACHE_BASENAME)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    gsm TEXT PRIMARY KEY,       -- e.g. GSMxxxxxxx
+    gse TEXT NOT NULL,          -- e.g. GSExxxxx
+    html BLOB,                  -- compressed with zlib
+    species TEXT,
+    resolved INTEGER NOT NULL DEFAULT 0, -- whether species has been looked for
+    updated_at REAL
+);
+"""
+
+
+class PackedCache(object):
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # shared by the threads of gen-csv, so access is serialized with the
+        # lock
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_html(self, gsm):
+        """:returns: the html of gsm, None if not cached"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT html FROM pages WHERE gsm = ?', (gsm,)).fetchone()
+        if row is None or row['html'] is None:
+            return None
+        return zlib.decompress(row['html'])
+
+    def put_html(self, gse, gsm, html):
+        blob = sqlite3.Binary(zlib.compress(html))
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO pages (gsm, gse) VALUES (?, ?)',
+                (gsm, gse))
+            self.conn.execute(
+                'UPDATE pages SET html = ?, updated_at = ? WHERE gsm = ?',
+                (blob, time.time(), gsm))
+
+    def get_species(self, gsm):
+        """
+        :returns: (resolved, species), species is None when it's not resolved
+        yet or not found in the html (e.g. private GSMs)
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT species, resolved FROM pages WHERE gsm = ?',
+                (gsm,)).fetchone()
+        if row is None:
+            return False, None
+        return bool(row['resolved']), row['species']
+
+    def put_species(self, gse, gsm, species):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO pages (gsm, gse) VALUES (?, ?)',
+                (gsm, gse))
+            self.conn.execute(
+                'UPDATE pages SET species = ?, resolved = 1, updated_at = ? '
+                'WHERE gsm = ?', (species, time.time(), gsm))
+
+    def import_dir(self, html_dir):
+        """
+        import html_dir/<GSE>/<GSM>.html and <GSM>.species as written by
+        gen-csv without the packed cache
+
+        :returns: the number of GSMs imported
+        """
+        num = 0
+        for gse in sorted(os.listdir(html_dir)):
+            gse_dir = os.path.join(html_dir, gse)
+            if not os.path.isdir(gse_dir):
+                continue
+            for basename in sorted(os.listdir(gse_dir)):
+                gsm, ext = os.path.splitext(basename)
+                path = os.path.join(gse_dir, basename)
+                if ext == '.html':
+                    with open(path, 'rb') as inf:
+                        self.put_html(gse, gsm, inf.read())
+                    num += 1
+                elif ext == '.species':
+                    with open(path, 'rb') as inf:
+                        self.put_species(
+                            gse, gsm, inf.read().strip().decode('utf-8') or None)
+        logger.info('imported {0} GSMs from {1} into {2}'.format(
+            num, html_dir, self.db_file))
+        return num
+
+    def export_dir(self, html_dir):
+        """
+        the reverse of import_dir
+
+        :returns: the number of GSMs exported
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT gsm, gse, html, species, resolved FROM pages '
+                'ORDER BY gse, gsm').fetchall()
+        mkdir(html_dir)
+        num = 0
+        for row in rows:
+            gse_dir = os.path.join(html_dir, row['gse'])
+            mkdir(gse_dir)
+            if row['html'] is not None:
+                path = os.path.join(gse_dir, '{0}.html'.format(row['gsm']))
+                with open(path, 'wb') as opf:
+                    opf.write(zlib.decompress(row['html']))
+                num += 1
+            if row['resolved']:
+                path = os.path.join(gse_dir, '{0}.species'.format(row['gsm']))
+                with open(path, 'wb') as opf:
+                    opf.write(row['species'].encode('utf-8')
+                              if row['species'] else '')
+        logger.info('exported {0} GSMs from {1} to {2}'.format(
+            num, self.db_file, html_dir))
+        return num
+
+
+def gen_cache_file(outdir):
+    return os.path.join(outdir, HTML_CACHE_BASENAME)
+
+
+def main(options):
+    """import or export the html dir under options.outdir"""
+    html_dir = os.path.join(options.outdir, HTML_OUTDIR_BASENAME)
+    cache = PackedCache(gen_cache_file(options.outdir))
+    try:
+        if options.action == 'import':
+            cache.import_dir(html_dir)
+        else:
+            cache.export_dir(html_dir)
+    finally:
+        cache.close()
@@ -5,8 +5,9 @@ import os
 import argparse
 import logging.config
 
-from rsempipeline.conf.settings import SHARE_DIR, RP_PREP_LOGGING_CONFIG
-from rsempipeline.preprocess import gen_csv, get_soft
+from rsempipeline.conf.settings import (SHARE_DIR, RP_PREP_LOGGING_CONFIG,
+                                        HTML_CACHE_BASENAME)
+from rsempipeline.preprocess import gen_csv, get_soft, packed_cache
 
 logging.config.fileConfig(RP_PREP_LOGGING_CONFIG)
 
@@ -41,15 +42,48 @@ def get_parser():
     sp_gen_csv.add_argument(
         '--nt', type=int, default=1,
         help='number of threads')
+    sp_gen_csv.add_argument(
+        '--rate', type=float, default=gen_csv.NCBI_RATE,
+        help=('maximum number of requests per second to NCBI shared by all '
+              'threads, default: {0}'.format(gen_csv.NCBI_RATE)))
+    sp_gen_csv.add_argument(
+        '--backend', choices=gen_csv.BACKENDS, default='html',
+        help=('where to look up species, eutils: in batches of GSMs with '
+              'E-utilities esummary; soft: in the soft files of GSEs, '
+              'downloaded as by get-soft unless they exist already. Both '
+              'fall back to the html page of the GSMs not found. '
+              'default: html'))
+    sp_gen_csv.add_argument(
+        '--packed_cache', action='store_true',
+        help=('cache the htmls in a single SQLite file ({0}) under the '
+              'output directory instead of one file per GSM'.format(
+                  HTML_CACHE_BASENAME)))
     sp_gen_csv.add_argument(
         '--outdir', type=str,
         help=('output directory, default to the location of '
               '{0}.'.format(INPUT_FILE)))
     sp_gen_csv.set_defaults(func=gen_csv.main)
 
+    sp_html_cache = subparsers.add_parser(
+        'html-cache',
+        help=('Import the htmls downloaded by gen-csv into the packed cache, '
+              'or export them from it'))
+    sp_html_cache.add_argument('action', choices=['import', 'export'])
+    sp_html_cache.add_argument(
+        '--outdir', type=str, required=True,
+        help='the output directory of gen-csv')
+    sp_html_cache.set_defaults(func=packed_cache.main)
+
     sp_get_soft = subparsers.add_parser(
         'get-soft', parents=[dummy_parser],
         help='Download soft files for all GSEs')
+    sp_get_soft.add_argument(
+        '--nt', type=int, default=1,
+        help='number of soft files downloaded concurrently, one FTP connection each')
+    sp_get_soft.add_argument(
+        '--retries', type=int, default=get_soft.MAX_RETRIES,
+        help=('number of times a soft file is retried over a new connection '
+              'when failed, default: {0}'.format(get_soft.MAX_RETRIES)))
     sp_get_soft.add_argument(
         '--outdir', type=str,
         help=('directory for downloaded htmls, default to '
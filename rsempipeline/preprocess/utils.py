@@ -5,6 +5,7 @@ import csv
 import logging
 logger = logging.getLogger(__name__)
 
+from rsempipeline.utils.misc import mkdir
 from rsempipeline.conf.settings import SHARE_DIR
 
     
@@ -86,3 +87,28 @@ def process(k, row):
                        "are unique".format(gse, num_gsms, num_unique_gsms))
         return
     return gse, gsms
+
+
+def join_species(names):
+    """
+    the species of a GSM as written to GSE_species_GSM.csv by any backend of
+    gen-csv, multiple organisms (e.g. of a mixed sample or both channels) are
+    sorted and separated by "; ", e.g. Homo sapiens; Mus musculus
+
+    :returns: None if names is empty
+    """
+    names = sorted(set(_.strip() for _ in names if _.strip()))
+    return '; '.join(names) or None
+
+
+def gen_outdir(options):
+    """
+    the directory where the outputs of rp-prep go, default to the directory
+    where the input csv is located
+    """
+    if options.outdir:
+        d = options.outdir
+        mkdir(d)
+    else:
+        d = os.path.dirname(options.input_csv)
+    return d
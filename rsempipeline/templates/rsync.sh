@@ -16,8 +16,15 @@ dest_parent={{username}}@{{hostname}}:{{remote_top_outdir}}
 echo "Job started at: $(date)"
 echo "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
 
+{% if files_from %}
+# the exact files to transfer (fastq.gz and 0_submit.sh) are listed in
+# files_from, which implies -R to create the same directory hierachy on remote
+# host, and no directory is traversed
+cmd="rsync -a -v -h --stats --progress {% if bwlimit %}--bwlimit={{bwlimit}} {% endif %}--files-from={{files_from}} . $dest_parent"
+{% else %}
 # -R is important for creating the same directory hierachy on remote host
-cmd="rsync -R -r -a -v -h --stats --progress $GSMS_TO_TRANSFER $dest_parent --include='*.fastq.gz' --include='0_submit.sh' --exclude='GSM*[0-9]/*'"
+cmd="rsync -R -r -a -v -h --stats --progress {% if bwlimit %}--bwlimit={{bwlimit}} {% endif %}$GSMS_TO_TRANSFER $dest_parent --include='*.fastq.gz' --include='0_submit.sh' --exclude='GSM*[0-9]/*'"
+{% endif %}
 echo "$cmd"
 eval "$cmd"
 
@@ -25,6 +32,36 @@ eval "$cmd"
 RSYNC_RC=$?
 echo "rsync returncode: $RSYNC_RC"
 
+{% if submit_scripts %}
+# script:gsm_id,gsm_id,... the GSMs covered by each script to submit
+SUBMIT_JOBS="\
+{% for script in submit_scripts %}{{script}}:{{submit_gsms[loop.index0]|join(',')}}{% if not loop.last %} \
+{% endif %}{% endfor %}"
+
+if [ "$RSYNC_RC" -eq 0 ]; then
+{% if extra_files %}
+    # e.g. manifest, array or bundle job scripts, which are under the same
+    # relative path on remote host
+    rsync -R -a -v {{extra_files|join(' ')}} $dest_parent
+{% endif %}
+    echo 'do submission'
+    # the job id of each GSM is recorded as "submitted: gsm_id qsub_output"
+    ssh -l {{username}} {{hostname}} \
+	". ~/.bash_profile; submit_jobs=\"${SUBMIT_JOBS}\"; cd {{remote_top_outdir}};" \
+	'
+        pwd=${PWD}
+        for job in ${submit_jobs}; do
+            script=${job%%:*}
+	    cd $(dirname ${script})
+            output=$(qsub $(basename ${script}))
+            cd ${pwd}
+            for gsm in $(echo ${job#*:} | tr , " "); do
+                echo "submitted: ${gsm} ${output}"
+            done
+        done
+        '{% if job_ids_file %} | tee -a {{job_ids_file}}{% endif %}
+fi
+{% else %}
 if [ "$RSYNC_RC" -eq 0 ]; then
     echo 'do submission'
     ssh -l {{username}} {{hostname}} \
@@ -33,11 +70,12 @@ if [ "$RSYNC_RC" -eq 0 ]; then
         pwd=${PWD}
         for gsm in ${gsms_to_transfer}; do
 	    cd ${gsm}
-            qsub 0_submit.sh
+            echo "submitted: ${gsm} $(qsub 0_submit.sh)"
             cd ${pwd}
         done
-        '
+        '{% if job_ids_file %} | tee -a {{job_ids_file}}{% endif %}
 fi
+{% endif %}
 
 # remove fastq.gz files after transfer to save spaces
 if [ "$RSYNC_RC" -eq 0 ]; then
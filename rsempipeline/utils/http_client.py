@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*
+
+"""
+A pooled HTTP client shared by threads, for fetching pages and records of
+tens of thousands of GSMs from NCBI. Connections are kept alive and reused,
+requests are throttled by a token bucket to stay within NCBI's limit (3
+requests per second without an API key, 10 with one), and transient errors
+(connection errors, timeouts, 429 and 5xx) are retried with exponential
+backoff.
+"""
+
+import time
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# requests per second allowed by NCBI without an API key
+NCBI_RATE = 3
+# in seconds
+TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF = 1
+# the status codes worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """allow rate acquisitions per second on average, bursts of up to burst"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HTTPClient(object):
+    def __init__(self, rate=NCBI_RATE, burst=1, pool_size=10, timeout=TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF):
+        """
+        :param rate: requests per second
+        :param pool_size: the number of connections kept alive per host,
+        should be no less than the number of threads sharing the client
+        :param backoff: in seconds, doubled after each retry
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        """
+        :returns: the response
+        :raises: requests.RequestException when it still fails after
+        max_retries
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response
+                err = requests.HTTPError(
+                    '{0} for {1}'.format(response.status_code, url),
+                    response=response)
+                delay = get_retry_after(response)
+            except (requests.ConnectionError, requests.Timeout), err:
+                delay = None
+            if attempt == self.max_retries:
+                raise err
+            if delay is None:
+                delay = self.backoff * 2 ** attempt
+            logger.warning('{0}, retrying in {1}s ({2}/{3})'.format(
+                err, delay, attempt + 1, self.max_retries))
+            time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+def get_retry_after(response):
+    """:returns: the Retry-After header in seconds, None if not given"""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
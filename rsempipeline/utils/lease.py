@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*
+
+"""
+Per-GSM leases, so that several rp-run processes, on one host or several
+hosts sharing the top outdir over NFS, work on disjoint GSMs concurrently
+instead of a single rp-run blocking all the others.
+
+A lease is a file in the GSM directory created with O_CREAT | O_EXCL, which
+is atomic on local filesystems and NFSv3+. Its holder renews it (touches it)
+every heartbeat. A lease that hasn't been renewed within the ttl, or whose
+holder process is gone on the same host, is stale, and is broken by renaming
+it away. The lease renamed away is checked to be the stale one seen before,
+as another contender may have broken it and created a fresh one in between,
+in which case it's put back. e.g. content of a lease file:
+
+host: node1
+pid: 12345
+acquired_at: 1437148000.0
+"""
+
+import os
+import time
+import socket
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+import yaml
+
+
+def get_holder():
+    return {'host': socket.gethostname(), 'pid': os.getpid()}
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        # EPERM: alive, but owned by someone else
+        return err.errno == 1
+    return True
+
+
+class Lease(object):
+    def __init__(self, path, ttl):
+        """
+        :param ttl: in seconds, after which a lease that isn't renewed is
+        considered stale. The mtime of the lease file is compared with the
+        local clock, so ttl should be well above the clock skew among hosts
+        """
+        self.path = path
+        self.ttl = ttl
+        self.held = False
+
+    def read(self, path=None):
+        """:returns: the holder of the lease, None if not leased"""
+        path = self.path if path is None else path
+        try:
+            with open(path) as inf:
+                holder = yaml.safe_load(inf)
+            holder['renewed_at'] = os.path.getmtime(path)
+            return holder
+        except (IOError, OSError, TypeError, yaml.YAMLError):
+            # gone, or half written by a holder that is creating it
+            return None
+
+    def is_stale(self, holder):
+        if time.time() - holder['renewed_at'] > self.ttl:
+            return True
+        if holder.get('host') == socket.gethostname():
+            return not is_alive(holder['pid'])
+        return False
+
+    def acquire(self):
+        """:returns: True if acquired"""
+        if self._create():
+            return True
+        holder = self.read()
+        if holder is None or not self.is_stale(holder):
+            return False
+        broken = '{0}.stale.{1}.{2}'.format(
+            self.path, socket.gethostname(), os.getpid())
+        try:
+            os.rename(self.path, broken)
+        except OSError:
+            return False
+        if not self.is_same(self.read(broken), holder):
+            # another contender broke the stale lease and created a fresh one
+            # after it was read, which is live, so hand it back
+            self._put_back(broken)
+            return False
+        logger.warning('broke stale lease {0} of {1}:{2}'.format(
+            self.path, holder.get('host'), holder.get('pid')))
+        os.remove(broken)
+        return self._create()
+
+    @staticmethod
+    def is_same(holder1, holder2):
+        """
+        :returns: True if both are the same lease not renewed in between
+        """
+        keys = ['host', 'pid', 'acquired_at', 'renewed_at']
+        return (holder1 is not None and holder2 is not None and
+                all(holder1.get(_) == holder2.get(_) for _ in keys))
+
+    def _put_back(self, broken):
+        try:
+            # unlike rename, link fails if the path has been taken again
+            os.link(broken, self.path)
+        except OSError, err:
+            logger.error('failed to put back lease {0}: {1}'.format(self.path, err))
+        os.remove(broken)
+
+    def _create(self):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError:
+            return False
+        holder = dict(get_holder(), acquired_at=round(time.time(), 2))
+        try:
+            os.write(fd, yaml.safe_dump(holder, default_flow_style=False))
+        finally:
+            os.close(fd)
+        self.held = True
+        return True
+
+    def renew(self):
+        if self.held:
+            try:
+                os.utime(self.path, None)
+            except OSError, err:
+                # e.g. broken by others after this host was suspended
+                logger.error('failed to renew lease {0}: {1}'.format(self.path, err))
+
+    def release(self):
+        if self.held:
+            try:
+                os.remove(self.path)
+            except OSError, err:
+                logger.warning('failed to release lease {0}: {1}'.format(self.path, err))
+            self.held = False
+
+
+class LeaseKeeper(object):
+    """
+    hold leases for the lifetime of a run and renew them in a background
+    thread every heartbeat seconds
+    """
+    def __init__(self, ttl, heartbeat):
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.leases = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def is_held_by_others(self, path):
+        """
+        :returns: True if path is leased by a live holder other than this
+        keeper, which could change any time, so it's only for skipping work
+        early, use acquire to lease
+        """
+        if self.holds(path):
+            return False
+        lease = Lease(path, self.ttl)
+        holder = lease.read()
+        return holder is not None and not lease.is_stale(holder)
+
+    def acquire(self, path):
+        lease = Lease(path, self.ttl)
+        if lease.acquire():
+            self.leases.append(lease)
+            return True
+        return False
+
+    def holds(self, path):
+        return any(_.path == path for _ in self.leases)
+
+    def release(self, path):
+        for lease in self.leases:
+            if lease.path == path:
+                lease.release()
+                self.leases.remove(lease)
+                return
+
+    def _beat(self):
+        while not self._stopped.wait(self.heartbeat):
+            for lease in self.leases:
+                lease.renew()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._beat)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def release_all(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        for lease in self.leases:
+            lease.release()
+        self.leases = []
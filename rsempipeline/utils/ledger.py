@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*
+
+"""
+A ledger (SQLite) recording the lifecycle of each GSM after it's processed
+locally, i.e. selected for transfer => rsync started => transferred =>
+submitted => completed remotely => results fetched => local cleanup done,
+with a timestamp per stage, which replaces transferred_GSMs.txt. A GSM whose
+job left the queue without rsem.COMPLETE is failed instead of completed
+"""
+
+import os
+import re
+import time
+import datetime
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from rsempipeline.utils.misc import pretty_usage
+
+SELECTED = 'selected'
+RSYNC_STARTED = 'rsync_started'
+TRANSFERRED = 'transferred'
+SUBMITTED = 'submitted'
+COMPLETED = 'completed'
+FETCHED = 'fetched'
+CLEANED = 'cleaned'
+FAILED = 'failed'
+
+# in the order of the lifecycle
+LIFECYCLE = (SELECTED, RSYNC_STARTED, TRANSFERRED, SUBMITTED, COMPLETED,
+             FETCHED, CLEANED)
+STAGES = LIFECYCLE + (FAILED,)
+
+# the rank of a stage, which never goes backwards. FAILED ranks the same as
+# SUBMITTED, so a failed GSM can still be recorded as submitted again or
+# completed
+RANKS = dict((_, k) for k, _ in enumerate(LIFECYCLE))
+RANKS[FAILED] = RANKS[SUBMITTED]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gsms (
+    gsm_id TEXT PRIMARY KEY,    -- e.g. rsem_output/GSExxxxx/homo_sapiens/GSMxxxxxxx
+    gsm TEXT NOT NULL,          -- e.g. GSMxxxxxxx
+    stage TEXT NOT NULL,        -- the latest stage reached
+    job_id TEXT,
+    target TEXT,                -- the name of the remote cluster placed on
+    bytes INTEGER,              -- the size of files transferred
+{0}
+);
+CREATE INDEX IF NOT EXISTS gsms_gsm ON gsms (gsm);
+CREATE INDEX IF NOT EXISTS gsms_stage ON gsms (stage);
+""".format(',\n'.join('    {0}_at REAL'.format(_) for _ in STAGES))
+
+
+class Ledger(object):
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # shared by the threads transferring GSMs in parallel, so access is
+        # serialized with the lock
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+            # ledgers created before multiple targets were supported
+            columns = [_['name'] for _ in
+                       self.conn.execute('PRAGMA table_info(gsms)')]
+            if 'target' not in columns:
+                self.conn.execute('ALTER TABLE gsms ADD COLUMN target TEXT')
+            # and before stages were added, e.g. failed
+            for stage in STAGES:
+                if '{0}_at'.format(stage) not in columns:
+                    self.conn.execute(
+                        'ALTER TABLE gsms ADD COLUMN {0}_at REAL'.format(stage))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def record(self, gsm_ids, stage, when=None, bytes_=None, job_id=None,
+               target=None):
+        """
+        record that gsm_ids have reached stage in a single transaction, the
+        stage of a GSM never goes backwards
+
+        :param when: unix timestamp, default to now
+        :param bytes_: a dict of {gsm_id: bytes}
+        :param job_id: a dict of {gsm_id: job_id}
+        :param target: the name of the remote cluster gsm_ids are placed on
+        """
+        if stage not in STAGES:
+            raise ValueError('unknown stage: {0}'.format(stage))
+        when = time.time() if when is None else when
+        bytes_ = bytes_ or {}
+        job_id = job_id or {}
+        rank = RANKS[stage]
+        with self.lock, self.conn:
+            for gsm_id in gsm_ids:
+                self.conn.execute(
+                    'INSERT OR IGNORE INTO gsms (gsm_id, gsm, stage) '
+                    'VALUES (?, ?, ?)',
+                    (gsm_id, os.path.basename(gsm_id), stage))
+                row = self.conn.execute(
+                    'SELECT stage FROM gsms WHERE gsm_id = ?',
+                    (gsm_id,)).fetchone()
+                if RANKS[row['stage']] > rank:
+                    new_stage = row['stage']
+                else:
+                    new_stage = stage
+                self.conn.execute(
+                    'UPDATE gsms SET stage = ?, {0}_at = ?, '
+                    'bytes = COALESCE(?, bytes), '
+                    'job_id = COALESCE(?, job_id), '
+                    'target = COALESCE(?, target) '
+                    'WHERE gsm_id = ?'.format(stage),
+                    (new_stage, when, bytes_.get(gsm_id), job_id.get(gsm_id),
+                     target, gsm_id))
+
+    def get_gsms(self, stage):
+        """:returns: a set of GSMs (e.g. GSMxxxxxxx) that have reached stage"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT gsm FROM gsms WHERE {0}_at IS NOT NULL'.format(stage))
+            return set(_['gsm'] for _ in rows)
+
+    def get_gsm_ids(self, stage, target=None):
+        """
+        :returns: a list of gsm_ids whose latest stage is exactly stage, e.g.
+        those submitted but not completed yet, on target if specified
+        """
+        sql, params = 'SELECT gsm_id FROM gsms WHERE stage = ?', [stage]
+        if target is not None:
+            sql += ' AND target = ?'
+            params.append(target)
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY gsm_id', params)
+            return [_['gsm_id'] for _ in rows]
+
+    def set_default_target(self, target):
+        """
+        assign the GSMs recorded without a target, e.g. before multiple targets
+        were configured, to target
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE gsms SET target = ? WHERE target IS NULL', (target,))
+
+    def get(self, gsm_id):
+        """:returns: the row of gsm_id as a dict, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT * FROM gsms WHERE gsm_id = ?', (gsm_id,)).fetchone()
+        return dict(zip(row.keys(), row)) if row is not None else None
+
+    def count_by_stage(self):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT stage, COUNT(*) AS num FROM gsms GROUP BY stage')
+            return dict((_['stage'], _['num']) for _ in rows)
+
+    def get_latencies(self, from_stage, to_stage):
+        """:returns: a list of (gsm_id, seconds, bytes) between two stages"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT gsm_id, {1}_at - {0}_at AS seconds, bytes FROM gsms '
+                'WHERE {0}_at IS NOT NULL AND {1}_at IS NOT NULL '
+                'ORDER BY gsm_id'.format(from_stage, to_stage))
+            return [(_['gsm_id'], _['seconds'], _['bytes']) for _ in rows]
+
+    def get_throughput(self, target=None):
+        """
+        :returns: the observed rsync throughput in byte/s, to target if
+        specified, None if nothing has been transferred yet
+        """
+        # the GSMs transferred by one rsync (a batch) share rsync_started_at,
+        # so the duration of a batch is counted once rather than per GSM
+        sql = ('SELECT SUM(bytes) AS bytes, '
+               'MAX(transferred_at) - rsync_started_at AS seconds FROM gsms '
+               'WHERE bytes > 0 AND transferred_at > rsync_started_at')
+        params = []
+        if target is not None:
+            sql += ' AND target = ?'
+            params.append(target)
+        sql += ' GROUP BY target, rsync_started_at'
+        sql = ('SELECT SUM(bytes) AS bytes, SUM(seconds) AS seconds '
+               'FROM ({0})'.format(sql))
+        with self.lock:
+            row = self.conn.execute(sql, params).fetchone()
+        if not row['seconds']:
+            return None
+        return row['bytes'] / float(row['seconds'])
+
+    def log_summary(self):
+        counts = self.count_by_stage()
+        logger.info('GSMs per stage: {0}'.format(', '.join(
+            '{0}: {1}'.format(_, counts.get(_, 0)) for _ in STAGES)))
+        if counts.get(FAILED):
+            logger.warning('{0} GSMs failed remotely without rsem.COMPLETE, '
+                           'please check'.format(counts[FAILED]))
+        for from_stage, to_stage in zip(LIFECYCLE[:-1], LIFECYCLE[1:]):
+            latencies = self.get_latencies(from_stage, to_stage)
+            if not latencies:
+                continue
+            seconds = sorted(_[1] for _ in latencies)
+            logger.info('{0} => {1}: {2} GSMs, median latency: {3:.0f}s'.format(
+                from_stage, to_stage, len(seconds), seconds[len(seconds) // 2]))
+        throughput = self.get_throughput()
+        if throughput:
+            logger.info('rsync throughput: {0}/s'.format(
+                pretty_usage(throughput)))
+
+    def import_record_file(self, record_file):
+        """
+        import the GSMs recorded in a transferred_GSMs.txt as transferred,
+        with the time as recorded in the comment line preceding them
+
+        :returns: the number of GSMs imported
+        """
+        records = parse_record_file(record_file)
+        with_time, without_time = {}, []
+        for gsm_id, when in records:
+            if when is None:
+                without_time.append(gsm_id)
+            else:
+                with_time.setdefault(when, []).append(gsm_id)
+        for when, gsm_ids in sorted(with_time.items()):
+            self.record(gsm_ids, TRANSFERRED, when)
+        if without_time:
+            self.record(without_time, TRANSFERRED, os.path.getmtime(record_file))
+        logger.info('imported {0} GSMs from {1} into {2}'.format(
+            len(records), record_file, self.db_file))
+        return len(records)
+
+
+def parse_record_file(record_file):
+    """
+    parse transferred_GSMs.txt as written by rp-transfer before the ledger,
+    e.g.
+
+    # 15-01-01 01:01:01
+    rsem_output/GSE34736/homo_sapiens/GSM854343
+    rsem_output/GSE34736/homo_sapiens/GSM854344
+
+    :returns: a list of (gsm_id, unix timestamp or None)
+    """
+    records, when = [], None
+    with open(record_file) as inf:
+        for line in inf:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                match = re.search(r'^#\s*(\d{2}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})', line)
+                if match:
+                    dt = datetime.datetime.strptime(match.group(1), '%y-%m-%d %H:%M:%S')
+                    when = time.mktime(dt.timetuple())
+                continue
+            records.append((line, when))
+    return records
+
+
+def open_ledger(db_file, record_file=None):
+    """
+    open the ledger, when it's created for the first time, the GSMs in the
+    legacy record_file (transferred_GSMs.txt) are imported if it exists
+    """
+    is_new = not os.path.exists(db_file)
+    ledger = Ledger(db_file)
+    if is_new and record_file is not None and os.path.exists(record_file):
+        ledger.import_record_file(record_file)
+    return ledger
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*
+
+"""
+Per-command resource accounting. The resources used by each command run for a
+GSM (download, sra2fastq, rsem, etc.) are appended to metrics.yaml in the GSM
+directory, which is used for sizing concurrency and cluster requests. Each
+record is a single line of a yaml list so that commands run in parallel for
+the same GSM can append to it without locking, e.g. content of metrics.yaml:
+
+- {stage: download, item: SRR070177.sra, returncode: 0, time: 1437148000.0, wall: 312.4, utime: 20.1, stime: 35.2, maxrss: 10485760, read_bytes: 0, write_bytes: 2147483648}
+- {stage: sra2fastq, item: SRR070177.sra, returncode: 0, ...}
+"""
+
+import os
+import re
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+import yaml
+
+from rsempipeline.conf.settings import RSEM_OUTPUT_DIR_RE, METRICS_FILE_BASENAME
+
+# the order of keys in a record
+KEYS = ['stage', 'item', 'returncode', 'time', 'wall', 'utime', 'stime',
+        'maxrss', 'read_bytes', 'write_bytes']
+
+
+def parse_flag_file(flag_file):
+    """
+    figure out which GSM and stage a command is run for from its flag file,
+    e.g.
+
+    /path/to/rsem_output/GSE1/homo_sapiens/GSM1/SRR1.sra.download.COMPLETE
+    => (/path/to/rsem_output/GSE1/homo_sapiens/GSM1, download, SRR1.sra)
+
+    /path/to/rsem_output/GSE1/homo_sapiens/GSM1/rsem.COMPLETE
+    => (/path/to/rsem_output/GSE1/homo_sapiens/GSM1, rsem, None)
+
+    :returns: None if flag_file isn't under a GSM directory
+    """
+    res = re.search(RSEM_OUTPUT_DIR_RE, flag_file)
+    if not res:
+        return
+    gsm_dir = res.group(0)
+    fields = os.path.basename(flag_file).split('.')
+    if fields[-1] == 'COMPLETE':
+        fields.pop()
+    stage = fields.pop()
+    item = '.'.join(fields) or None
+    return gsm_dir, stage, item
+
+
+def dump_scalar(val):
+    # e.g. 'download\n...\n' => 'download', None => 'null'
+    return yaml.safe_dump(val).split('\n')[0]
+
+
+def format_record(record):
+    """a record in flow style in a single line, keys in the order of KEYS"""
+    return '- {{{0}}}\n'.format(', '.join(
+        '{0}: {1}'.format(_, dump_scalar(record[_])) for _ in KEYS))
+
+
+def record(flag_file, returncode, usage):
+    """
+    append the usage of a command to the metrics.yaml of the GSM it's run for
+
+    :param usage: as returned by runner.Task.get_usage
+    """
+    parsed = parse_flag_file(flag_file)
+    if parsed is None:
+        logger.debug('{0} is not of a GSM, metrics not recorded'.format(flag_file))
+        return
+    gsm_dir, stage, item = parsed
+    rec = dict(usage, stage=stage, item=item, returncode=returncode,
+               time=round(time.time(), 2))
+    metrics_file = os.path.join(gsm_dir, METRICS_FILE_BASENAME)
+    try:
+        # O_APPEND makes a single small write atomic among processes
+        fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, format_record(rec))
+        finally:
+            os.close(fd)
+    except OSError, err:
+        logger.exception(err)
+    return rec
+
+
+def load(gsm_dir):
+    """:returns: a list of records in the metrics.yaml of gsm_dir"""
+    metrics_file = os.path.join(gsm_dir, METRICS_FILE_BASENAME)
+    if not os.path.exists(metrics_file):
+        return []
+    with open(metrics_file) as inf:
+        return yaml.safe_load(inf) or []
+
+
+def format_usage(usage):
+    """a one-line summary for logging, sizes in MB"""
+    M = 2. ** 20
+    io = ''
+    if usage['read_bytes'] is not None:
+        io = ', read: {0:.1f} MB, written: {1:.1f} MB'.format(
+            usage['read_bytes'] / M, usage['write_bytes'] / M)
+    return 'wall: {0}s, user: {1}s, sys: {2}s, max rss: {3:.1f} MB{4}'.format(
+        usage['wall'], usage['utime'], usage['stime'], usage['maxrss'] / M, io)
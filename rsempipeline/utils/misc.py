@@ -6,7 +6,6 @@ import os
 import re
 import time
 import logging
-import select
 import subprocess
 import pickle
 import glob
@@ -15,7 +14,10 @@ from functools import update_wrapper
 logger = logging.getLogger(__name__)
 
 import yaml
-import paramiko
+
+from rsempipeline.utils import ssh
+from rsempipeline.utils import runner
+from rsempipeline.utils import metrics
 
 
 def mkdir(d):
@@ -178,6 +180,17 @@ def get_config(config_yaml_file):
 #     return True
 
 
+def record_usage(task, msg_id='', flag_file=None):
+    """
+    log the resources used by a finished task, and record them in the
+    metrics of the GSM and stage the flag_file belongs to
+    """
+    usage = task.get_usage()
+    logger.info('{0}: {1}'.format(msg_id, metrics.format_usage(usage)))
+    if flag_file is not None:
+        metrics.record(flag_file, task.returncode, usage)
+
+
 # used a better version of execute as defined in rsempipeline.py --2014-08-13
 def execute(cmd, msg_id='', flag_file=None, debug=False):
     """
@@ -188,7 +201,9 @@ def execute(cmd, msg_id='', flag_file=None, debug=False):
     if debug:                   # only print out cmd
         return
     try:
-        returncode = subprocess.call(cmd, shell=True, executable="/bin/bash")
+        task = runner.run(cmd, msg_id, capture=False)
+        returncode = task.returncode
+        record_usage(task, msg_id, flag_file)
         if returncode != 0:
             logger.error(
                 '{0}: started, but failed to finish with a returncode of {1}. '
@@ -206,43 +221,30 @@ def execute(cmd, msg_id='', flag_file=None, debug=False):
             'CMD: "{2}"'.format(msg_id, err, cmd))
 
 
-def execute_log_stdout_stderr(cmd, msg_id='', flag_file=None, debug=False):
+def execute_log_stdout_stderr(cmd, msg_id='', flag_file=None, debug=False,
+                              log_file=None, timeout=None):
     """
     This execute logs all stdout and stderr, which could look funny, especially
-    when it comes to tools like aspc and wget
+    when it comes to tools like aspc and wget. With log_file, the output goes
+    there instead and only a periodic summary is logged
+
+    :param timeout: in seconds, after which the command is killed
     """
     logger.info(cmd)
     if debug:
         return
     try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, shell=True,
-                                executable="/bin/bash")
-
-        # stdout, stderr = [], []
-        while True:
-            reads = [proc.stdout.fileno(), proc.stderr.fileno()]
-            ret = select.select(reads, [], [])
-
-            for fd in ret[0]:
-                if fd == proc.stdout.fileno():
-                    read = proc.stdout.readline()
-                    logger.info('stdout: ' + read.strip())
-                    # stdout.append(read)
-                if fd == proc.stderr.fileno():
-                    read = proc.stderr.readline()
-                    logger.info('stderr: ' + read.strip())
-                    # stderr.append(read)
-
-            if proc.poll() != None:
-                break
-
-        returncode = proc.returncode
+        task = runner.run(cmd, msg_id, log_file, timeout)
+        returncode = task.returncode
+        record_usage(task, msg_id, flag_file)
 
         if returncode != 0:
             logger.error(
                 '{0}, started, but then failed with returncode: {1}. '
                 'CMD "{2}"'.format(msg_id, returncode, cmd))
+            if log_file is not None and task.tail:
+                logger.error('last lines of output in {0}:\n    {1}'.format(
+                    log_file, '\n    '.join(task.tail)))
         else:
             logger.info('{0}, execution succeeded with returncode: {1}. '
                         'CMD "{2}"'.format(msg_id, returncode, cmd))
@@ -312,26 +314,28 @@ def is_empty_dir(dir_, output):
 
 def sshexec(cmd, host, username, private_key_file='~/.ssh/id_rsa'):
     """
-    ssh to username@remote and execute cmd.
+    ssh to username@remote and execute cmd. The authenticated connection is
+    pooled and reused by subsequent calls to the same host
 
     :param private_key_file: could be ~/.ssh/id_dsa, as well
     """
-    private_key_file = os.path.expanduser(private_key_file)
-    rsa_key = paramiko.RSAKey.from_private_key_file(private_key_file)
-
-    # This step will timeout after about 75 seconds if cannot proceed
-    channel = paramiko.Transport((host, 22))
-
-    channel.connect(username=username, pkey=rsa_key)
-    session = channel.open_session()
-    # if exec_command fails, None will be returned
-    session.exec_command(cmd)
-
-    # not sure what -1 does? learned from ssh.py
-    output = session.makefile('rb', -1).readlines()
-    channel.close()
-    # if execution failed, output is None
-    return output
+    return ssh.get_session(host, username, private_key_file).execute(cmd)
+
+
+def sshexec_iter(cmd, host, username, private_key_file='~/.ssh/id_rsa'):
+    """
+    ssh to username@remote and execute cmd, yield the output line by line
+    instead of returning them all at once
+    """
+    return ssh.get_session(host, username, private_key_file).execute_iter(cmd)
+
+
+def sshexec_many(cmds, host, username, private_key_file='~/.ssh/id_rsa'):
+    """
+    ssh to username@remote and execute cmds concurrently over the same
+    connection, return a list of outputs in the same order as cmds
+    """
+    return ssh.get_session(host, username, private_key_file).execute_many(cmds)
 
 
 def disk_used(dir):
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*
+
+"""
+utilities for submitting jobs to the scheduler (SGE or PBS) on remote cluster,
+e.g. submitting all transferred GSMs as a single array job instead of one qsub
+per GSM
+"""
+
+import os
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+from jinja2 import Environment, FileSystemLoader
+
+from rsempipeline.utils import resources as RES
+from rsempipeline.utils.misc import pretty_usage
+from rsempipeline.utils.resources import parse_walltime, format_walltime
+from rsempipeline.utils.rsem import gen_fastq_gz_input
+from rsempipeline.conf.settings import (TEMPLATES_DIR, RSEM_OUTPUT_DIR_RE,
+                                        QSUB_SUBMIT_SCRIPT_BASENAME)
+
+# prefixes of directive lines in a qsub script per scheduler
+DIRECTIVE_PREFIXES = {
+    'sge': '#$',
+    'pbs': '#PBS',
+}
+
+# the environment variables set by the scheduler for the index of an array
+# task and the directory where qsub is executed
+ARRAY_TASK_ID_VARS = {
+    'sge': '${SGE_TASK_ID}',
+    # -J for PBS Pro, -t for Torque
+    'pbs': '${PBS_ARRAY_INDEX:-${PBS_ARRAYID}}',
+}
+
+WORKDIR_VARS = {
+    'sge': 'SGE_O_WORKDIR',
+    'pbs': 'PBS_O_WORKDIR',
+}
+
+# PBS Pro takes -J for array jobs while Torque takes -t, they are told apart
+# by how resources are requested, i.e. -l select=1:ncpus=8 for PBS Pro and
+# -l nodes=1:ppn=8 for Torque
+ARRAY_OPTIONS = {
+    'sge': '-t',
+    'torque': '-t',
+    'pbspro': '-J',
+}
+
+PBS_PRO_RE = r'-l\s+.*\bselect='
+
+# compiled jinja2 templates of qsub scripts, keyed by template name
+jinja2_templates = {}
+
+# how walltime is specified in a directive, e.g. -l h_rt=24:00:00
+WALLTIME_RES = {
+    'sge': r'(h_rt=)(\d+:\d+:\d+)',
+    'pbs': r'(walltime=)(\d+:\d+:\d+)',
+}
+
+# how cpus and memory (in G) are requested in a directive, e.g.
+# -pe ncpus 8, -l mem_free=3.83G,mem_token=3.83G,h_vmem=3.83G for SGE, and
+# -l walltime=24:00:00,nodes=1:ppn=8,mem=20GB for PBS
+NCPUS_RES = {
+    'sge': r'(-pe\s+\S+\s+)(\d+)',
+    'pbs': r'(ppn=)(\d+)',
+}
+
+MEM_RES = {
+    'sge': r'((?:mem_free|mem_token|h_vmem)=)(\d+(?:\.\d+)?)',
+    'pbs': r'(mem=)(\d+(?:\.\d+)?)',
+}
+
+# whether mem is requested per slot (cpu) rather than per job, SGE multiplies
+# mem_free, h_vmem, etc. by the number of slots of -pe
+MEM_PER_SLOT = {
+    'sge': True,
+    'pbs': False,
+}
+
+
+def get_directives(qsub_script):
+    """
+    Read the scheduler directives from a templated qsub script (e.g.
+    0_submit.sh), the job name (-N) and array (-t, -J) directives are excluded
+    since they are specific to a single job
+
+    :returns: scheduler (sge or pbs) and a list of directive lines
+    """
+    scheduler, directives = None, []
+    with open(qsub_script) as inf:
+        for line in inf:
+            line = line.strip()
+            for sch, prefix in DIRECTIVE_PREFIXES.items():
+                if line.startswith(prefix + ' '):
+                    scheduler = sch
+                    if re.search(r'^{0}\s+-[NtJ]\s'.format(re.escape(prefix)), line):
+                        continue
+                    directives.append(line)
+    if scheduler is None:
+        raise ValueError('no SGE or PBS directives found in {0}'.format(qsub_script))
+    return scheduler, directives
+
+
+def write_manifest(gsm_ids, manifest):
+    """
+    write one GSM id (e.g. rsem_output/GSExxxxx/homo_sapiens/GSMxxxxxxx) per
+    line, the line number corresponds to the index of array task
+    """
+    with open(manifest, 'wb') as opf:
+        for _ in gsm_ids:
+            opf.write('{0}\n'.format(_))
+
+
+def gen_array_params(qsub_script, job_name, num_tasks, manifest):
+    """
+    Generate the parameters for templating an array job script based on an
+    already templated qsub_script of one of the GSMs
+
+    :param manifest: the path to the manifest relative to remote_top_outdir
+    """
+    scheduler, directives = get_directives(qsub_script)
+    prefix = DIRECTIVE_PREFIXES[scheduler]
+    directives.append('{0} -N {1}'.format(prefix, job_name))
+    directives.append('{0} {1} 1-{2}'.format(
+        prefix, ARRAY_OPTIONS[get_flavour(scheduler, directives)], num_tasks))
+    return dict(
+        scheduler=scheduler,
+        directives=directives,
+        task_id=ARRAY_TASK_ID_VARS[scheduler],
+        workdir_var=WORKDIR_VARS[scheduler],
+        manifest=manifest)
+
+
+def get_flavour(scheduler, directives):
+    """:returns: sge, torque or pbspro"""
+    if scheduler == 'sge':
+        return scheduler
+    if any(re.search(PBS_PRO_RE, _) for _ in directives):
+        return 'pbspro'
+    return 'torque'
+
+
+def gen_job_name(job_name):
+    """
+    Generate a job name for the array or bundle job. SGE doesn't allow : in
+    job names, and a job name should start with a letter
+    """
+    return 'rp_{0}'.format(re.sub(r'[^\w.-]', '-', os.path.basename(job_name)))
+
+
+def gen_bundle_params(qsub_script, job_name):
+    """
+    Generate the parameters for templating a bundle job script, which runs
+    the qsub scripts of multiple GSMs within one allocation
+    """
+    scheduler, directives = get_directives(qsub_script)
+    prefix = DIRECTIVE_PREFIXES[scheduler]
+    directives.append('{0} -N {1}'.format(prefix, job_name))
+    return dict(
+        scheduler=scheduler,
+        directives=directives,
+        workdir_var=WORKDIR_VARS[scheduler])
+
+
+def pack_bundles(runtimes, max_runtime):
+    """
+    Pack GSMs into bundles by their predicted runtimes (first fit decreasing),
+    so that the total runtime of each bundle doesn't exceed max_runtime. A GSM
+    that takes longer than max_runtime by itself makes its own bundle
+
+    :param runtimes: a list of (gsm_id, predicted runtime in seconds)
+    :returns: a list of bundles, each one is a list of gsm_ids
+    """
+    bundles, totals = [], []
+    for gsm_id, runtime in sorted(runtimes, key=lambda x: x[1], reverse=True):
+        for k, total in enumerate(totals):
+            if total + runtime <= max_runtime:
+                bundles[k].append(gsm_id)
+                totals[k] += runtime
+                break
+        else:
+            bundles.append([gsm_id])
+            totals.append(runtime)
+    return bundles
+
+
+def get_walltime(qsub_script):
+    """get the walltime (e.g. 24:00:00) requested in qsub_script if any"""
+    scheduler, directives = get_directives(qsub_script)
+    for directive in directives:
+        match = re.search(WALLTIME_RES[scheduler], directive)
+        if match:
+            return match.group(2)
+
+
+def set_walltime(directives, scheduler, walltime):
+    """replace the walltime requested in directives with walltime"""
+    return [re.sub(WALLTIME_RES[scheduler], r'\g<1>{0}'.format(walltime), _)
+            for _ in directives]
+
+
+def search_directives(directives, regex):
+    for directive in directives:
+        match = re.search(regex, directive)
+        if match:
+            return match.group(2)
+
+
+def get_resources(qsub_script):
+    """
+    :returns: a dict of ncpus, mem (G) and walltime (in seconds) requested in
+    qsub_script, each is None if not requested
+    """
+    scheduler, directives = get_directives(qsub_script)
+    ncpus = search_directives(directives, NCPUS_RES[scheduler])
+    mem = search_directives(directives, MEM_RES[scheduler])
+    walltime = search_directives(directives, WALLTIME_RES[scheduler])
+    return dict(ncpus=int(ncpus) if ncpus else None,
+                mem=float(mem) if mem else None,
+                walltime=parse_walltime(walltime) if walltime else None)
+
+
+def merge_resources(qsub_scripts, parallel=False):
+    """
+    the resources for a single job that runs the qsub scripts of multiple
+    GSMs, whose resources are sized per GSM. Running them one at a time (in
+    an array task or sequentially in a bundle) needs the max of each, while
+    running them in parallel needs the sum of cpus, and the sum of memory
+    unless it's requested per slot (SGE), in which case the max per slot
+    memory is enough as the slots add up. The walltime is always the max, a
+    sequential bundle sets its own
+
+    :returns: the same as get_resources
+    """
+    scheduler, _ = get_directives(qsub_scripts[0])
+    resources = [get_resources(_) for _ in qsub_scripts]
+    summed = ['ncpus'] if MEM_PER_SLOT[scheduler] else ['ncpus', 'mem']
+    merged = {}
+    for key in ['ncpus', 'mem', 'walltime']:
+        vals = [_[key] for _ in resources]
+        if None in vals:
+            merged[key] = None
+        elif parallel and key in summed:
+            merged[key] = sum(vals)
+        else:
+            merged[key] = max(vals)
+    return merged
+
+
+def set_resources(directives, scheduler, ncpus=None, mem=None, walltime=None):
+    """replace the resources requested in directives, None for unchanged"""
+    subs = []
+    if ncpus is not None:
+        subs.append((NCPUS_RES[scheduler], str(ncpus)))
+    if mem is not None:
+        subs.append((MEM_RES[scheduler], '{0:g}'.format(round(mem, 2))))
+    if walltime is not None:
+        subs.append((WALLTIME_RES[scheduler], format_walltime(walltime)))
+    for regex, val in subs:
+        directives = [re.sub(regex, r'\g<1>{0}'.format(val), _)
+                      for _ in directives]
+    return directives
+
+
+def parse_job_id(qsub_output):
+    """
+    parse the job id from the output of qsub, e.g.
+
+    SGE: Your job 1234 ("GSM1_GSE1") has been submitted
+    SGE array job: Your job-array 1234.1-10:1 ("rp_transfer") has been submitted
+    PBS: 1234.server.domain or 1234[].server.domain for array job
+
+    :returns: the numeric job id as a string, or None if not found
+    """
+    match = (re.search(r'Your job(?:-array)? (\d+)', qsub_output) or
+             re.search(r'^\s*(\d+)(?:\[\])?(?:\.\S+)?\s*$', qsub_output))
+    if match:
+        return match.group(1)
+
+
+def parse_qstat(lines):
+    """
+    parse the job ids from the output of qstat (both SGE and PBS), the header
+    and the lines that don't start with a job id are skipped, e.g.
+
+    job-ID  prior   name       user   state submit/start at     queue  slots
+    -----------------------------------------------------------------------
+    1234    0.50500 GSM1_GSE1  user   r     07/17/2015 09:04:38 all.q@n1  12
+
+    :returns: a set of numeric job ids as strings
+    """
+    job_ids = set()
+    for line in lines:
+        match = re.search(r'^\s*(\d+)(?:\[\d*\])?(?:\.\S+)?\s', line)
+        if match:
+            job_ids.add(match.group(1))
+    return job_ids
+
+
+def count_array_tasks(task_ids):
+    """
+    count the tasks in the ja-task-ID column of SGE qstat, e.g. 1-10:1 => 10,
+    4-10:2 => 4, 1,3,5 => 3
+    """
+    num = 0
+    for part in task_ids.split(','):
+        match = re.search(r'^(\d+)-(\d+):(\d+)$', part)
+        if match:
+            start, end, step = [int(_) for _ in match.groups()]
+            num += len(range(start, end + 1, step))
+        else:
+            num += 1
+    return num
+
+
+def parse_qstat_states(lines):
+    """
+    count the jobs pending and running in the output of qstat (both SGE and
+    PBS), a pending SGE array job counts as many jobs as its tasks, e.g.
+
+    SGE: job-ID prior name user state submit/start at queue slots ja-task-ID
+    PBS: Job ID Username Queue Jobname SessID NDS TSK Memory Time S Time
+
+    :returns: a dict with keys of pending and running
+    """
+    states = {'pending': 0, 'running': 0}
+    for line in lines:
+        fields = line.split()
+        if not fields or not re.search(r'^\d+(?:\[\d*\])?(?:\.\S+)?$', fields[0]):
+            continue
+        if len(fields) > 4 and re.search(r'^\d+\.\d+$', fields[1]):
+            # SGE, the priority is always a float
+            state = fields[4]
+            if 'E' in state:
+                # e.g. Eqw, it won't start until the error is cleared
+                continue
+            if 'qw' in state:
+                num = 1
+                if re.search(r'^[\d,:\-]+$', fields[-1]) and (
+                        '-' in fields[-1] or ',' in fields[-1]):
+                    num = count_array_tasks(fields[-1])
+                states['pending'] += num
+            elif 'r' in state or 't' in state:
+                states['running'] += 1
+        else:
+            # PBS, the state is the second last column
+            state = fields[-2]
+            if state in ('R', 'E'):
+                states['running'] += 1
+            elif state in ('Q', 'H', 'W', 'T'):
+                states['pending'] += 1
+    return states
+
+
+def get_template(template_name):
+    """
+    Get the compiled template, which is cached per process so that it's not
+    recompiled for every GSM
+    """
+    if template_name not in jinja2_templates:
+        # TEMPLATES_DIR: the standard templates directory
+        # os.getcwd(): the current working directory
+        # use both for looking for the template
+        jinja2_env = Environment(
+            loader=FileSystemLoader([TEMPLATES_DIR, os.getcwd()]))
+        jinja2_templates[template_name] = jinja2_env.get_template(template_name)
+    return jinja2_templates[template_name]
+
+
+def calc_qsub_resources(fastq_gzs, limits, cpu_rates):
+    """
+    Auto-size ncpus, mem and walltime based on the sizes of fastq_gzs
+
+    :param limits: the QSUB_RESOURCES of the template in use, when None,
+    None is returned for each and the defaults in the template are used
+    :param cpu_rates: as returned by resources.collect_cpu_rates
+    """
+    if not limits or not fastq_gzs:
+        return None, None, None
+    size = sum(os.path.getsize(_) for _ in fastq_gzs)
+    res = RES.calc_resources(size, cpu_rates, limits)
+    logger.info('resources for {0} ({1} of fastq.gz): {2}'.format(
+        os.path.dirname(fastq_gzs[0]), pretty_usage(size), res))
+    return res['ncpus'], res['mem'], res['walltime']
+
+
+def render_qsub_script(gsm_dir, fastq_gzs, template_name, reference_names,
+                       limits=None, cpu_rates=None):
+    """
+    render the qsub script (0_submit.sh) of a GSM, which is executed in the
+    GSM dir
+
+    :param reference_names: a dict of {species: reference name}
+    :returns: the path to the qsub script
+    """
+    res = re.search(RSEM_OUTPUT_DIR_RE, gsm_dir)
+    gse = res.group('GSE')
+    species = res.group('species')
+    gsm = res.group('GSM')
+    # only need the basename since the 0_submit.sh will be executed in the
+    # GSM dir
+    fastq_gz_input = gen_fastq_gz_input([os.path.basename(_) for _ in fastq_gzs])
+    reference_name = reference_names[species]
+    sample_name = gsm
+    ncpus, mem, walltime = calc_qsub_resources(fastq_gzs, limits, cpu_rates)
+
+    qsub_script = os.path.join(gsm_dir, QSUB_SUBMIT_SCRIPT_BASENAME)
+    content = get_template(template_name).render(
+        gse=gse, species=species, gsm=gsm, fastq_gz_input=fastq_gz_input,
+        reference_name=reference_name, sample_name=sample_name,
+        ncpus=ncpus, mem=mem, walltime=walltime)
+    with open(qsub_script, 'wb') as opf:
+        opf.write(content)
+    logger.info('templated {0}'.format(qsub_script))
+    return qsub_script
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*
+
+"""
+A self-contained agent that is pushed to and executed on the remote host by
+rp-transfer. It walks REMOTE_TOP_OUTDIR once and prints a single line of
+base64-encoded, zlib-compressed JSON summarizing the state of each GSM, the
+real disk usage of REMOTE_TOP_OUTDIR and the free space of the filesystem,
+which replaces the separate du -s, find and df calls over ssh.
+
+Only the standard library could be used here, and the code needs to run with
+both python2 and python3 since it's unknown which one is available remotely,
+e.g.
+
+python remote_agent.py /path/to/top_outdir /path/for/df
+"""
+
+import os
+import re
+import sys
+import json
+import zlib
+import base64
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+GSM_DIR_RE = re.compile(r'^GSM\d+$')
+
+# the states of a GSM on remote host
+EMPTY = 'empty'                 # dir created, nothing transferred yet
+TRANSFERRED = 'transferred'     # fastq.gz transferred, rsem not started
+RUNNING = 'running'             # rsem.log exists but not rsem.COMPLETE
+COMPLETE = 'complete'           # rsem.COMPLETE exists
+
+
+def list_dir(path):
+    """:returns: a list of (name, is_dir, usage in byte) of entries in path"""
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            st = entry.stat(follow_symlinks=False)
+            entries.append((entry.name,
+                            entry.is_dir(follow_symlinks=False),
+                            disk_usage(st)))
+    else:
+        for name in os.listdir(path):
+            st = os.lstat(os.path.join(path, name))
+            entries.append((name, stat.S_ISDIR(st.st_mode), disk_usage(st)))
+    return entries
+
+
+def disk_usage(st):
+    """the space actually allocated as counted by du"""
+    blocks = getattr(st, 'st_blocks', None)
+    if blocks is None:
+        return st.st_size
+    return blocks * 512
+
+
+def get_gsm_state(names):
+    if 'rsem.COMPLETE' in names:
+        return COMPLETE
+    if 'rsem.log' in names:
+        return RUNNING
+    if names:
+        return TRANSFERRED
+    return EMPTY
+
+
+def walk(top_dir):
+    """
+    walk top_dir recursively without following symlinks
+
+    :returns: total usage of top_dir and a dict of per-GSM summaries keyed by
+    the path of GSM dir relative to top_dir
+    """
+    total = disk_usage(os.lstat(top_dir))
+    gsms = {}
+    stack = [top_dir]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = list_dir(path)
+        except OSError:
+            # e.g. removed by a running job during the walk
+            continue
+        usage = 0
+        for name, is_dir, size in entries:
+            usage += size
+            if is_dir:
+                stack.append(os.path.join(path, name))
+        total += usage
+        if GSM_DIR_RE.search(os.path.basename(path)):
+            gsms[os.path.relpath(path, top_dir)] = {
+                'state': get_gsm_state([_[0] for _ in entries]),
+                'usage': usage}
+    # usage of nested dirs within GSM dirs is counted in total only
+    return total, gsms
+
+
+def get_free_space(path):
+    """equivalent to the Available column of df -k -P path, in byte"""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def gen_status(top_dir, df_dir):
+    total, gsms = walk(top_dir)
+    return {'top_outdir': top_dir,
+            'usage': total,
+            'free': get_free_space(df_dir),
+            'gsms': gsms}
+
+
+def encode(status):
+    data = json.dumps(status, sort_keys=True).encode('utf-8')
+    return base64.b64encode(zlib.compress(data)).decode('ascii')
+
+
+def decode(line):
+    return json.loads(zlib.decompress(base64.b64decode(line)).decode('utf-8'))
+
+
+def main(argv):
+    top_dir = argv[0]
+    df_dir = argv[1] if len(argv) > 1 else top_dir
+    if not os.path.isdir(top_dir):
+        sys.stderr.write('{0} does not exist\n'.format(top_dir))
+        return 1
+    sys.stdout.write(encode(gen_status(top_dir, df_dir)) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*
+
+"""
+An index of the directory tree on remote host as listed by find, so that
+checking whether a GSM dir is empty or contains a flag file (e.g.
+rsem.COMPLETE) is O(1) instead of scanning the whole listing
+"""
+
+import os
+import re
+
+
+class RemoteTree(object):
+    """Index of paths as listed by find {top_dir}"""
+
+    def __init__(self, lines=()):
+        # dir path => set of basenames of its children
+        self.children = {}
+        # GSM dirs in the order they are listed
+        self.gsm_dirs = []
+        self.num_paths = 0
+        self.update(lines)
+
+    def update(self, lines):
+        """
+        :param lines: an iterable of paths, trailing whitespace (e.g. '\\n')
+        is stripped, so the output from ssh could be streamed in directly
+        """
+        for line in lines:
+            path = line.rstrip()
+            if path:
+                self.add(path)
+
+    def add(self, path):
+        self.num_paths += 1
+        parent, basename = os.path.split(path)
+        children = self.children.get(parent)
+        if children is None:
+            children = self.children[parent] = set()
+        children.add(basename)
+        if basename.startswith('GSM') and re.search(r'^GSM\d+$', basename):
+            self.gsm_dirs.append(path)
+
+    def is_empty_dir(self, dir_):
+        return not self.children.get(dir_)
+
+    def has_file(self, dir_, basename):
+        """e.g. check if rsem.COMPLETE exists in a GSM dir"""
+        return basename in self.children.get(dir_, ())
+
+    def __len__(self):
+        return self.num_paths
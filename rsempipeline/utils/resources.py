@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*
+
+"""
+utilities for sizing the resources (ncpus, mem and walltime) requested in
+qsub scripts based on the sizes of fastq.gz files of a GSM and the efficiency
+of historical rsem runs, i.e. cpu seconds spent per byte of fastq.gz, which is
+derived from GSMxxxxxxx.time and rsem.log. Floors and ceilings are configured
+per qsub template in rp_config.yml, e.g.
+
+QSUB_RESOURCES:
+  0_submit_genesis.jinja2:
+    ncpus: [2, 12]
+    mem: [3.83, 3.83]           # in G, as interpreted by the template
+    walltime: [2, 72]           # in hours
+"""
+
+import os
+import re
+import glob
+import math
+import logging
+logger = logging.getLogger(__name__)
+
+from rsempipeline.utils.misc import ugly_usage
+from rsempipeline.utils.runtime import parse_rsem_time, get_rsem_time_file
+from rsempipeline.utils.pre_pipeline_run import get_rsem_outdir
+
+# the size of fastq.gz files per cpu when deciding ncpus, the larger the
+# input, the more cpus are requested
+BYTES_PER_CPU = 2 * 2 ** 30
+
+# the safety factor multiplied to the predicted runtime to get the walltime
+WALLTIME_FACTOR = 1.5
+
+RSEM_LOG_BASENAME = 'rsem.log'
+
+
+def parse_du_size(val):
+    """convert the size as output by du -h (e.g. 1.2G, 512K) to byte"""
+    if val[-1].isdigit():
+        return ugly_usage('{0} bytes'.format(val))
+    return ugly_usage('{0} {1}B'.format(val[:-1], val[-1]))
+
+
+def parse_rsem_log(rsem_log):
+    """
+    Parse rsem.log for the total size of fastq.gz files and the number of
+    cpus used, which are written by rsem.jinja2 after rsem finishes,
+    e.g. content of rsem.log:
+
+    ...
+    ncpus: 8
+    1.2G	./SRR1557065_1.fastq.gz
+    1.2G	./SRR1557065_2.fastq.gz
+
+    :returns: a tuple of (fastq_gz_size, ncpus), ncpus is None if not found
+    """
+    size, ncpus = 0, None
+    with open(rsem_log) as inf:
+        for line in inf:
+            match = re.search(r'^ncpus:\s*(\d+)', line)
+            if match:
+                ncpus = int(match.group(1))
+                continue
+            match = re.search(r'^(\d+(\.\d+)?[KMGTP]?)\s+\S+\.fastq\.gz$',
+                              line.strip())
+            if match:
+                size += parse_du_size(match.group(1))
+    return size, ncpus
+
+
+def collect_cpu_rates(top_outdir, default_ncpus):
+    """
+    Collect the cpu seconds spent per byte of fastq.gz for every GSM under
+    top_outdir that has both a .time file and a rsem.log
+
+    :param default_ncpus: used when ncpus isn't recorded in rsem.log
+    """
+    pattern = os.path.join(get_rsem_outdir(top_outdir), 'GSE*', '*', 'GSM*')
+    rates = []
+    for gsm_dir in glob.glob(pattern):
+        rsem_log = os.path.join(gsm_dir, RSEM_LOG_BASENAME)
+        seconds = parse_rsem_time(get_rsem_time_file(gsm_dir))
+        if seconds is None or not os.path.exists(rsem_log):
+            continue
+        size, ncpus = parse_rsem_log(rsem_log)
+        if size > 0:
+            rates.append(seconds * (ncpus or default_ncpus) / float(size))
+    logger.info('{0} historical cpu rates collected from {1}'.format(
+        len(rates), top_outdir))
+    return rates
+
+
+def median(vals):
+    vals = sorted(vals)
+    num = len(vals)
+    if num % 2 == 1:
+        return vals[num // 2]
+    return (vals[num // 2 - 1] + vals[num // 2]) / 2.
+
+
+def clamp(val, bounds):
+    low, high = bounds
+    return max(low, min(high, val))
+
+
+def format_walltime(seconds):
+    """e.g. 3661 => 01:01:01"""
+    seconds = int(math.ceil(seconds))
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def calc_resources(fastq_gz_size, cpu_rates, limits):
+    """
+    Calculate the resources to request for one GSM
+
+    :param fastq_gz_size: total size of fastq.gz files in byte
+    :param cpu_rates: as returned by collect_cpu_rates
+    :param limits: floors and ceilings of ncpus, mem (G) and walltime (hours)
+    of a particular template, e.g. {'ncpus': [2, 12], 'mem': [3.83, 3.83],
+    'walltime': [2, 72]}
+    :returns: a dict with keys of ncpus, mem and walltime (e.g. 12:00:00)
+    """
+    ncpus_bounds = limits['ncpus']
+    ncpus = int(clamp(math.ceil(fastq_gz_size / float(BYTES_PER_CPU)),
+                      ncpus_bounds))
+
+    # the more cpus, the more memory is needed for running bowtie in parallel
+    mem_low, mem_high = limits['mem']
+    if ncpus_bounds[1] > ncpus_bounds[0]:
+        frac = (ncpus - ncpus_bounds[0]) / float(ncpus_bounds[1] - ncpus_bounds[0])
+    else:
+        frac = 1.
+    mem = round(mem_low + (mem_high - mem_low) * frac, 2)
+
+    walltime_bounds = [_ * 3600 for _ in limits['walltime']]
+    if cpu_rates:
+        predicted = median(cpu_rates) * fastq_gz_size / ncpus
+        walltime = clamp(predicted * WALLTIME_FACTOR, walltime_bounds)
+    else:
+        # no history to predict from, be safe
+        walltime = walltime_bounds[1]
+    return dict(ncpus=ncpus, mem=mem, walltime=format_walltime(walltime))
+
+
+def parse_walltime(walltime):
+    """e.g. 01:01:01 => 3661"""
+    hours, minutes, seconds = [int(_) for _ in walltime.split(':')]
+    return hours * 3600 + minutes * 60 + seconds
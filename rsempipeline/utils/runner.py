@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*
+
+"""
+run commands as child processes whose stdout and stderr are drained by
+threads into a per-task log file, so that neither a partial line without a
+newline nor a chatty tool (fastq-dump, rsem, rsync) blocks the caller, and
+the workers don't serialize on the shared logger for every line of output.
+Only a summary of the progress is logged at most every SUMMARY_INTERVAL
+seconds, and the last TAIL_SIZE lines are kept in memory to be logged when
+the command fails.
+
+The child is reaped with os.wait4 so that its resource usage (user and sys
+CPU time, max RSS) is known, and /proc/<pid>/io is sampled while it runs for
+the bytes read and written by it and the children it has waited for.
+
+Since the child runs in a process group of its own, it doesn't get the
+SIGINT or SIGHUP of the terminal, so it's killed when the wait for it is
+interrupted, and kill_all kills those still running, e.g. waited for in other
+threads, when the caller exits.
+"""
+
+import os
+import sys
+import time
+import atexit
+import signal
+import threading
+import subprocess
+from collections import deque
+import logging
+logger = logging.getLogger(__name__)
+
+# in seconds, how often the progress of a running task is logged
+SUMMARY_INTERVAL = 300
+# the number of last lines of output kept in memory per task
+TAIL_SIZE = 20
+# a partial line longer than this is split so the buffer stays bounded
+MAX_LINE_LENGTH = 65536
+# in seconds, how long a child has to exit after SIGTERM before SIGKILL
+KILL_GRACE_PERIOD = 10
+# in seconds, how often the child is polled
+POLL_INTERVAL = 0.1
+
+# the tasks started and not waited for yet
+live_tasks = set()
+live_tasks_lock = threading.Lock()
+
+
+def read_proc_io(pid):
+    """
+    :returns: (read_bytes, write_bytes) from /proc/<pid>/io, None if it's not
+    readable, e.g. not on Linux. content of /proc/<pid>/io, e.g.
+
+    rchar: 323934931
+    wchar: 323929600
+    ...
+    read_bytes: 0
+    write_bytes: 323932160
+    cancelled_write_bytes: 0
+    """
+    try:
+        with open('/proc/{0}/io'.format(pid)) as inf:
+            io = dict(_.split(':', 1) for _ in inf if ':' in _)
+        return int(io['read_bytes']), int(io['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+class Task(object):
+    def __init__(self, cmd, msg_id='', log_file=None, timeout=None,
+                 summary_interval=SUMMARY_INTERVAL, tail_size=TAIL_SIZE,
+                 capture=True):
+        """
+        :param log_file: where stdout and stderr go, if None, each line is
+        logged as before, but still without blocking on partial lines
+        :param timeout: in seconds, the child is killed when exceeded
+        :param capture: if False, the child inherits stdout and stderr,
+        e.g. for tools with progress bars like ascp and wget
+        """
+        self.cmd = cmd
+        self.msg_id = msg_id
+        self.log_file = log_file
+        self.timeout = timeout
+        self.summary_interval = summary_interval
+        self.capture = capture
+        self.tail = deque(maxlen=tail_size)
+        self.num_lines = 0
+        self.num_bytes = 0
+        self.returncode = None
+        self.timed_out = False
+        self.proc = None
+        self.rusage = None
+        self.io = None
+        self.started_at = None
+        self.finished_at = None
+        self._opf = None
+        self._closed = False
+        self._drainers = []
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+
+    def start(self):
+        """:raises OSError: when the command fails to start"""
+        if self.log_file is not None and self.capture:
+            self._opf = open(self.log_file, 'ab')
+        pipe = subprocess.PIPE if self.capture else None
+        # a process group of its own, so that the children of the shell are
+        # killed along with it on timeout. close_fds: the pipes of the tasks
+        # started by other threads at the same time aren't inherited, which
+        # would keep them open after those tasks exit
+        self.proc = subprocess.Popen(
+            self.cmd, stdout=pipe, stderr=pipe, close_fds=True,
+            shell=True, executable='/bin/bash', preexec_fn=os.setsid)
+        self.started_at = time.time()
+        with live_tasks_lock:
+            live_tasks.add(self)
+        if not self.capture:
+            return self
+        for name, stream in [('stdout', self.proc.stdout),
+                             ('stderr', self.proc.stderr)]:
+            drainer = threading.Thread(target=self._drain, args=(name, stream))
+            drainer.daemon = True
+            drainer.start()
+            self._drainers.append(drainer)
+        return self
+
+    def _drain(self, name, stream):
+        """
+        read whatever is available instead of a line at a time, so a partial
+        line never blocks, and whatever is buffered at exit is written out
+        """
+        fd = stream.fileno()
+        partial = ''
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            if len(partial) > MAX_LINE_LENGTH:
+                lines.append(partial)
+                partial = ''
+            self._write(name, lines)
+        if partial:
+            self._write(name, [partial])
+        stream.close()
+
+    def _write(self, name, lines):
+        with self._lock:
+            if self._closed:
+                # output of grandchildren that outlived the task
+                return
+            for line in lines:
+                self.num_lines += 1
+                self.num_bytes += len(line) + 1
+                self.tail.append('{0}: {1}'.format(name, line))
+                if self._opf is None:
+                    logger.info('{0}: {1}'.format(name, line.strip()))
+                else:
+                    self._opf.write('{0}: {1}\n'.format(name, line))
+            if self._opf is not None:
+                self._opf.flush()
+
+    def poll(self, options=os.WNOHANG):
+        """
+        reap the child with wait4 instead of Popen.poll, which would discard
+        its rusage
+
+        :returns: the returncode, None if it's still running
+        """
+        # also polled by kill_all from another thread, only one can reap it
+        with self._poll_lock:
+            if self.returncode is not None:
+                return self.returncode
+            self.sample_io()
+            pid, status, rusage = os.wait4(self.proc.pid, options)
+            if pid == 0:
+                return None
+            self.finished_at = time.time()
+            self.rusage = rusage
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+            # so that Popen doesn't try to reap it again
+            self.proc.returncode = self.returncode
+            return self.returncode
+
+    def sample_io(self):
+        # the io of the shell includes that of the children it has reaped, the
+        # file is gone once the child is reaped, so keep the latest sample
+        io = read_proc_io(self.proc.pid)
+        if io is not None:
+            self.io = io
+
+    def get_usage(self):
+        """
+        :returns: a dict of the resources used by the finished child, time in
+        seconds, maxrss and io in bytes, io are None when unavailable
+        """
+        usage = {
+            'wall': round(self.finished_at - self.started_at, 2),
+            'utime': round(self.rusage.ru_utime, 2),
+            'stime': round(self.rusage.ru_stime, 2),
+            # ru_maxrss is in KB on Linux
+            'maxrss': self.rusage.ru_maxrss * 1024,
+            'read_bytes': None,
+            'write_bytes': None,
+        }
+        if self.io is not None:
+            usage['read_bytes'], usage['write_bytes'] = self.io
+        return usage
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+            deadline = time.time() + KILL_GRACE_PERIOD
+            while self.poll() is None and time.time() < deadline:
+                time.sleep(POLL_INTERVAL)
+            if self.poll() is None:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            # already gone
+            pass
+
+    def log_summary(self):
+        with self._lock:
+            last = self.tail[-1] if self.tail else ''
+            logger.info('{0}: running for {1:.0f}s, {2} lines of output{3}, '
+                        'last: {4}'.format(
+                            self.msg_id or self.cmd, time.time() - self.started_at,
+                            self.num_lines,
+                            ' in {0}'.format(self.log_file) if self.log_file else '',
+                            last.strip()))
+
+    def wait(self):
+        """:returns: the returncode, negative when killed by a signal"""
+        try:
+            self._wait()
+        except BaseException:
+            # e.g. KeyboardInterrupt, SystemExit, the child would be left
+            # running otherwise
+            logger.warning('{0}: interrupted, killing it'.format(
+                self.msg_id or self.cmd))
+            self.kill()
+            raise
+        finally:
+            with live_tasks_lock:
+                live_tasks.discard(self)
+            self._close()
+        return self.returncode
+
+    def _wait(self):
+        last_summary = time.time()
+        while self.poll() is None:
+            now = time.time()
+            if self.timeout and now - self.started_at > self.timeout:
+                logger.warning('{0}: timed out after {1}s, killing it'.format(
+                    self.msg_id or self.cmd, self.timeout))
+                self.timed_out = True
+                self.kill()
+                break
+            if self._opf is not None and now - last_summary >= self.summary_interval:
+                self.log_summary()
+                last_summary = now
+            time.sleep(POLL_INTERVAL)
+        self.poll(0)
+
+    def _close(self):
+        # grandchildren that escaped the kill may still hold the pipes open
+        for drainer in self._drainers:
+            drainer.join(KILL_GRACE_PERIOD)
+        with self._lock:
+            self._closed = True
+            if self._opf is not None:
+                self._opf.close()
+
+
+def kill_all():
+    """kill the tasks still running, e.g. when the caller is exiting"""
+    with live_tasks_lock:
+        tasks = list(live_tasks)
+    for task in tasks:
+        if task.poll() is None:
+            logger.warning('{0}: still running, killing it'.format(
+                task.msg_id or task.cmd))
+            task.kill()
+
+atexit.register(kill_all)
+
+
+def exit_on_sigterm():
+    """
+    turn SIGTERM into SystemExit, so that finally clauses (e.g. kill_all,
+    releasing leases) are run, which the default action of SIGTERM skips
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+
+def run(cmd, msg_id='', log_file=None, timeout=None, capture=True):
+    """run cmd and wait for it, :returns: the finished Task"""
+    task = Task(cmd, msg_id, log_file, timeout, capture=capture).start()
+    task.wait()
+    return task
+
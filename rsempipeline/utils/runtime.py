@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*
+
+"""
+utilities for predicting how long rsem is gonna take on a GSM. The prediction
+is based on a simple linear model per species, which is fitted from the
+historical outputs of rsem-calculate-expression --time (i.e. GSMxxxxxxx.time)
+and the sizes of sra files recorded in sras_info.yaml. It is used for ordering
+GSMs so that the longest jobs get started first (LPT scheduling)
+"""
+
+import os
+import re
+import glob
+import logging
+logger = logging.getLogger(__name__)
+
+from rsempipeline.utils.pre_pipeline_run import get_rsem_outdir, get_sras_info
+from rsempipeline.conf.settings import RSEM_OUTPUT_DIR_RE, SRA_INFO_FILE_BASENAME
+
+# the key in the model for the fit over all species, used when there is no
+# history for a particular species
+ALL_SPECIES = '__all__'
+
+
+def get_rsem_time_file(gsm_dir):
+    """
+    e.g. /path/to/rsem_output/GSExxxxx/homo_sapiens/GSMxxxxxxx/GSMxxxxxxx.time,
+    rsem writes it when --time is specified
+    """
+    return os.path.join(gsm_dir, '{0}.time'.format(os.path.basename(gsm_dir)))
+
+
+def parse_rsem_time(time_file):
+    """
+    Sum up the time spent on all steps recorded in time_file, return None if
+    the time_file doesn't exist. e.g. content of time_file:
+
+    Aligning reads: 3146 s.
+    Estimating expression levels: 1530 s.
+    Calculating credibility intervals: 0 s.
+    """
+    if not os.path.exists(time_file):
+        return
+    total, found = 0., False
+    with open(time_file) as inf:
+        for line in inf:
+            match = re.search(r':\s*(\d+(\.\d+)?)\s*s\.?\s*$', line)
+            if match:
+                total += float(match.group(1))
+                found = True
+    if found:
+        return total
+
+
+def get_sras_size(gsm_dir):
+    """the total size of sra files of one GSM based on sras_info.yaml"""
+    sras_info = get_sras_info(gsm_dir)
+    return sum(d[k]['size'] for d in sras_info for k in d.keys())
+
+
+def get_species(gsm_dir):
+    res = re.search(RSEM_OUTPUT_DIR_RE, gsm_dir)
+    if res:
+        return res.group('species')
+
+
+def collect_history(top_outdir):
+    """
+    Collect (species, sras_size, seconds) for every GSM under top_outdir that
+    has both a .time file and a sras_info.yaml
+    """
+    pattern = os.path.join(get_rsem_outdir(top_outdir), 'GSE*', '*', 'GSM*')
+    records = []
+    for gsm_dir in glob.glob(pattern):
+        seconds = parse_rsem_time(get_rsem_time_file(gsm_dir))
+        if seconds is None:
+            continue
+        if not os.path.exists(os.path.join(gsm_dir, SRA_INFO_FILE_BASENAME)):
+            continue
+        size = get_sras_size(gsm_dir)
+        records.append((get_species(gsm_dir), size, seconds))
+    logger.info('{0} historical rsem runtime records collected from '
+                '{1}'.format(len(records), top_outdir))
+    return records
+
+
+def fit_linear(points):
+    """
+    Least squares fit of seconds = slope * size + intercept, fall back to a
+    line through the origin when sizes don't vary enough
+
+    :param points: a list of (size, seconds)
+    """
+    num = len(points)
+    mean_x = sum(x for x, _ in points) / float(num)
+    mean_y = sum(y for _, y in points) / float(num)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if num >= 2 and var_x > 0:
+        cov = sum((x - mean_x) * (y - mean_y) for x, y in points)
+        slope = cov / var_x
+        intercept = mean_y - slope * mean_x
+        if slope > 0:
+            return slope, intercept
+    sum_xx = sum(x * x for x, _ in points)
+    if sum_xx == 0:
+        return 0., mean_y
+    return sum(x * y for x, y in points) / float(sum_xx), 0.
+
+
+def fit_runtime_model(records):
+    """
+    Fit one linear model per species as well as one over all species
+
+    :param records: a list of (species, size, seconds) as returned by
+    collect_history
+
+    :returns: a dict, e.g. {'homo_sapiens': (slope, intercept),
+                            '__all__': (slope, intercept)}
+    """
+    model = {}
+    if not records:
+        return model
+    by_species = {}
+    for species, size, seconds in records:
+        by_species.setdefault(species, []).append((size, seconds))
+    for species, points in by_species.items():
+        model[species] = fit_linear(points)
+    model[ALL_SPECIES] = fit_linear([(s, t) for _, s, t in records])
+    return model
+
+
+def predict_runtime(model, species, size):
+    """
+    predict runtime in seconds, return None if there is no model to use
+    """
+    coef = model.get(species, model.get(ALL_SPECIES))
+    if coef is None:
+        return
+    slope, intercept = coef
+    return max(slope * size + intercept, 0.)
+
+
+def predict_gsm_runtime(model, gsm_dir):
+    return predict_runtime(model, get_species(gsm_dir), get_sras_size(gsm_dir))
+
+
+def sort_by_predicted_runtime(samples, model):
+    """
+    Sort samples by predicted runtime in descending order (longest processing
+    time first). When there is no model, samples are sorted by the sizes of
+    their sra files instead, which is what the runtime is proportional to
+    anyway
+    """
+    def key(sample):
+        runtime = predict_gsm_runtime(model, sample.outdir)
+        if runtime is None:
+            return get_sras_size(sample.outdir)
+        return runtime
+    return sorted(samples, key=key, reverse=True)
+
+
+def pretty_runtime(seconds):
+    if seconds is None:
+        return 'NA'
+    return '{0:.1f}h'.format(seconds / 3600.)
+
+
+def log_predicted_vs_actual(samples, model):
+    """log predicted and actual (when available) rsem runtime per sample"""
+    P = pretty_runtime
+    for sample in samples:
+        predicted = predict_gsm_runtime(model, sample.outdir)
+        actual = parse_rsem_time(get_rsem_time_file(sample.outdir))
+        logger.info('{0}: predicted rsem runtime: {1}, actual: {2}'.format(
+            sample.name, P(predicted), P(actual)))
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*
+
+"""
+Pooled ssh sessions to remote hosts. Loading the private key, connecting and
+authenticating are done once per (host, username), the authenticated
+transport is then reused by all commands executed on that host, each of which
+runs over its own channel, so multiple commands can run concurrently
+"""
+
+import os
+import atexit
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+import paramiko
+
+# interval (in seconds) of keepalive packets, which prevent idle transports
+# from being dropped by firewalls between commands
+KEEPALIVE_INTERVAL = 30
+
+
+class SSHSession(object):
+    """An authenticated transport to a remote host, reconnected lazily"""
+
+    def __init__(self, host, username, private_key_file='~/.ssh/id_rsa',
+                 keepalive=KEEPALIVE_INTERVAL):
+        """
+        :param private_key_file: could be ~/.ssh/id_dsa, as well
+        """
+        self.host = host
+        self.username = username
+        self.private_key_file = os.path.expanduser(private_key_file)
+        self.keepalive = keepalive
+        self.pkey = None
+        self.transport = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.pkey is None:
+            self.pkey = paramiko.RSAKey.from_private_key_file(
+                self.private_key_file)
+        logger.info('connecting to {0}@{1}'.format(self.username, self.host))
+        # This step will timeout after about 75 seconds if cannot proceed
+        transport = paramiko.Transport((self.host, 22))
+        transport.connect(username=self.username, pkey=self.pkey)
+        transport.set_keepalive(self.keepalive)
+        self.transport = transport
+
+    def get_transport(self, reconnect=False):
+        """return the active transport, (re)connect if needed"""
+        with self.lock:
+            if (reconnect or self.transport is None or
+                not self.transport.is_active()):
+                self.close_transport()
+                self.connect()
+            return self.transport
+
+    def open_channel(self):
+        try:
+            return self.get_transport().open_session()
+        except paramiko.SSHException:
+            # e.g. the transport was dropped after the last command, try once
+            # more with a fresh one
+            logger.warning('failed to open a channel to {0}, '
+                           'reconnecting'.format(self.host))
+            return self.get_transport(reconnect=True).open_session()
+
+    def execute(self, cmd):
+        """execute cmd over a new channel and return the lines of stdout"""
+        channel = self.open_channel()
+        # if exec_command fails, None will be returned
+        channel.exec_command(cmd)
+        # not sure what -1 does? learned from ssh.py
+        output = channel.makefile('rb', -1).readlines()
+        channel.close()
+        # if execution failed, output is None
+        return output
+
+    def execute_iter(self, cmd):
+        """
+        execute cmd and yield the lines of stdout as they arrive, useful when
+        the output is too large to be held as a list of lines, e.g. find
+        """
+        channel = self.open_channel()
+        channel.exec_command(cmd)
+        try:
+            for line in channel.makefile('rb', -1):
+                yield line
+        finally:
+            channel.close()
+
+    def execute_many(self, cmds):
+        """
+        execute cmds concurrently, each over its own channel of the same
+        transport, the outputs are returned in the same order as cmds
+        """
+        outputs = [None] * len(cmds)
+        errors = []
+
+        def worker(k, cmd):
+            try:
+                outputs[k] = self.execute(cmd)
+            except Exception as err:
+                errors.append(err)
+
+        # make sure the transport is ready before starting the channels
+        self.get_transport()
+        threads = [threading.Thread(target=worker, args=(k, cmd))
+                   for k, cmd in enumerate(cmds)]
+        for thrd in threads:
+            thrd.start()
+        for thrd in threads:
+            thrd.join()
+        if errors:
+            raise errors[0]
+        return outputs
+
+    def close_transport(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def close(self):
+        with self.lock:
+            self.close_transport()
+
+
+# sessions keyed by (host, username, private_key_file)
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(host, username, private_key_file='~/.ssh/id_rsa'):
+    """get the pooled session, created on first use"""
+    key = (host, username, private_key_file)
+    with sessions_lock:
+        if key not in sessions:
+            sessions[key] = SSHSession(host, username, private_key_file)
+        return sessions[key]
+
+
+def close_all():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+atexit.register(close_all)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*
+
+"""
+A cache of the state of remote hosts (disk usage, free space and queue) that
+persists between invocations of rp-transfer, so that a cron tick shortly
+after the previous one doesn't probe the login node and the filesystem of
+the cluster again. Entries expire after a TTL, and are invalidated once GSMs
+are transferred to or results removed from the host, e.g. content of the
+cache file:
+
+genesis.bcgsc.ca:
+  usage:/path/to/batchx: {time: 1437148000.0, state: [1073741824, ...]}
+  queue:username: {time: 1437148000.0, state: {pending: 0, running: 3}}
+"""
+
+import os
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+import yaml
+
+
+class StateCache(object):
+    def __init__(self, cache_file, ttl):
+        """
+        :param ttl: in seconds, 0 disables the cache
+        """
+        self.cache_file = cache_file
+        self.ttl = ttl
+
+    def read(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as inf:
+                return yaml.safe_load(inf) or {}
+        except yaml.YAMLError:
+            logger.warning('{0} is corrupted, ignored'.format(self.cache_file))
+            return {}
+
+    def write(self, cache):
+        # write to a temporary file first so that the cache file is never
+        # left half written
+        tmp = '{0}.tmp'.format(self.cache_file)
+        with open(tmp, 'wb') as opf:
+            yaml.safe_dump(cache, opf, default_flow_style=False)
+        os.rename(tmp, self.cache_file)
+
+    def get(self, host, key, fetch):
+        """
+        :param fetch: called to fetch the state when it's not cached or
+        expired, the state returned must be serializable by yaml
+        """
+        if not self.ttl:
+            return fetch()
+        cache = self.read()
+        entry = cache.get(host, {}).get(key)
+        now = time.time()
+        if entry is not None and 0 <= now - entry['time'] < self.ttl:
+            logger.info('using {0} of {1} cached {2:.0f}s ago'.format(
+                key, host, now - entry['time']))
+            return entry['state']
+        state = fetch()
+        cache.setdefault(host, {})[key] = {'time': now, 'state': state}
+        self.write(cache)
+        return state
+
+    def invalidate(self, host):
+        """forget everything cached about host"""
+        if not self.ttl:
+            return
+        cache = self.read()
+        if cache.pop(host, None) is not None:
+            self.write(cache)
+            logger.info('cached state of {0} invalidated'.format(host))
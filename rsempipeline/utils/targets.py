@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*
+
+"""
+utilities for dispatching GSMs to multiple remote clusters (targets) from one
+local staging area. Targets are configured in rp_config.yml, keys missing in
+a target are taken from the top level of the config, e.g.
+
+REMOTE_TARGETS:
+  - NAME: genesis
+    REMOTE_HOST: genesis.bcgsc.ca
+    REMOTE_TOP_OUTDIR: /genesis/path/to/batchx
+    REMOTE_CMD_DF: df -k -P /genesis/path
+    REMOTE_MAX_USAGE: 1 TB
+    QSUB_TEMPLATE: 0_submit_genesis.jinja2
+  - NAME: nestor
+    REMOTE_HOST: nestor.westgrid.ca
+    ...
+
+Without REMOTE_TARGETS, the top level of the config is a single target.
+"""
+
+import os
+import glob
+import logging
+logger = logging.getLogger(__name__)
+
+from rsempipeline.utils import qsub as QS
+
+# the keys that can be configured per target
+TARGET_KEYS = [
+    'REMOTE_HOST',
+    'USERNAME',
+    'REMOTE_TOP_OUTDIR',
+    'REMOTE_CMD_DF',
+    'REMOTE_MAX_USAGE',
+    'REMOTE_MIN_FREE',
+    'REMOTE_PYTHON',
+    'REMOTE_REFERENCE_NAMES',
+    'QSUB_TEMPLATE',
+    'REMOTE_QUEUE_HORIZON',
+    'REMOTE_QUEUE_CEILING',
+]
+
+def get_targets(config):
+    """
+    :returns: a list of targets, each of which is a dict with NAME and
+    TARGET_KEYS, the first one is the default target, to which the GSMs
+    transferred before targets were introduced belong
+    """
+    defaults = dict((_, config.get(_)) for _ in TARGET_KEYS)
+    if defaults['REMOTE_PYTHON'] is None:
+        defaults['REMOTE_PYTHON'] = 'python'
+    if not config.get('REMOTE_TARGETS'):
+        defaults['NAME'] = defaults['REMOTE_HOST']
+        return [defaults]
+
+    targets = []
+    for k, conf in enumerate(config['REMOTE_TARGETS']):
+        target = dict(defaults)
+        target.update(conf)
+        target.setdefault('NAME', target['REMOTE_HOST'])
+        # the 0_submit.sh generated by rp-run is for a single cluster, so it
+        # has to be regenerated for whichever target a GSM is placed on
+        if not target['QSUB_TEMPLATE']:
+            raise ValueError('QSUB_TEMPLATE is not configured for target {0} '
+                             '(#{1} in REMOTE_TARGETS)'.format(target['NAME'], k + 1))
+        targets.append(target)
+    names = [_['NAME'] for _ in targets]
+    if len(set(names)) != len(names):
+        raise ValueError('duplicated target names in REMOTE_TARGETS: '
+                         '{0}'.format(', '.join(names)))
+    return targets
+
+
+def calc_capacity(pending, running, runtime, horizon, ceiling=None):
+    """
+    the number of GSMs that can be transferred, whose jobs are expected to
+    start within horizon. When the cluster is at a steady state with running
+    jobs of ours, about running * horizon / runtime of them finish, so as
+    many pending ones start, within horizon
+
+    :param pending: the number of jobs pending on the cluster
+    :param running: the number of jobs running on the cluster
+    :param runtime: the typical runtime of a job in seconds, None if unknown
+    :param horizon: in hours
+    :param ceiling: the max number of GSMs to transfer at a time, which caps
+    the estimate, and applies when there is nothing to estimate from
+    :returns: None for no limit
+    """
+    if not pending and not (running and runtime):
+        # nothing is waiting and nothing to estimate how many more would
+        # start from
+        return ceiling
+    if not running:
+        # none of ours is running while some are waiting, the queue is stuck
+        return 0
+    if runtime:
+        will_start = int(running * horizon * 3600. / runtime)
+    else:
+        # no history to tell, keep no more pending than running
+        will_start = running
+    capacity = max(0, will_start - pending)
+    if ceiling is not None:
+        capacity = min(capacity, ceiling)
+    return capacity
+
+
+def score(state, max_throughput):
+    """
+    the larger the better, a target with more free space to use, fewer jobs
+    queued and faster transfers observed scores higher. A target without
+    observed throughput is deemed as fast as the fastest one so that it gets
+    a chance to be measured
+
+    :param state: a dict with keys of free_to_use, queue_depth and throughput
+    """
+    if state['throughput'] and max_throughput:
+        speed = state['throughput'] / float(max_throughput)
+    else:
+        speed = 1.
+    return state['free_to_use'] * speed / (1. + state['queue_depth'])
+
+
+def place(usages, states):
+    """
+    place each GSM on the target with the highest score among those it fits,
+    the free space to use, queue depth and capacity of a target are updated
+    after each placement so GSMs are spread over targets
+
+    :param usages: a list of (gsm_id, estimated rsem usage)
+    :param states: a dict of {target name: state}, as described in score,
+    with an optional capacity as returned by calc_capacity
+    :returns: a dict of {target name: [gsm_ids]}
+    """
+    states = dict((k, dict(v)) for k, v in states.items())
+    throughputs = [_['throughput'] for _ in states.values() if _['throughput']]
+    max_throughput = max(throughputs) if throughputs else None
+    placement = {}
+    for gsm_id, usage in usages:
+        fits = [_ for _ in sorted(states)
+                if states[_]['free_to_use'] >= usage and
+                states[_].get('capacity') != 0]
+        if not fits:
+            logger.debug('{0} doesn\'t fit any target'.format(gsm_id))
+            continue
+        best = max(fits, key=lambda x: score(states[x], max_throughput))
+        states[best]['free_to_use'] -= usage
+        states[best]['queue_depth'] += 1
+        if states[best].get('capacity') is not None:
+            states[best]['capacity'] -= 1
+        placement.setdefault(best, []).append(gsm_id)
+    return placement
+
+
+def render_qsub_script(gsm_dir, template_name, reference_names, limits=None,
+                       cpu_rates=None):
+    """
+    regenerate the 0_submit.sh of a GSM for a target with its own template and
+    reference paths, the same way as gen_qsub_script in rp-run
+
+    :param limits: the QSUB_RESOURCES of template_name, if configured
+    :param cpu_rates: as returned by resources.collect_cpu_rates
+    """
+    fastq_gzs = sorted(glob.glob(os.path.join(gsm_dir, '*.fastq.gz')))
+    return QS.render_qsub_script(gsm_dir, fastq_gzs, template_name,
+                                 reference_names, limits, cpu_rates)
@@ -43,7 +43,8 @@ setup(
     scripts=[
         'rsempipeline/bin/rp-prep',
         'rsempipeline/bin/rp-run',
-        'rsempipeline/bin/rp-transfer'],
+        'rsempipeline/bin/rp-transfer',
+        'rsempipeline/bin/rp-harvest'],
 
     # using entry_points would cause problem for ruffus to recoganize decorated
     # tasks
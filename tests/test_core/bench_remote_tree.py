@@ -0,0 +1,75 @@
+"""
+Benchmark estimate_current_remote_usage on a synthetic listing from find,
+comparing the indexed RemoteTree against the previous linear scan of the
+whole listing per GSM. Not collected by pytest, run it directly, e.g.
+
+python tests/test_core/bench_remote_tree.py 100000
+"""
+
+import sys
+import time
+
+from rsempipeline.utils.remote_tree import RemoteTree
+
+
+def gen_find_output(num_gsms, files_per_gsm=8):
+    top = '/path/to/rsem_output'
+    yield top
+    for k in range(num_gsms):
+        gse_dir = '{0}/GSE{1}'.format(top, k // 20)
+        if k % 20 == 0:
+            yield gse_dir
+            yield gse_dir + '/homo_sapiens'
+        gsm_dir = '{0}/homo_sapiens/GSM{1}'.format(gse_dir, k)
+        yield gsm_dir
+        # a third are completed, a third are empty, the rest are running
+        if k % 3 == 0:
+            yield gsm_dir + '/rsem.COMPLETE'
+        if k % 3 != 1:
+            for i in range(files_per_gsm):
+                yield '{0}/SRR{1}_{2}.fastq.gz'.format(gsm_dir, k, i)
+
+
+def linear_scan(output):
+    """the algorithm replaced by RemoteTree"""
+    import re
+    count = 0
+    for dir_ in output:
+        if re.search(r'GSM\d+$', dir_):
+            if (dir_ + '/rsem.COMPLETE' not in output and
+                [_ for _ in output if _.startswith(dir_ + '/')]):
+                count += 1
+    return count
+
+
+def indexed(output):
+    tree = RemoteTree(output)
+    return len([_ for _ in tree.gsm_dirs
+                if not tree.has_file(_, 'rsem.COMPLETE') and
+                not tree.is_empty_dir(_)])
+
+
+def bench(func, output):
+    start = time.time()
+    res = func(output)
+    return res, time.time() - start
+
+
+def main():
+    num_gsms = int(sys.argv[1]) if len(sys.argv) > 1 else 150000
+    output = list(gen_find_output(num_gsms))
+    res, secs = bench(indexed, output)
+    print('indexed: {0} paths, {1} running GSMs, {2:.2f}s'.format(
+        len(output), res, secs))
+    # the linear scan is quadratic, so only run it on a small sample
+    small = list(gen_find_output(min(num_gsms, 2000)))
+    res, secs = bench(linear_scan, small)
+    print('linear scan: {0} paths, {1} running GSMs, {2:.2f}s'.format(
+        len(small), res, secs))
+    res, secs = bench(indexed, small)
+    print('indexed: {0} paths, {1} running GSMs, {2:.2f}s'.format(
+        len(small), res, secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from rsempipeline.core import rp_harvest as RP_H
+from rsempipeline.utils import ledger as LG
+
+
+def write_results(gsm_dir, genes_header='gene_id'):
+    gsm = os.path.basename(gsm_dir)
+    os.makedirs(os.path.join(gsm_dir, '{0}.stat'.format(gsm)))
+    for _ in ['{0}.isoforms.results', '{0}.time', 'rsem.log', 'align.stats',
+              'rsem.COMPLETE']:
+        with open(os.path.join(gsm_dir, _.format(gsm)), 'wb') as opf:
+            opf.write('transcript_id\tgene_id\n')
+    with open(os.path.join(gsm_dir, '{0}.genes.results'.format(gsm)), 'wb') as opf:
+        opf.write('{0}\ttranscript_id(s)\n'.format(genes_header))
+
+
+class RPHarvestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.l_top_outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.l_top_outdir)
+
+    @mock.patch('rsempipeline.core.rp_harvest.misc.sshexec', autospec=True)
+    def test_poll_jobs(self, mock_sshexec):
+        mock_sshexec.return_value = [
+            'job-ID  prior   name       user   state submit/start at     queue  slots\n',
+            '-----------------------------------------------------------------------\n',
+            '   1234 0.50500 GSM1_GSE1  user   r     07/17/2015 09:04:38 all.q@n1  12\n']
+        self.assertEqual(RP_H.poll_jobs('r_host', 'user'), set(['1234']))
+        mock_sshexec.assert_called_once_with('qstat -u user', 'r_host', 'user')
+
+    @mock.patch('rsempipeline.core.rp_harvest.misc.sshexec', autospec=True)
+    def test_poll_jobs_failed(self, mock_sshexec):
+        mock_sshexec.return_value = None
+        self.assertRaises(ValueError, RP_H.poll_jobs, 'r_host', 'user')
+
+    def test_find_finished(self):
+        submitted = {'a/GSM1': '1', 'a/GSM2': '2', 'a/GSM3': '2', 'a/GSM4': '4'}
+        self.assertEqual(RP_H.find_finished(submitted, set(['2'])),
+                         ['a/GSM1', 'a/GSM4'])
+
+    @mock.patch('rsempipeline.core.rp_harvest.misc.sshexec', autospec=True)
+    def test_check_completed(self, mock_sshexec):
+        mock_sshexec.return_value = ['a/GSM1/rsem.COMPLETE\n']
+        self.assertEqual(
+            RP_H.check_completed('r_host', 'user', '/r_top', ['a/GSM1', 'a/GSM2']),
+            ['a/GSM1'])
+        mock_sshexec.assert_called_once_with(
+            'cd /r_top && ls -d a/GSM1/rsem.COMPLETE a/GSM2/rsem.COMPLETE '
+            '2>/dev/null; true', 'r_host', 'user')
+
+    @mock.patch('rsempipeline.core.rp_harvest.misc.sshexec', autospec=True)
+    def test_check_completed_nothing_finished(self, mock_sshexec):
+        self.assertEqual(RP_H.check_completed('r_host', 'user', '/r_top', []), [])
+        self.assertFalse(mock_sshexec.called)
+
+    def test_write_results_manifest(self):
+        manifest = os.path.join(self.l_top_outdir, 'harvest.files')
+        RP_H.write_results_manifest(['a/GSM1'], manifest)
+        with open(manifest) as inf:
+            self.assertEqual(inf.read().splitlines(), [
+                'a/GSM1/GSM1.genes.results',
+                'a/GSM1/GSM1.isoforms.results',
+                'a/GSM1/GSM1.stat',
+                'a/GSM1/GSM1.time',
+                'a/GSM1/rsem.log',
+                'a/GSM1/align.stats',
+                'a/GSM1/rsem.COMPLETE'])
+
+    def test_verify_results(self):
+        gsm_dir = os.path.join(self.l_top_outdir, 'a', 'GSM1')
+        write_results(gsm_dir)
+        self.assertTrue(RP_H.verify_results(gsm_dir))
+
+    def test_verify_results_corrupted(self):
+        gsm_dir = os.path.join(self.l_top_outdir, 'a', 'GSM1')
+        write_results(gsm_dir, genes_header='garbage')
+        self.assertFalse(RP_H.verify_results(gsm_dir))
+
+    def test_verify_results_missing(self):
+        gsm_dir = os.path.join(self.l_top_outdir, 'a', 'GSM1')
+        write_results(gsm_dir)
+        os.remove(os.path.join(gsm_dir, 'GSM1.isoforms.results'))
+        self.assertFalse(RP_H.verify_results(gsm_dir))
+
+    def test_clean_local(self):
+        gsm_dir = os.path.join(self.l_top_outdir, 'a', 'GSM1')
+        os.makedirs(os.path.join(gsm_dir, 'SRX1', 'SRR1'))
+        for _ in ['SRX1/SRR1/SRR1.sra', 'SRR1_1.fastq.gz', 'GSM1.genes.results']:
+            open(os.path.join(gsm_dir, _), 'wb').close()
+        RP_H.clean_local(gsm_dir)
+        self.assertEqual(os.listdir(gsm_dir).sort(),
+                         ['SRX1', 'GSM1.genes.results'].sort())
+        self.assertFalse(os.path.exists(os.path.join(gsm_dir, 'SRX1/SRR1/SRR1.sra')))
+        self.assertFalse(os.path.exists(os.path.join(gsm_dir, 'SRR1_1.fastq.gz')))
+
+    @mock.patch('rsempipeline.core.rp_harvest.free_remote_space', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.fetch_results', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.check_completed', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.poll_jobs', autospec=True)
+    def test_harvest(self, mock_poll_jobs, mock_check_completed,
+                     mock_fetch_results, mock_free_remote_space):
+        ledger = LG.Ledger(os.path.join(self.l_top_outdir, 'transfer_ledger.db'))
+        gsm_ids = ['a/GSM1', 'a/GSM2', 'a/GSM3', 'a/GSM4']
+        ledger.record(gsm_ids, LG.SUBMITTED,
+                      job_id={'a/GSM1': '1', 'a/GSM2': '2', 'a/GSM3': '3', 'a/GSM4': '4'})
+        # GSM1 still running, GSM2 failed, GSM3 & GSM4 completed, but results
+        # of GSM4 are corrupted
+        mock_poll_jobs.return_value = set(['1'])
+        mock_check_completed.return_value = ['a/GSM3', 'a/GSM4']
+        def fetch(r_host, r_username, r_top_outdir, l_top_outdir, gsm_ids):
+            write_results(os.path.join(l_top_outdir, 'a/GSM3'))
+            write_results(os.path.join(l_top_outdir, 'a/GSM4'), genes_header='')
+            return 23
+        mock_fetch_results.side_effect = fetch
+
+        self.assertEqual(RP_H.harvest(ledger, 'r_host', 'user', '/r_top',
+                                      self.l_top_outdir), ['a/GSM3'])
+        mock_check_completed.assert_called_once_with(
+            'r_host', 'user', '/r_top', ['a/GSM2', 'a/GSM3', 'a/GSM4'])
+        mock_free_remote_space.assert_called_once_with(
+            'r_host', 'user', '/r_top', ['a/GSM3'])
+        self.assertEqual(ledger.get('a/GSM1')['stage'], LG.SUBMITTED)
+        self.assertEqual(ledger.get('a/GSM2')['stage'], LG.FAILED)
+        self.assertEqual(ledger.get('a/GSM3')['stage'], LG.CLEANED)
+        # to be fetched again next time
+        self.assertEqual(ledger.get('a/GSM4')['stage'], LG.COMPLETED)
+
+        # the failed one is not checked again
+        mock_check_completed.reset_mock()
+        mock_check_completed.return_value = []
+        mock_fetch_results.side_effect = None
+        mock_fetch_results.return_value = 23
+        RP_H.harvest(ledger, 'r_host', 'user', '/r_top', self.l_top_outdir)
+        mock_check_completed.assert_called_once_with(
+            'r_host', 'user', '/r_top', [])
+        ledger.close()
+
+    @mock.patch('rsempipeline.core.rp_harvest.free_remote_space', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.fetch_results', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.check_completed', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.poll_jobs', autospec=True)
+    def test_harvest_keep_remote(self, mock_poll_jobs, mock_check_completed,
+                                 mock_fetch_results, mock_free_remote_space):
+        ledger = LG.Ledger(os.path.join(self.l_top_outdir, 'transfer_ledger.db'))
+        ledger.record(['a/GSM1'], LG.SUBMITTED, job_id={'a/GSM1': '1'})
+        mock_poll_jobs.return_value = set()
+        mock_check_completed.return_value = ['a/GSM1']
+        mock_fetch_results.side_effect = lambda *args: write_results(
+            os.path.join(self.l_top_outdir, 'a/GSM1')) or 0
+        self.assertEqual(RP_H.harvest(ledger, 'r_host', 'user', '/r_top',
+                                      self.l_top_outdir, keep_remote=True),
+                         ['a/GSM1'])
+        self.assertFalse(mock_free_remote_space.called)
+        # the remote copy is still there
+        self.assertEqual(ledger.get('a/GSM1')['stage'], LG.FETCHED)
+        ledger.close()
+
+    @mock.patch('rsempipeline.core.rp_harvest.free_remote_space', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.fetch_results', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.poll_jobs', autospec=True)
+    def test_harvest_nothing_submitted(self, mock_poll_jobs, mock_fetch_results,
+                                       mock_free_remote_space):
+        ledger = LG.Ledger(os.path.join(self.l_top_outdir, 'transfer_ledger.db'))
+        self.assertEqual(RP_H.harvest(ledger, 'r_host', 'user', '/r_top',
+                                      self.l_top_outdir), [])
+        self.assertFalse(mock_poll_jobs.called)
+        self.assertFalse(mock_fetch_results.called)
+        ledger.close()
+
+    @mock.patch('rsempipeline.core.rp_harvest.free_remote_space', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.fetch_results', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.check_completed', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.poll_jobs', autospec=True)
+    def test_harvest_target(self, mock_poll_jobs, mock_check_completed,
+                            mock_fetch_results, mock_free_remote_space):
+        ledger = LG.Ledger(os.path.join(self.l_top_outdir, 'transfer_ledger.db'))
+        ledger.record(['a/GSM1'], LG.SELECTED, target='genesis')
+        ledger.record(['a/GSM2'], LG.SELECTED, target='nestor')
+        ledger.record(['a/GSM1', 'a/GSM2'], LG.SUBMITTED,
+                      job_id={'a/GSM1': '1', 'a/GSM2': '2'})
+        mock_poll_jobs.return_value = set()
+        mock_check_completed.return_value = []
+        RP_H.harvest(ledger, 'nestor', 'user', '/r_top', self.l_top_outdir,
+                     target='nestor')
+        mock_check_completed.assert_called_once_with(
+            'nestor', 'user', '/r_top', ['a/GSM2'])
+        ledger.close()
+
+    @mock.patch('rsempipeline.core.rp_harvest.StateCache', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.harvest', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.LG.open_ledger', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.misc.get_config', autospec=True)
+    @mock.patch('rsempipeline.core.rp_harvest.parse_args_for_rp_harvest', autospec=True)
+    def test_main(self, mock_parse, mock_get_config, mock_open_ledger,
+                  mock_harvest, mock_state_cache):
+        mock_get_config.return_value = {
+            'LOCAL_TOP_OUTDIR': 'l_top_outdir',
+            'USERNAME': 'user',
+            'REMOTE_TARGETS': [
+                {'NAME': 'genesis', 'REMOTE_HOST': 'genesis',
+                 'REMOTE_TOP_OUTDIR': '/genesis/batch',
+                 'QSUB_TEMPLATE': '0_submit_genesis.jinja2'},
+                {'NAME': 'nestor', 'REMOTE_HOST': 'nestor',
+                 'REMOTE_TOP_OUTDIR': '/nestor/batch',
+                 'QSUB_TEMPLATE': '0_submit_nestor.jinja2'}]}
+        mock_parse.return_value.keep_remote = False
+        # genesis is down
+        mock_harvest.side_effect = [ValueError('failed to execute qstat'),
+                                    ['a/GSM1']]
+        RP_H.main()
+        ledger = mock_open_ledger.return_value
+        ledger.set_default_target.assert_called_once_with('genesis')
+        self.assertEqual(mock_harvest.call_args_list, [
+            mock.call(ledger, 'genesis', 'user', '/genesis/batch',
+                      'l_top_outdir', False, 'genesis'),
+            mock.call(ledger, 'nestor', 'user', '/nestor/batch',
+                      'l_top_outdir', False, 'nestor')])
+        self.assertTrue(ledger.log_summary.called)
+        # remote space is freed on nestor
+        mock_state_cache.return_value.invalidate.assert_called_once_with('nestor')
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*
 
+import os
+import shutil
+import tempfile
 import unittest
 import mock
 import types
@@ -7,6 +10,7 @@ import types
 from testfixtures import log_capture
 
 from rsempipeline.core import rp_run
+from rsempipeline.utils import lease as LS
 from rsempipeline.utils.objs import Series, Sample
 
 class RPRunTestCase(unittest.TestCase):
@@ -103,29 +107,38 @@ anonftp@ftp-trace.ncbi.nlm.nih.gov:/sra/sra-instant/reads/ByExp/sra/SRX/SRX093/S
 some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRX999999/SRR999999/SRR999999.sra'''
         flag_file = 'some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRX999999/SRR999999/SRR999999.sra.sra2fastq.COMPLETE'
         mock_config.__getitem__().format.return_value = cmd
+        mock_config.get.return_value = 2
         mock_options.debug = False
         rp_run.sra2fastq(['some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRX999999/SRR999999/SRR999999.sra',
                           'some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRR999999.sra.download.COMPLETE'],
                          [flag_file])
-        mock_execute.assert_called_once_with(cmd, flag_file=flag_file, debug=False)
+        mock_execute.assert_called_once_with(
+            cmd, flag_file=flag_file, debug=False,
+            log_file='some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRX999999/SRR999999/SRR999999.sra.sra2fastq.out',
+            timeout=7200)
+        mock_config.get.assert_called_once_with('SRA2FASTQ_TIMEOUT')
 
 
     @mock.patch('rsempipeline.core.rp_run.options', autospec=True)
     @mock.patch('rsempipeline.core.rp_run.config', autospec=True)
-    @mock.patch('rsempipeline.core.rp_run.gen_fastq_gz_input', autospec=True)
-    @mock.patch('rsempipeline.core.rp_run.Environment', autospec=True)
-    def test_gen_qsub_script(self, mock_env, mocke_gen_fastq_gz_input, mock_config, mock_options):
-        mop = mock.mock_open()
-        with mock.patch('rsempipeline.core.rp_run.open', mop):
-            rp_run.gen_qsub_script(
-                [
-                    'some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRR999999_1.fastq.gz'
-                    'some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRR999999_2.fastq.gz'
-                ],
-                [
-                    'some_outdir/rsem_output/GSE99999/some_species/GSM999999/0_submit.sh'
-                ])
-        self.assertTrue(mop().write.called)
+    @mock.patch('rsempipeline.core.rp_run.get_qsub_resource_limits', autospec=True)
+    @mock.patch('rsempipeline.core.rp_run.QS.render_qsub_script', autospec=True)
+    def test_gen_qsub_script(self, mock_render, mock_limits, mock_config, mock_options):
+        mock_limits.return_value = None
+        mock_options.qsub_template = '0_submit_genesis.jinja2'
+        mock_config.__getitem__.return_value = {'some_species': 'ref'}
+        inputs = [
+            'some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRR999999_1.fastq.gz',
+            'some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRR999999_2.fastq.gz',
+            'some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRX1/SRR999999/SRR999999.sra.sra2fastq.COMPLETE',
+        ]
+        rp_run.gen_qsub_script(
+            inputs,
+            ['some_outdir/rsem_output/GSE99999/some_species/GSM999999/0_submit.sh'])
+        mock_render.assert_called_once_with(
+            'some_outdir/rsem_output/GSE99999/some_species/GSM999999',
+            inputs[:2], '0_submit_genesis.jinja2', {'some_species': 'ref'},
+            None, rp_run.cpu_rates)
 
     @mock.patch('rsempipeline.core.rp_run.PPR.disk_used', autospec=True)
     @mock.patch('rsempipeline.core.rp_run.PPR.disk_free', autospec=True)
@@ -134,3 +147,94 @@ some_outdir/rsem_output/GSE99999/some_species/GSM999999/SRX999999/SRR999999/SRR9
         mock_disk_used.return_value = 20
         res = rp_run.calc_local_free_space_to_use('top_outdir', 'df -k -P /local/path', 10, 50)
         self.assertEqual(res, 30)
+
+
+class LeaseSamplesTestCase(unittest.TestCase):
+    def setUp(self):
+        series = Series('GSE1', 'GSE1_family.soft.subset')
+        self.samples = [Sample('GSM1', series), Sample('GSM2', series)]
+        for k, sample in enumerate(self.samples):
+            sample.outdir = 'top/rsem_output/GSE1/homo_sapiens/GSM{0}'.format(k + 1)
+
+    def test_lease_samples(self):
+        keeper = mock.Mock()
+        keeper.acquire.side_effect = [False, True]
+        self.assertEqual(rp_run.lease_samples(self.samples, keeper),
+                         [self.samples[1]])
+        keeper.acquire.assert_called_with(
+            'top/rsem_output/GSE1/homo_sapiens/GSM2/.rp-run.lease')
+
+    @mock.patch('rsempipeline.utils.pre_pipeline_run.is_processed', autospec=True)
+    @mock.patch('rsempipeline.utils.pre_pipeline_run.estimate_sra2fastq_usage', autospec=True)
+    @mock.patch('rsempipeline.core.rp_run.calc_leased_usage', autospec=True)
+    def test_release_samples_not_fitting(self, mock_leased_usage, mock_estimate,
+                                         mock_is_processed):
+        mock_is_processed.return_value = False
+        # another rp-run leased GSMs taking 600 after these were selected
+        mock_leased_usage.return_value = 600
+        mock_estimate.return_value = 300
+        keeper = mock.Mock()
+        self.assertEqual(rp_run.release_samples_not_fitting(
+            self.samples, 1000, 'top', keeper), [self.samples[0]])
+        keeper.release.assert_called_once_with(
+            'top/rsem_output/GSE1/homo_sapiens/GSM2/.rp-run.lease')
+
+    @mock.patch('rsempipeline.core.rp_run.run', autospec=True)
+    @mock.patch('rsempipeline.core.rp_run.LS.LeaseKeeper', autospec=True)
+    @mock.patch('rsempipeline.core.rp_run.misc.get_config', autospec=True)
+    @mock.patch('rsempipeline.core.rp_run.parse_args_for_rp_run', autospec=True)
+    def test_main_propagates_failures(self, mock_parse, mock_get_config,
+                                      mock_keeper, mock_run):
+        mock_get_config.return_value = {}
+        mock_run.side_effect = IOError(
+            '-t/--qsub_template required when running gen_qsub_script')
+        # so that cron sees a failed run
+        self.assertRaises(IOError, rp_run.main)
+        mock_keeper.return_value.release_all.assert_called_once_with()
+
+    def test_gen_history_file(self):
+        history_file = rp_run.gen_history_file(self.samples)
+        self.assertTrue(history_file.startswith('log/.ruffus_history_'))
+        self.assertEqual(history_file, rp_run.gen_history_file(self.samples[::-1]))
+        self.assertNotEqual(history_file, rp_run.gen_history_file(self.samples[:1]))
+
+
+class LeasedUsageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.top_outdir = tempfile.mkdtemp()
+        self.gsm_dirs = []
+        for gsm in ['GSM1', 'GSM2', 'GSM3']:
+            gsm_dir = os.path.join(self.top_outdir, 'rsem_output', 'GSE1',
+                                   'homo_sapiens', gsm)
+            os.makedirs(gsm_dir)
+            self.gsm_dirs.append(gsm_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.top_outdir)
+
+    @mock.patch('rsempipeline.core.rp_run.PPR.estimate_sra2fastq_usage', autospec=True)
+    def test_calc_leased_usage(self, mock_estimate):
+        mock_estimate.return_value = 1000
+        gsm1, gsm2, gsm3 = self.gsm_dirs
+        other = LS.LeaseKeeper(60, 60)
+        other.acquire(os.path.join(gsm1, '.rp-run.lease'))
+        other.acquire(os.path.join(gsm2, '.rp-run.lease'))
+        # a stale one
+        stale = os.path.join(gsm3, '.rp-run.lease')
+        with open(stale, 'wb') as opf:
+            opf.write('host: another_host\npid: 1\n')
+        os.utime(stale, (0, 0))
+        # partially downloaded already
+        with open(os.path.join(gsm2, 'SRR1.sra'), 'wb') as opf:
+            opf.write('a' * 400)
+        keeper = LS.LeaseKeeper(60, 60)
+        lease_sizes = [os.path.getsize(os.path.join(_, '.rp-run.lease'))
+                       for _ in [gsm1, gsm2]]
+        self.assertEqual(rp_run.calc_leased_usage(self.top_outdir, keeper),
+                         1000 + 1000 - 400 - sum(lease_sizes))
+        # those leased by keeper itself don't count
+        other.release_all()
+        keeper.acquire(os.path.join(gsm1, '.rp-run.lease'))
+        self.assertEqual(rp_run.calc_leased_usage(self.top_outdir, keeper), 0)
+        keeper.release_all()
+        other.release_all()
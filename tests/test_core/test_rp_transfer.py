@@ -1,4 +1,9 @@
+import os
+import sys
+import subprocess
+import shutil
 import datetime
+import tempfile
 
 import unittest
 import mock
@@ -6,6 +11,9 @@ import mock
 from testfixtures import log_capture
 
 from rsempipeline.core import rp_transfer as RP_T
+from rsempipeline.utils.remote_tree import RemoteTree
+from rsempipeline.utils import ledger as LG
+from rsempipeline.utils.state_cache import StateCache
 from rsempipeline.utils.objs import Series, Sample
 
 
@@ -19,38 +27,34 @@ class RPRunTestCase(unittest.TestCase):
         res = RP_T.get_remote_free_disk_space('remote', 'username', cmd)
         self.assertEqual(res, 3072e9)
 
-    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
-    def test_fetch_remote_file_list(self, mock_sshexec):
-        mock_sshexec.return_value = [
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec_iter', autospec=True)
+    def test_fetch_remote_tree(self, mock_sshexec_iter):
+        mock_sshexec_iter.return_value = iter([
                              '/path/to/rsemoutput\n',
                              '/path/to/rsemoutput/GSE1\n',
                              '/path/to/rsemoutput/GSE1/homo_sapiens\n',
                              '/path/to/rsemoutput/GSE1/homo_sapiens/GSM1\n',
                              '/path/to/rsemoutput/GSE2\n',
                              '/path/to/rsemoutput/GSE2/homo_sapiens\n',
-                             '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2\n']
-        self.assertEqual(RP_T.fetch_remote_file_list('remote', 'username', 'r_dir'),
-                         [
-                            '/path/to/rsemoutput',
-                             '/path/to/rsemoutput/GSE1',
-                             '/path/to/rsemoutput/GSE1/homo_sapiens',
-                             '/path/to/rsemoutput/GSE1/homo_sapiens/GSM1',
-                             '/path/to/rsemoutput/GSE2',
-                             '/path/to/rsemoutput/GSE2/homo_sapiens',
-                             '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2'])
+                             '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2\n'])
+        tree = RP_T.fetch_remote_tree('remote', 'username', 'r_dir')
+        self.assertEqual(len(tree), 7)
+        self.assertEqual(tree.gsm_dirs,
+                         ['/path/to/rsemoutput/GSE1/homo_sapiens/GSM1',
+                          '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2'])
 
-    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
-    def test_fetch_remote_file_list_remote_down(self, mock_sshexec):
-        mock_sshexec.return_value = None
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec_iter', autospec=True)
+    def test_fetch_remote_tree_remote_down(self, mock_sshexec_iter):
+        mock_sshexec_iter.return_value = iter([])
         self.assertRaisesRegexp(
             ValueError,
             'cannot estimate current usage on remote host. Please check r_dir exists on remote, or remote may be down',
-            RP_T.fetch_remote_file_list, 'remote', 'username', 'r_dir')
+            RP_T.fetch_remote_tree, 'remote', 'username', 'r_dir')
 
     @mock.patch('rsempipeline.core.rp_transfer.estimate_rsem_usage', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.fetch_remote_file_list', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.fetch_remote_tree', autospec=True)
     def test_estimate_current_remote_usage(self, mock_fetch, mock_est):
-        mock_fetch.return_value = [
+        mock_fetch.return_value = RemoteTree([
             '/path/to/rsemoutput',
             '/path/to/rsemoutput/GSE1',
             '/path/to/rsemoutput/GSE1/homo_sapiens', 
@@ -63,10 +67,11 @@ class RPRunTestCase(unittest.TestCase):
             '/path/to/rsemoutput/GSE3/homo_sapiens',
             '/path/to/rsemoutput/GSE3/homo_sapiens/GSM3',
             '/path/to/rsemoutput/GSE3/homo_sapiens/GSM3/some.fq.gz'
-        ]
+        ])
         mock_est.return_value = 1e3
         self.assertEqual(RP_T.estimate_current_remote_usage('remote', 'username', '/path/to', '/l_path/to', 5),
                          1e3)
+        mock_est.assert_called_once_with('/l_path/to/rsemoutput/GSE3/homo_sapiens/GSM3', 5)
 
     @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
     def test_get_real_current_usage(self, mock_sshexec):
@@ -79,67 +84,6 @@ class RPRunTestCase(unittest.TestCase):
         mock_estimate_sra2fastq_usage.return_value = 1e5
         self.assertEqual(RP_T.estimate_rsem_usage('gsm_dir', 5), 5e5)
 
-    def test_get_gsms_transferred_record_file_not_exist(self):
-        self.assertEqual(RP_T.get_gsms_transferred('nonexistent_transferred_GSMs.txt'), [])
-
-    @mock.patch('rsempipeline.core.rp_transfer.os.path.exists', autospec=True)
-    def test_get_gsms_transferred(self, mock_exists):
-        mock_exists.return_value = True
-        # known issue, mock_open doesn't implement iteration,
-        # http://stackoverflow.com/questions/24779893/customizing-unittest-mock-mock-open-for-iteration
-        # cannot successfully implement what is suggested in this thread, but
-        # my such hack works
-        m = mock.mock_open()
-        m.return_value.__iter__.return_value = [
-            '# 15-07-17 09:04:38',
-            'rsem_output/GSE34736/homo_sapiens/GSM854343',
-            'rsem_output/GSE34736/homo_sapiens/GSM854344'
-        ]
-        with mock.patch('rsempipeline.core.rp_transfer.open', m):
-            self.assertEqual(RP_T.get_gsms_transferred('transferred_GSMs.txt'),
-                             ['rsem_output/GSE34736/homo_sapiens/GSM854343',
-                              'rsem_output/GSE34736/homo_sapiens/GSM854344'])
-
-    @mock.patch('rsempipeline.core.rp_transfer.datetime', autospec=True)
-    def test_append_transfer_record(self, mock_datetime):
-        mock_datetime.datetime.now.return_value = datetime.datetime(2015, 1, 1, 1, 1, 1)
-        m = mock.mock_open()
-        records = ['rsem_output/GSE1/homo_sapiens/GSM1',
-                   'rsem_output/GSE2/homo_sapiens/GSM2']
-        with mock.patch('rsempipeline.core.rp_transfer.open', m):
-            RP_T.append_transfer_record(records, 'transferred_GSMs.txt')
-            self.assertEqual(m().write.call_count, 3)
-
-
-    # such mocking works, too
-    @mock.patch('rsempipeline.core.rp_transfer.datetime.datetime', autospec=True)
-    def test_append_transfer_record2(self, mock_datetime):
-        mock_datetime.now().strftime.return_value = '15-01-01 01:01:01'
-        m = mock.mock_open()
-        records = ['rsem_output/GSE1/homo_sapiens/GSM1',
-                   'rsem_output/GSE2/homo_sapiens/GSM2']
-        with mock.patch('rsempipeline.core.rp_transfer.open', m):
-            RP_T.append_transfer_record(records, 'transferred_GSMs.txt')
-            m.assert_called_once_with('transferred_GSMs.txt', 'ab')
-            expected = [mock.call('# 15-01-01 01:01:01\n'),
-                        mock.call('rsem_output/GSE1/homo_sapiens/GSM1\n'),
-                        mock.call('rsem_output/GSE2/homo_sapiens/GSM2\n')]
-            self.assertEqual(expected, m().write.call_args_list)
-
-    # # Interestingly, such mock doesn't work because of the following error
-    # # E           TypeError: can't set attributes of built-in/extension type 'datetime.datetime'
-    # # http://stackoverflow.com/questions/4481954/python-trying-to-mock-datetime-date-today-but-not-working
-    # @mock.patch('rsempipeline.core.rp_transfer.datetime.datetime.now')
-    # def test_append_transfer_record3(self, mock_now):
-    #     mock_now.return_value = datetime.datetime(2015, 1, 1, 1, 1, 1)
-    #     m = mock.mock_open()
-    #     records = ['rsem_output/GSE1/homo_sapiens/GSM1',
-    #                'rsem_output/GSE2/homo_sapiens/GSM2']
-    #     with mock.patch('rsempipeline.core.rp_transfer.open', m):
-    #         RP_T.append_transfer_record(records, 'transferred_GSMs.txt')
-    #         self.assertEqual(m().write.call_count, 3)
-
-
     @mock.patch('rsempipeline.core.rp_transfer.PPR.is_processed', autospec=True)
     def test_select_gsms_to_transfer_all_processed(self, mock_is_processed):
         mock_is_processed.return_value = False
@@ -193,6 +137,25 @@ class RPRunTestCase(unittest.TestCase):
                 all_gsms, transferred_gsms, 'l_top_outdir', 1e6, 5), [m1])
 
 
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_rsem_usage', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.is_processed', autospec=True)
+    def test_select_gsms_to_transfer_with_max_num(self, mock_is_processed,
+                                                  mock_estimate_rsem_usage):
+        mock_is_processed.return_value = True
+        mock_estimate_rsem_usage.return_value = 1e5
+        all_gsms = []
+        for k in range(3):
+            m = mock.Mock()
+            m.outdir = 'l_top_outdir/rsemoutput/GSE1/homo_sapiens/GSM{0}'.format(k)
+            m.name = 'GSM{0}'.format(k)
+            all_gsms.append(m)
+        self.assertEqual(
+            RP_T.select_gsms_to_transfer(
+                all_gsms, [], 'l_top_outdir', 1e6, 5, 2), all_gsms[:2])
+        self.assertEqual(
+            RP_T.select_gsms_to_transfer(
+                all_gsms, [], 'l_top_outdir', 1e6, 5, 0), [])
+
     @mock.patch.object(RP_T.os, 'mkdir', autospec=True)
     @mock.patch.object(RP_T.os.path, 'exists', autospec=True)
     def test_create_transfer_sh_dir(self, mock_exists, mock_mkdir):
@@ -209,48 +172,379 @@ class RPRunTestCase(unittest.TestCase):
     @mock.patch('rsempipeline.core.rp_transfer.create_transfer_sh_dir', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.datetime', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.write', autospec=True)
-    def test_write_transfer_sh(self, mock_write, mock_datetime, mock_create):
+    @mock.patch('rsempipeline.core.rp_transfer.write_files_manifest', autospec=True)
+    def test_write_transfer_sh(self, mock_write_files_manifest, mock_write,
+                               mock_datetime, mock_create):
         mock_create.return_value = 'l_top_outdir/transfer_scripts'
         mock_datetime.datetime.now.return_value = datetime.datetime(2015, 1, 1, 1, 1, 1)
+        gsm_ids = ['rsem_output/GSE56743/rattus_norvegicus/GSM1367849',
+                   'rsem_output/GSE56743/rattus_norvegicus/GSM1367850']
         self.assertEqual(RP_T.write_transfer_sh(
-            ['rsem_output/GSE56743/rattus_norvegicus/GSM1367849',
-             'rsem_output/GSE56743/rattus_norvegicus/GSM1367850'],
+            gsm_ids,
             'rsync_template',
             'l_top_outdir',
             'r_username', 'r_host', 'r_top_outdir'),
                          'l_top_outdir/transfer_scripts/transfer.15-01-01_01:01:01.sh')
+        files_from = 'l_top_outdir/transfer_scripts/transfer.15-01-01_01:01:01.files'
+        mock_write_files_manifest.assert_called_once_with(
+            gsm_ids, 'l_top_outdir', files_from)
+        self.assertEqual(mock_write.call_args[1]['files_from'], files_from)
+
+    def test_get_transfer_sizes(self):
+        l_top_outdir = tempfile.mkdtemp()
+        try:
+            gsm_id = 'rsem_output/GSE1/homo_sapiens/GSM1'
+            os.makedirs(os.path.join(l_top_outdir, gsm_id))
+            for _, size in [('SRR1_1.fastq.gz', 100), ('0_submit.sh', 10),
+                            ('sras_info.yaml', 1000)]:
+                with open(os.path.join(l_top_outdir, gsm_id, _), 'wb') as opf:
+                    opf.write('a' * size)
+            self.assertEqual(RP_T.get_transfer_sizes([gsm_id], l_top_outdir),
+                             {gsm_id: 110})
+        finally:
+            shutil.rmtree(l_top_outdir)
+
+    def test_get_job_ids_file(self):
+        self.assertEqual(RP_T.get_job_ids_file('transfer_scripts/transfer.x.sh'),
+                         'transfer_scripts/transfer.x.jobids')
+
+    def test_record_submitted(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            job_ids_file = os.path.join(tmp_dir, 'transfer.x.jobids')
+            with open(job_ids_file, 'wb') as opf:
+                opf.write('some other output\n'
+                          'submitted: rsem_output/GSE1/homo_sapiens/GSM1 '
+                          'Your job 1234 ("GSM1_GSE1") has been submitted\n'
+                          'submitted: rsem_output/GSE1/homo_sapiens/GSM2 '
+                          'qsub: Job exceeds queue resource limits\n')
+            ledger = mock.Mock()
+            self.assertEqual(RP_T.record_submitted(ledger, job_ids_file),
+                             {'rsem_output/GSE1/homo_sapiens/GSM1': '1234'})
+            ledger.record.assert_called_once_with(
+                ['rsem_output/GSE1/homo_sapiens/GSM1'], LG.SUBMITTED,
+                job_id={'rsem_output/GSE1/homo_sapiens/GSM1': '1234'})
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_record_submitted_without_job_ids_file(self):
+        ledger = mock.Mock()
+        self.assertEqual(RP_T.record_submitted(ledger, 'nonexistent.jobids'), {})
+        self.assertFalse(ledger.record.called)
+
+    def test_write_files_manifest(self):
+        l_top_outdir = tempfile.mkdtemp()
+        try:
+            gsm_id = 'rsem_output/GSE1/homo_sapiens/GSM1'
+            gsm_dir = os.path.join(l_top_outdir, gsm_id)
+            os.makedirs(os.path.join(gsm_dir, 'SRX1', 'SRR1'))
+            for _ in ['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz', '0_submit.sh',
+                      'sras_info.yaml', 'SRR1.sra.download.COMPLETE',
+                      'SRX1/SRR1/SRR1.sra']:
+                open(os.path.join(gsm_dir, _), 'wb').close()
+            manifest = os.path.join(l_top_outdir, 'transfer.files')
+            self.assertEqual(RP_T.write_files_manifest([gsm_id], l_top_outdir, manifest), 3)
+            with open(manifest) as inf:
+                self.assertEqual(inf.read().splitlines(), [
+                    'rsem_output/GSE1/homo_sapiens/GSM1/0_submit.sh',
+                    'rsem_output/GSE1/homo_sapiens/GSM1/SRR1_1.fastq.gz',
+                    'rsem_output/GSE1/homo_sapiens/GSM1/SRR1_2.fastq.gz'])
+        finally:
+            shutil.rmtree(l_top_outdir)
+
+    @mock.patch('rsempipeline.core.rp_transfer.create_transfer_sh_dir', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.datetime', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.write', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.write_array_job', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.write_files_manifest', autospec=True)
+    def test_write_transfer_sh_array_job(self, mock_write_files_manifest,
+                                         mock_write_array_job, mock_write,
+                                         mock_datetime, mock_create):
+        mock_create.return_value = 'l_top_outdir/transfer_scripts'
+        mock_datetime.datetime.now.return_value = datetime.datetime(2015, 1, 1, 1, 1, 1)
+        mock_write_array_job.return_value = {
+            'submit_scripts': ['transfer_scripts/transfer.15-01-01_01:01:01.array.sh'],
+            'extra_files': ['transfer_scripts/transfer.15-01-01_01:01:01.manifest',
+                            'transfer_scripts/transfer.15-01-01_01:01:01.array.sh']}
+        RP_T.write_transfer_sh(['rsem_output/GSE1/homo_sapiens/GSM1',
+                                'rsem_output/GSE1/homo_sapiens/GSM2'],
+                               'rsync_template', 'l_top_outdir',
+                               'r_username', 'r_host', 'r_top_outdir', True)
+        self.assertEqual(
+            mock_write.call_args[1]['submit_scripts'],
+            ['transfer_scripts/transfer.15-01-01_01:01:01.array.sh'])
+
+        # a single GSM is submitted as a plain job
+        mock_write_array_job.reset_mock()
+        RP_T.write_transfer_sh(['rsem_output/GSE1/homo_sapiens/GSM1'],
+                               'rsync_template', 'l_top_outdir',
+                               'r_username', 'r_host', 'r_top_outdir', True)
+        self.assertFalse(mock_write_array_job.called)
+        self.assertNotIn('submit_scripts', mock_write.call_args[1])
+
+    @mock.patch('rsempipeline.core.rp_transfer.os.chmod', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_transfer_sizes', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.execute_log_stdout_stderr', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.write_transfer_sh', autospec=True)
+    def test_transfer_in_streams(self, mock_write_transfer_sh, mock_execute,
+                                 mock_get_transfer_sizes, mock_chmod):
+        gsm_ids = ['rsem_output/GSE1/homo_sapiens/GSM{0}'.format(_) for _ in range(1, 6)]
+        mock_write_transfer_sh.side_effect = (
+            lambda gsm_ids, *args, **kwargs: '{0}.sh'.format(gsm_ids[0]))
+        # GSM3 fails to transfer
+        mock_execute.side_effect = lambda script, timeout: 1 if 'GSM3' in script else 0
+        ledger = mock.Mock()
+        res = RP_T.transfer_in_streams(
+            gsm_ids, 'rsync_template', 'l_top_outdir', 'r_username', 'r_host',
+            'r_top_outdir', ledger, 3, 3000, timeout=3600)
+        self.assertEqual(sorted(res), [gsm_ids[0], gsm_ids[1], gsm_ids[3], gsm_ids[4]])
+        # one script per GSM, with the bandwidth shared by 3 streams
+        self.assertEqual(mock_write_transfer_sh.call_count, 5)
+        self.assertEqual(
+            set(_[1]['bwlimit'] for _ in mock_write_transfer_sh.call_args_list),
+            set([1000]))
+        # recorded GSM by GSM
+        self.assertEqual(
+            sorted(_[0][0][0] for _ in ledger.record.call_args_list
+                   if _[0][1] == LG.TRANSFERRED),
+            sorted(res))
+        self.assertEqual(
+            len([_ for _ in ledger.record.call_args_list
+                 if _[0][1] == LG.RSYNC_STARTED]), 5)
+        self.assertEqual(set(_[1]['timeout'] for _ in mock_execute.call_args_list),
+                         set([3600]))
+
+    @mock.patch('rsempipeline.core.rp_transfer.os.chmod', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_transfer_sizes', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.execute_log_stdout_stderr', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.write_transfer_sh', autospec=True)
+    def test_transfer_in_streams_more_streams_than_gsms(
+            self, mock_write_transfer_sh, mock_execute, mock_get_transfer_sizes,
+            mock_chmod):
+        mock_execute.return_value = 0
+        res = RP_T.transfer_in_streams(
+            ['GSM1'], 'rsync_template', 'l_top_outdir', 'r_username', 'r_host',
+            'r_top_outdir', mock.Mock(), 4, 1000)
+        self.assertEqual(res, ['GSM1'])
+        self.assertEqual(mock_write_transfer_sh.call_args[1]['bwlimit'], 1000)
+
+    @mock.patch('rsempipeline.core.rp_transfer.os.chmod', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_transfer_sizes', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.execute_log_stdout_stderr', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.write_transfer_sh', autospec=True)
+    def test_transfer_in_streams_error_doesnt_stop_stream(
+            self, mock_write_transfer_sh, mock_execute, mock_get_transfer_sizes,
+            mock_chmod):
+        def write_transfer_sh(gsm_ids, *args, **kwargs):
+            if gsm_ids[0] == 'GSM1':
+                raise IOError('No space left on device')
+            return '{0}.sh'.format(gsm_ids[0])
+        mock_write_transfer_sh.side_effect = write_transfer_sh
+        mock_execute.return_value = 0
+        # a single stream, so GSM2 and GSM3 are transferred by the same
+        # thread after GSM1 fails
+        res = RP_T.transfer_in_streams(
+            ['GSM1', 'GSM2', 'GSM3'], 'rsync_template', 'l_top_outdir',
+            'r_username', 'r_host', 'r_top_outdir', mock.Mock(), 1)
+        self.assertEqual(res, ['GSM2', 'GSM3'])
+
+    def test_write_array_job(self):
+        l_top_outdir = tempfile.mkdtemp()
+        try:
+            gsm_ids = ['rsem_output/GSE1/homo_sapiens/GSM1',
+                       'rsem_output/GSE1/homo_sapiens/GSM2']
+            # sized per GSM
+            for _, ncpus in zip(gsm_ids, [4, 12]):
+                os.makedirs(os.path.join(l_top_outdir, _))
+                with open(os.path.join(l_top_outdir, _, '0_submit.sh'), 'wb') as opf:
+                    opf.write('#!/bin/bash\n#$ -N {0}\n#$ -pe ncpus {1}\n'.format(
+                        os.path.basename(_), ncpus))
+            tf_dir = RP_T.create_transfer_sh_dir(l_top_outdir)
+            res = RP_T.write_array_job(gsm_ids, 'transfer.x', tf_dir,
+                                       l_top_outdir, '/r_top_outdir')
+            self.assertEqual(res, {
+                'submit_scripts': ['transfer_scripts/transfer.x.array.sh'],
+                'submit_gsms': [gsm_ids],
+                'extra_files': ['transfer_scripts/transfer.x.manifest',
+                                'transfer_scripts/transfer.x.array.sh']})
+            with open(os.path.join(l_top_outdir, res['submit_scripts'][0])) as inf:
+                content = inf.read()
+            self.assertIn('#$ -pe ncpus 12\n', content)
+            self.assertIn('#$ -t 1-2\n', content)
+            self.assertNotIn('#$ -N GSM1', content)
+            self.assertIn('sed -n "${SGE_TASK_ID}p" '
+                          'transfer_scripts/transfer.x.manifest', content)
+        finally:
+            shutil.rmtree(l_top_outdir)
+
+    def test_write_bundle_jobs(self):
+        l_top_outdir = tempfile.mkdtemp()
+        try:
+            gsm_ids = ['rsem_output/GSE1/homo_sapiens/GSM1',
+                       'rsem_output/GSE1/homo_sapiens/GSM2',
+                       'rsem_output/GSE1/homo_sapiens/GSM3']
+            for _, ppn in zip(gsm_ids, [2, 4, 8]):
+                os.makedirs(os.path.join(l_top_outdir, _))
+                with open(os.path.join(l_top_outdir, _, '0_submit.sh'), 'wb') as opf:
+                    opf.write('#!/bin/bash\n#PBS -N {0}\n'
+                              '#PBS -l walltime=24:00:00,nodes=1:ppn={1},mem={1}GB\n'.format(
+                                  os.path.basename(_), ppn))
+            tf_dir = RP_T.create_transfer_sh_dir(l_top_outdir)
+            res = RP_T.write_bundle_jobs([gsm_ids[:1], gsm_ids[1:]], 'transfer.x',
+                                         tf_dir, l_top_outdir, '/r_top_outdir',
+                                         parallel=True)
+            self.assertEqual(res, {
+                'submit_scripts': ['rsem_output/GSE1/homo_sapiens/GSM1/0_submit.sh',
+                                   'transfer_scripts/transfer.x.bundle2.sh'],
+                'submit_gsms': [gsm_ids[:1], gsm_ids[1:]],
+                'extra_files': ['transfer_scripts/transfer.x.bundle2.sh']})
+            with open(os.path.join(l_top_outdir, res['extra_files'][0])) as inf:
+                content = inf.read()
+            # walltime of two GSMs in parallel, and the sum of their cpus
+            # and memory
+            self.assertIn('#PBS -l walltime=24:00:00,nodes=1:ppn=12,mem=12GB\n', content)
+            self.assertIn('#PBS -N rp_transfer.x.bundle2\n', content)
+            self.assertIn('rsem_output/GSE1/homo_sapiens/GSM2 '
+                          'rsem_output/GSE1/homo_sapiens/GSM3 ', content)
+            self.assertIn('export PBS_O_WORKDIR=${PWD}', content)
+            self.assertIn('\nwait\n', content)
+        finally:
+            shutil.rmtree(l_top_outdir)
+
+    @mock.patch('rsempipeline.core.rp_transfer.qsub.get_walltime', autospec=True)
+    def test_calc_bundle_walltime(self, mock_get_walltime):
+        mock_get_walltime.side_effect = ['01:30:00', '02:00:00']
+        self.assertEqual(RP_T.calc_bundle_walltime(['GSM1', 'GSM2'], 'l_top_outdir', False),
+                         '03:30:00')
+        mock_get_walltime.side_effect = ['01:30:00', '02:00:00']
+        self.assertEqual(RP_T.calc_bundle_walltime(['GSM1', 'GSM2'], 'l_top_outdir', True),
+                         '02:00:00')
+        mock_get_walltime.side_effect = ['01:30:00', None]
+        self.assertIsNone(RP_T.calc_bundle_walltime(['GSM1', 'GSM2'], 'l_top_outdir', True))
+
+    @mock.patch('rsempipeline.core.rp_transfer.RT.collect_history', autospec=True)
+    def test_bundle_gsms_without_history(self, mock_collect):
+        mock_collect.return_value = []
+        self.assertIsNone(RP_T.bundle_gsms(['rsem_output/GSE1/homo_sapiens/GSM1'],
+                                           'l_top_outdir', 3600))
+
+    @mock.patch('rsempipeline.core.rp_transfer.RT.predict_gsm_runtime', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.RT.collect_history', autospec=True)
+    def test_bundle_gsms(self, mock_collect, mock_predict):
+        mock_collect.return_value = [('homo_sapiens', 100, 1000)]
+        mock_predict.side_effect = [3000, 1000, 2000]
+        self.assertEqual(
+            RP_T.bundle_gsms(['GSM1', 'GSM2', 'GSM3'], 'l_top_outdir', 3600),
+            [['GSM1'], ['GSM3', 'GSM2']])
 
-    @mock.patch('rsempipeline.core.rp_transfer.get_real_current_usage', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.estimate_current_remote_usage', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.get_remote_free_disk_space', autospec=True)
-    def test_calc_remote_free_space_to_use(
-            self, mock_get_real, mock_estimate_current, mock_get_remote_free):
+    @mock.patch('rsempipeline.core.rp_transfer.get_remote_usage', autospec=True)
+    def test_calc_remote_free_space_to_use(self, mock_get_remote_usage):
         """numbers are intentionally made small for convenience, in real scenario,
         just image multiplying them by a constant factor"""
-        mock_get_real.return_value = 1234
-        mock_estimate_current.return_value = 10
-        mock_get_remote_free.return_value = 90
+        # real usage, estimated usage, free space
+        mock_get_remote_usage.return_value = (1234, 10, 90)
         r_max_usage = 50
         r_min_free = 20
         res = RP_T.calc_remote_free_space_to_use(
             'r_host', 'r_username', 'r_top_outdir',
             'l_top_outdir', 'r_cmd_df', r_max_usage, r_min_free, 5)
         self.assertEqual(res, 40)
+        mock_get_remote_usage.assert_called_once_with(
+            'r_host', 'r_username', 'r_top_outdir', 'l_top_outdir',
+            'r_cmd_df', 5, 'python')
+
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_usage_from_status', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.fetch_remote_status', autospec=True)
+    def test_get_remote_usage(self, mock_fetch, mock_estimate):
+        mock_fetch.return_value = {'usage': 1234, 'free': 90, 'gsms': {}}
+        mock_estimate.return_value = 10
+        self.assertEqual(
+            RP_T.get_remote_usage('r_host', 'r_username', 'r_top_outdir',
+                                  'l_top_outdir', 'df -k -P /r_path', 5),
+            (1234, 10, 90))
+        mock_fetch.assert_called_once_with(
+            'r_host', 'r_username', 'r_top_outdir', '/r_path', 'python')
+
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_rsem_usage', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec_many', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.fetch_remote_status', autospec=True)
+    def test_get_remote_usage_fallback(self, mock_fetch, mock_sshexec_many,
+                                       mock_estimate_rsem_usage):
+        mock_fetch.side_effect = ValueError('no status returned')
+        mock_sshexec_many.return_value = [
+            ['3096\t/r_path\n'],
+            ['/r_path\n',
+             '/r_path/rsem_output/GSE1/homo_sapiens/GSM1\n',
+             '/r_path/rsem_output/GSE1/homo_sapiens/GSM1/SRR1_1.fastq.gz\n',
+             '/r_path/rsem_output/GSE1/homo_sapiens/GSM2\n',
+             '/r_path/rsem_output/GSE1/homo_sapiens/GSM2/rsem.COMPLETE\n'],
+            ['Filesystem 1024-blocks Used Available Capacity Mounted on\n',
+             '/dev/analysis 100 10 90 10% /r_path\n']]
+        mock_estimate_rsem_usage.return_value = 10
+        self.assertEqual(
+            RP_T.get_remote_usage('r_host', 'r_username', '/r_path',
+                                  '/l_path', 'df -k -P /r_path', 5),
+            (3096 * 1024, 10, 90 * 1024))
+        # all three over one connection
+        mock_sshexec_many.assert_called_once_with(
+            ['du -s /r_path', 'find /r_path', 'df -k -P /r_path'],
+            'r_host', 'r_username')
+        # only GSM2 is done
+        mock_estimate_rsem_usage.assert_called_once_with(
+            '/l_path/rsem_output/GSE1/homo_sapiens/GSM1', 5)
 
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec_many', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.fetch_remote_status', autospec=True)
+    def test_get_remote_usage_fallback_empty_tree(self, mock_fetch, mock_sshexec_many):
+        mock_fetch.side_effect = ValueError('no status returned')
+        mock_sshexec_many.return_value = [['3096\t/r_path\n'], [], []]
+        self.assertRaises(ValueError, RP_T.get_remote_usage, 'r_host', 'r_username',
+                          '/r_path', '/l_path', 'df -k -P /r_path', 5)
+
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
+    def test_fetch_remote_status_no_output(self, mock_sshexec):
+        mock_sshexec.return_value = []
+        self.assertRaises(ValueError, RP_T.fetch_remote_status,
+                          'remote', 'username', 'r_dir', 'r_dir')
+
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
+    def test_fetch_remote_status_unreadable_output(self, mock_sshexec):
+        mock_sshexec.return_value = ['python: command not found\n']
+        self.assertRaises(ValueError, RP_T.fetch_remote_status,
+                          'remote', 'username', 'r_dir', 'r_dir')
+
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_rsem_usage', autospec=True)
+    def test_estimate_usage_from_status(self, mock_est):
+        status = {'gsms': {
+            'rsem_output/GSE1/homo_sapiens/GSM1': {'state': 'complete', 'usage': 1},
+            'rsem_output/GSE1/homo_sapiens/GSM2': {'state': 'empty', 'usage': 0},
+            'rsem_output/GSE1/homo_sapiens/GSM3': {'state': 'transferred', 'usage': 1},
+            'rsem_output/GSE1/homo_sapiens/GSM4': {'state': 'running', 'usage': 1},
+        }}
+        mock_est.return_value = 1e3
+        self.assertEqual(RP_T.estimate_usage_from_status(status, '/l_top_outdir', 5), 2e3)
+        self.assertEqual(mock_est.call_args_list, [
+            mock.call('/l_top_outdir/rsem_output/GSE1/homo_sapiens/GSM3', 5),
+            mock.call('/l_top_outdir/rsem_output/GSE1/homo_sapiens/GSM4', 5)])
+
+
+    @mock.patch('rsempipeline.core.rp_transfer.find_candidates', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.record_submitted', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.os', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.append_transfer_record', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_transfer_sizes', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.misc.execute_log_stdout_stderr', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.write_transfer_sh', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.select_gsms_to_transfer', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.get_gsms_transferred', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.LG.open_ledger', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.PPR.init_sample_outdirs', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.PPR.gen_all_samples_from_soft_and_isamp', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.misc.get_config', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.parse_args_for_rp_transfer', autospec=True)
     def test_main(self, mock_parse, mock_get_config, mock_calc, mock_gen, mock_init,
-                  mock_get_gsms_transferred, mock_find_gsms, mock_write_transfer_script,
-                  mock_execute, mock_append, mock_os):
+                  mock_open_ledger, mock_find_gsms, mock_write_transfer_script,
+                  mock_execute, mock_get_transfer_sizes, mock_os,
+                  mock_record_submitted, mock_find_candidates):
         mock_get_config.return_value = {
             'LOCAL_TOP_OUTDIR': 'l_top_outdir',
             'REMOTE_TOP_OUTDIR': 'r_top_outdir',
@@ -262,6 +556,7 @@ class RPRunTestCase(unittest.TestCase):
             'FASTQ2RSEM_RATIO': 5,
         }
         mock_calc.return_value = 40
+        mock_parse.return_value.parallel_streams = None
         m1 = mock.Mock()
         m1.outdir = 'l_top_outdir/rsemoutput/GSE1/homo_sapiens/GSM1'
         m1.name = 'GSM1'
@@ -272,14 +567,19 @@ class RPRunTestCase(unittest.TestCase):
         mock_execute.return_value = 0
         RP_T.main()
         self.assertTrue(mock_execute.called)
-        self.assertTrue(mock_append.called)
+        ledger = mock_open_ledger.return_value
+        self.assertEqual(
+            [_[0][1] for _ in ledger.record.call_args_list],
+            [LG.SELECTED, LG.RSYNC_STARTED, LG.TRANSFERRED])
+        self.assertTrue(mock_record_submitted.called)
 
+    @mock.patch('rsempipeline.core.rp_transfer.find_candidates', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.os', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.append_transfer_record', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_transfer_sizes', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.misc.execute_log_stdout_stderr', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.write_transfer_sh', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.select_gsms_to_transfer', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.get_gsms_transferred', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.LG.open_ledger', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.PPR.init_sample_outdirs', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.PPR.gen_all_samples_from_soft_and_isamp', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
@@ -287,8 +587,9 @@ class RPRunTestCase(unittest.TestCase):
     @mock.patch('rsempipeline.core.rp_transfer.parse_args_for_rp_transfer', autospec=True)
     def test_main_no_GSM_found_for_transfer(
             self, mock_parse, mock_get_config, mock_calc, mock_gen, mock_init,
-            mock_get_gsms_transferred, mock_find_gsms, mock_write_transfer_script,
-            mock_execute, mock_append, mock_os):
+            mock_open_ledger, mock_find_gsms, mock_write_transfer_script,
+            mock_execute, mock_get_transfer_sizes, mock_os,
+            mock_find_candidates):
         mock_get_config.return_value = {
             'LOCAL_TOP_OUTDIR': 'l_top_outdir',
             'REMOTE_TOP_OUTDIR': 'r_top_outdir',
@@ -300,18 +601,21 @@ class RPRunTestCase(unittest.TestCase):
             'FASTQ2RSEM_RATIO': 5,
         }
         mock_calc.return_value = 40
+        mock_parse.return_value.parallel_streams = None
         mock_find_gsms.return_value = []
         mock_execute.return_value = 0
         RP_T.main()
         self.assertFalse(mock_write_transfer_script.called)
         self.assertFalse(mock_execute.called)
 
+    @mock.patch('rsempipeline.core.rp_transfer.find_candidates', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.record_submitted', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.os', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.append_transfer_record', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_transfer_sizes', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.misc.execute_log_stdout_stderr', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.write_transfer_sh', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.select_gsms_to_transfer', autospec=True)
-    @mock.patch('rsempipeline.core.rp_transfer.get_gsms_transferred', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.LG.open_ledger', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.PPR.init_sample_outdirs', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.PPR.gen_all_samples_from_soft_and_isamp', autospec=True)
     @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
@@ -319,8 +623,9 @@ class RPRunTestCase(unittest.TestCase):
     @mock.patch('rsempipeline.core.rp_transfer.parse_args_for_rp_transfer', autospec=True)
     def test_main_transfer_unsuccessfull(
             self, mock_parse, mock_get_config, mock_calc, mock_gen, mock_init,
-            mock_get_gsms_transferred, mock_find_gsms, mock_write_transfer_script,
-            mock_execute, mock_append, mock_os):
+            mock_open_ledger, mock_find_gsms, mock_write_transfer_script,
+            mock_execute, mock_get_transfer_sizes, mock_os,
+            mock_record_submitted, mock_find_candidates):
         mock_get_config.return_value = {
             'LOCAL_TOP_OUTDIR': 'l_top_outdir',
             'REMOTE_TOP_OUTDIR': 'r_top_outdir',
@@ -332,6 +637,7 @@ class RPRunTestCase(unittest.TestCase):
             'FASTQ2RSEM_RATIO': 5,
         }
         mock_calc.return_value = 40
+        mock_parse.return_value.parallel_streams = None
         m1 = mock.Mock()
         m1.outdir = 'l_top_outdir/rsemoutput/GSE1/homo_sapiens/GSM1'
         m1.name = 'GSM1'
@@ -342,4 +648,394 @@ class RPRunTestCase(unittest.TestCase):
         mock_execute.return_value = 1
         RP_T.main()
         self.assertTrue(mock_execute.called)
-        self.assertFalse(mock_append.called)
+        ledger = mock_open_ledger.return_value
+        self.assertNotIn(LG.TRANSFERRED,
+                         [_[0][1] for _ in ledger.record.call_args_list])
+        self.assertFalse(mock_record_submitted.called)
+
+
+def local_sshexec(cmd, host, username):
+    """a stand-in for misc.sshexec that executes cmd locally"""
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    return proc.communicate()[0].splitlines(True)
+
+
+class RemoteAgentTestCase(unittest.TestCase):
+    """run the agent against a local directory as if it were on remote host"""
+    def setUp(self):
+        self.top_outdir = tempfile.mkdtemp()
+        gse_dir = os.path.join(self.top_outdir, 'rsem_output', 'GSE1', 'homo_sapiens')
+        for gsm, files in [('GSM1', ['rsem.log', 'rsem.COMPLETE']),
+                           ('GSM2', []),
+                           ('GSM3', ['SRR1_1.fastq.gz', '0_submit.sh']),
+                           ('GSM4', ['SRR2_1.fastq.gz', 'rsem.log'])]:
+            os.makedirs(os.path.join(gse_dir, gsm))
+            for f in files:
+                with open(os.path.join(gse_dir, gsm, f), 'wb') as opf:
+                    opf.write('a' * 10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.top_outdir)
+
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
+    def test_fetch_remote_status(self, mock_sshexec):
+        mock_sshexec.side_effect = local_sshexec
+        status = RP_T.fetch_remote_status(
+            'remote', 'username', self.top_outdir, self.top_outdir,
+            sys.executable)
+        self.assertEqual(
+            dict((k, v['state']) for k, v in status['gsms'].items()), {
+                'rsem_output/GSE1/homo_sapiens/GSM1': 'complete',
+                'rsem_output/GSE1/homo_sapiens/GSM2': 'empty',
+                'rsem_output/GSE1/homo_sapiens/GSM3': 'transferred',
+                'rsem_output/GSE1/homo_sapiens/GSM4': 'running'})
+        self.assertEqual(status['gsms']['rsem_output/GSE1/homo_sapiens/GSM2']['usage'], 0)
+        self.assertGreaterEqual(status['usage'], 6 * 10000)
+        self.assertGreater(status['free'], 0)
+        # a single ssh call
+        self.assertEqual(mock_sshexec.call_count, 1)
+
+
+class TransferMainTestCase(unittest.TestCase):
+    @mock.patch('rsempipeline.core.rp_transfer.find_candidates', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.transfer_in_streams', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.execute_log_stdout_stderr', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.write_transfer_sh', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.select_gsms_to_transfer', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.LG.open_ledger', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.init_sample_outdirs', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.gen_all_samples_from_soft_and_isamp', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.get_config', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.parse_args_for_rp_transfer', autospec=True)
+    def test_main_parallel_streams(self, mock_parse, mock_get_config, mock_calc,
+                                   mock_gen, mock_init, mock_open_ledger,
+                                   mock_find_gsms, mock_write_transfer_script,
+                                   mock_execute, mock_transfer_in_streams,
+                                   mock_find_candidates):
+        mock_get_config.return_value = {
+            'LOCAL_TOP_OUTDIR': 'l_top_outdir',
+            'REMOTE_TOP_OUTDIR': 'r_top_outdir',
+            'REMOTE_HOST': 'remote',
+            'USERNAME': 'username',
+            'REMOTE_CMD_DF': 'df -k -P target_dir',
+            'REMOTE_MAX_USAGE': '50 GB',
+            'REMOTE_MIN_FREE': '20 GB',
+            'FASTQ2RSEM_RATIO': 5,
+        }
+        options = mock_parse.return_value
+        options.parallel_streams = 4
+        options.bwlimit = 2000
+        options.bundle_runtime = None
+        options.rsync_timeout = 0.5
+        m1 = mock.Mock()
+        m1.outdir = 'l_top_outdir/rsem_output/GSE1/homo_sapiens/GSM1'
+        m1.name = 'GSM1'
+        mock_find_gsms.return_value = [m1]
+        RP_T.main()
+        mock_transfer_in_streams.assert_called_once_with(
+            ['rsem_output/GSE1/homo_sapiens/GSM1'], options.rsync_template,
+            'l_top_outdir', 'username', 'remote', 'r_top_outdir',
+            mock_open_ledger.return_value, 4, 2000, None, 1800)
+        mock_open_ledger.assert_called_once_with(
+            'l_top_outdir/transfer_ledger.db', 'l_top_outdir/transferred_GSMs.txt')
+        self.assertFalse(mock_write_transfer_script.called)
+        self.assertFalse(mock_execute.called)
+
+
+    @mock.patch('rsempipeline.core.rp_transfer.find_candidates', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.transfer_to_target', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_job_runtime', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_queue_state', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.select_gsms_to_transfer', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.LG.open_ledger', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.init_sample_outdirs', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.gen_all_samples_from_soft_and_isamp', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.get_config', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.parse_args_for_rp_transfer', autospec=True)
+    def test_main_queue_horizon(self, mock_parse, mock_get_config, mock_calc,
+                                mock_gen, mock_init, mock_open_ledger,
+                                mock_find_gsms, mock_get_queue_state,
+                                mock_estimate_job_runtime, mock_transfer_to_target,
+                                mock_find_candidates):
+        mock_get_config.return_value = {
+            'LOCAL_TOP_OUTDIR': 'l_top_outdir',
+            'REMOTE_TOP_OUTDIR': 'r_top_outdir',
+            'REMOTE_HOST': 'remote',
+            'USERNAME': 'username',
+            'REMOTE_CMD_DF': 'df -k -P target_dir',
+            'REMOTE_MAX_USAGE': '50 GB',
+            'REMOTE_MIN_FREE': '20 GB',
+            'REMOTE_QUEUE_HORIZON': 10,
+            'FASTQ2RSEM_RATIO': 5,
+        }
+        mock_calc.return_value = 40
+        mock_get_queue_state.return_value = {'pending': 20, 'running': 10}
+        mock_estimate_job_runtime.return_value = 7200
+        mock_find_gsms.return_value = []
+        RP_T.main()
+        self.assertEqual(mock_get_queue_state.call_args[0][:2], ('remote', 'username'))
+        self.assertEqual(mock_find_gsms.call_args[0][-1], 30)
+        self.assertFalse(mock_transfer_to_target.called)
+
+    @mock.patch('rsempipeline.core.rp_transfer.get_queue_state', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.find_candidates', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.LG.open_ledger', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.init_sample_outdirs', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.gen_all_samples_from_soft_and_isamp', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.get_config', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.parse_args_for_rp_transfer', autospec=True)
+    def test_main_nothing_to_transfer(self, mock_parse, mock_get_config, mock_gen,
+                                      mock_init, mock_open_ledger,
+                                      mock_find_candidates, mock_calc,
+                                      mock_get_queue_state):
+        mock_get_config.return_value = {
+            'LOCAL_TOP_OUTDIR': 'l_top_outdir',
+            'REMOTE_HOST': 'remote',
+            'USERNAME': 'username',
+            'REMOTE_QUEUE_HORIZON': 10,
+            'FASTQ2RSEM_RATIO': 5,
+        }
+        mock_find_candidates.return_value = []
+        RP_T.main()
+        self.assertTrue(mock_find_candidates.called)
+        # remote host is not probed at all
+        self.assertFalse(mock_calc.called)
+        self.assertFalse(mock_get_queue_state.called)
+
+
+class RemoteStateCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = StateCache(os.path.join(self.tmp_dir, 'cache.yaml'), 600)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.is_processed', autospec=True)
+    def test_find_candidates(self, mock_is_processed):
+        samples = []
+        for name in ['GSM1', 'GSM2', 'GSM3']:
+            sample = mock.Mock()
+            sample.name = name
+            sample.outdir = 'l_top_outdir/rsem_output/GSE1/homo_sapiens/{0}'.format(name)
+            samples.append(sample)
+        mock_is_processed.side_effect = lambda x: not x.endswith('GSM3')
+        self.assertEqual(RP_T.find_candidates(samples, set(['GSM1'])), [samples[1]])
+        # transferred GSMs are not checked
+        self.assertEqual(mock_is_processed.call_count, 2)
+
+    @mock.patch('rsempipeline.core.rp_transfer.get_remote_usage', autospec=True)
+    def test_calc_remote_free_space_to_use_cached(self, mock_get_remote_usage):
+        mock_get_remote_usage.return_value = (10 * 2 ** 30, 20 * 2 ** 30, 500 * 2 ** 30)
+        for _ in range(2):
+            self.assertEqual(RP_T.calc_remote_free_space_to_use(
+                'remote', 'username', 'r_top_outdir', 'l_top_outdir',
+                'df -k -P r_dir', 50 * 2 ** 30, 100 * 2 ** 30, 5, 'python',
+                self.cache), 30 * 2 ** 30)
+        self.assertEqual(mock_get_remote_usage.call_count, 1)
+        self.cache.invalidate('remote')
+        RP_T.calc_remote_free_space_to_use(
+            'remote', 'username', 'r_top_outdir', 'l_top_outdir',
+            'df -k -P r_dir', 50 * 2 ** 30, 100 * 2 ** 30, 5, 'python',
+            self.cache)
+        self.assertEqual(mock_get_remote_usage.call_count, 2)
+
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
+    def test_get_queue_state_cached(self, mock_sshexec):
+        mock_sshexec.return_value = [
+            '   1234 0.50500 GSM1_GSE1  user   r     07/17/2015 09:04:38 all.q@n1  12\n']
+        for _ in range(2):
+            self.assertEqual(RP_T.get_queue_state('remote', 'username', self.cache),
+                             {'pending': 0, 'running': 1})
+        self.assertEqual(mock_sshexec.call_count, 1)
+
+
+class TargetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.targets = [
+            {'NAME': 'genesis', 'REMOTE_HOST': 'genesis', 'USERNAME': 'username',
+             'REMOTE_TOP_OUTDIR': '/genesis/batch', 'REMOTE_CMD_DF': 'df -k -P /genesis',
+             'REMOTE_MAX_USAGE': '50 GB', 'REMOTE_MIN_FREE': '20 GB',
+             'REMOTE_PYTHON': 'python', 'REMOTE_REFERENCE_NAMES': {},
+             'QSUB_TEMPLATE': '0_submit_genesis.jinja2'},
+            {'NAME': 'nestor', 'REMOTE_HOST': 'nestor', 'USERNAME': 'username',
+             'REMOTE_TOP_OUTDIR': '/nestor/batch', 'REMOTE_CMD_DF': 'df -k -P /nestor',
+             'REMOTE_MAX_USAGE': '50 GB', 'REMOTE_MIN_FREE': '20 GB',
+             'REMOTE_PYTHON': 'python', 'REMOTE_REFERENCE_NAMES': {},
+             'QSUB_TEMPLATE': '0_submit_nestor.jinja2'}]
+
+    def test_gen_transfer_job_name(self):
+        self.assertRegexpMatches(RP_T.gen_transfer_job_name(),
+                                 r'^transfer\.[\d\-_:]+$')
+        self.assertRegexpMatches(RP_T.gen_transfer_job_name('nestor'),
+                                 r'^transfer\.[\d\-_:]+\.nestor$')
+
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
+    def test_get_queue_state(self, mock_sshexec):
+        mock_sshexec.return_value = [
+            'job-ID  prior   name       user   state submit/start at     queue  slots\n',
+            '-----------------------------------------------------------------------\n',
+            '   1234 0.50500 GSM1_GSE1  user   r     07/17/2015 09:04:38 all.q@n1  12\n',
+            '   1235 0.50500 GSM2_GSE1  user   qw    07/17/2015 09:04:38           12\n']
+        self.assertEqual(RP_T.get_queue_state('remote', 'username'),
+                         {'pending': 1, 'running': 1})
+        mock_sshexec.assert_called_once_with('qstat -u username', 'remote', 'username')
+
+    @mock.patch('rsempipeline.core.rp_transfer.misc.sshexec', autospec=True)
+    def test_get_queue_state_failed(self, mock_sshexec):
+        mock_sshexec.return_value = None
+        self.assertRaises(ValueError, RP_T.get_queue_state, 'remote', 'username')
+
+    @mock.patch('rsempipeline.core.rp_transfer.RT.collect_history', autospec=True)
+    def test_estimate_job_runtime(self, mock_collect_history):
+        mock_collect_history.return_value = [
+            ('homo_sapiens', 1e9, 3600), ('homo_sapiens', 2e9, 7200),
+            ('mus_musculus', 1e9, 1800)]
+        self.assertEqual(RP_T.estimate_job_runtime('l_top_outdir'), 3600)
+        mock_collect_history.return_value = []
+        self.assertIsNone(RP_T.estimate_job_runtime('l_top_outdir'))
+
+    def test_calc_queue_capacity(self):
+        # 10 running jobs taking 2h each, 50 of them finish within 10h
+        self.assertEqual(RP_T.calc_queue_capacity(
+            {'pending': 20, 'running': 10}, 10, 7200, 'remote'), 30)
+
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_job_runtime', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_queue_state', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
+    def test_survey_targets(self, mock_calc, mock_get_queue_state,
+                            mock_estimate_job_runtime):
+        mock_calc.side_effect = [40, ValueError('nestor may be down')]
+        mock_get_queue_state.return_value = {'pending': 1, 'running': 2}
+        ledger = mock.Mock()
+        ledger.get_throughput.return_value = 1e6
+        states = RP_T.survey_targets(self.targets, 'l_top_outdir', 5, ledger)
+        self.assertEqual(states, {'genesis': dict(
+            free_to_use=40, queue_depth=3, throughput=1e6, capacity=None)})
+        # no REMOTE_QUEUE_HORIZON configured
+        self.assertFalse(mock_estimate_job_runtime.called)
+        self.assertEqual(mock_calc.call_args_list[1], mock.call(
+            'nestor', 'username', '/nestor/batch', 'l_top_outdir',
+            'df -k -P /nestor', 50 * 2 ** 30, 20 * 2 ** 30, 5, 'python', None))
+
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_job_runtime', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.get_queue_state', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
+    def test_survey_targets_with_queue_horizon(self, mock_calc, mock_get_queue_state,
+                                               mock_estimate_job_runtime):
+        for target in self.targets:
+            target['REMOTE_QUEUE_HORIZON'] = 10
+        mock_calc.return_value = 40
+        mock_get_queue_state.side_effect = [{'pending': 20, 'running': 10},
+                                            {'pending': 0, 'running': 0}]
+        mock_estimate_job_runtime.return_value = 7200
+        ledger = mock.Mock()
+        ledger.get_throughput.return_value = None
+        states = RP_T.survey_targets(self.targets, 'l_top_outdir', 5, ledger)
+        self.assertEqual(states['genesis']['capacity'], 30)
+        self.assertEqual(states['genesis']['queue_depth'], 30)
+        self.assertIsNone(states['nestor']['capacity'])
+        # estimated once for all targets
+        mock_estimate_job_runtime.assert_called_once_with('l_top_outdir')
+
+    @mock.patch('rsempipeline.core.rp_transfer.transfer_to_target', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.retarget_qsub_scripts', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.place_gsms_on_targets', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.survey_targets', autospec=True)
+    def test_dispatch_to_targets(self, mock_survey, mock_place, mock_retarget,
+                                 mock_transfer_to_target):
+        mock_place.return_value = {
+            'nestor': ['rsem_output/GSE1/homo_sapiens/GSM1',
+                       'rsem_output/GSE1/homo_sapiens/GSM2']}
+        options = mock.Mock()
+        options.bwlimit = 2000
+        ledger = mock.Mock()
+        config = {'LOCAL_TOP_OUTDIR': 'l_top_outdir', 'FASTQ2RSEM_RATIO': 5}
+        RP_T.dispatch_to_targets([], set(), self.targets, options, config, ledger)
+        ledger.record.assert_called_once_with(
+            mock_place.return_value['nestor'], LG.SELECTED, target='nestor')
+        mock_retarget.assert_called_once_with(
+            mock_place.return_value['nestor'], self.targets[1], 'l_top_outdir',
+            config)
+        self.assertEqual(mock_transfer_to_target.call_count, 1)
+        args = mock_transfer_to_target.call_args[0]
+        self.assertEqual(args[:6], (mock_place.return_value['nestor'],
+                                    self.targets[1], options, 'l_top_outdir',
+                                    ledger, 2000))
+        self.assertTrue(args[6].endswith('.nestor'))
+
+    @mock.patch('rsempipeline.core.rp_transfer.transfer_to_target', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.place_gsms_on_targets', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.survey_targets', autospec=True)
+    def test_dispatch_to_targets_bwlimit_shared(self, mock_survey, mock_place,
+                                                mock_transfer_to_target):
+        mock_place.return_value = {'genesis': ['a/GSM1'], 'nestor': ['a/GSM2']}
+        options = mock.Mock()
+        options.bwlimit = 2000
+        config = {'LOCAL_TOP_OUTDIR': 'l_top_outdir', 'FASTQ2RSEM_RATIO': 5}
+        with mock.patch('rsempipeline.core.rp_transfer.retarget_qsub_scripts'):
+            RP_T.dispatch_to_targets([], set(), self.targets, options, config,
+                                     mock.Mock())
+        self.assertEqual(
+            sorted((_[0][1]['NAME'], _[0][5])
+                   for _ in mock_transfer_to_target.call_args_list),
+            [('genesis', 1000), ('nestor', 1000)])
+
+    @mock.patch('rsempipeline.core.rp_transfer.transfer_to_target', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.place_gsms_on_targets', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.survey_targets', autospec=True)
+    def test_dispatch_to_targets_nothing_placed(self, mock_survey, mock_place,
+                                                mock_transfer_to_target):
+        mock_place.return_value = {}
+        config = {'LOCAL_TOP_OUTDIR': 'l_top_outdir', 'FASTQ2RSEM_RATIO': 5}
+        RP_T.dispatch_to_targets([], set(), self.targets, mock.Mock(), config,
+                                 mock.Mock())
+        self.assertFalse(mock_transfer_to_target.called)
+
+    @mock.patch('rsempipeline.core.rp_transfer.estimate_rsem_usage', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.is_processed', autospec=True)
+    def test_place_gsms_on_targets(self, mock_is_processed, mock_estimate):
+        samples = []
+        for name in ['GSM1', 'GSM2', 'GSM3']:
+            sample = mock.Mock()
+            sample.name = name
+            sample.outdir = 'l_top_outdir/rsem_output/GSE1/homo_sapiens/{0}'.format(name)
+            samples.append(sample)
+        mock_is_processed.side_effect = lambda x: not x.endswith('GSM3')
+        mock_estimate.return_value = 10
+        states = {'genesis': dict(free_to_use=15, queue_depth=0, throughput=None),
+                  'nestor': dict(free_to_use=15, queue_depth=1, throughput=None)}
+        # GSM1 is transferred already, GSM3 is not processed yet
+        self.assertEqual(
+            RP_T.place_gsms_on_targets(samples, set(['GSM1']), 'l_top_outdir',
+                                       states, 5),
+            {'genesis': ['rsem_output/GSE1/homo_sapiens/GSM2']})
+
+    @mock.patch('rsempipeline.core.rp_transfer.find_candidates', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.dispatch_to_targets', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.calc_remote_free_space_to_use', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.LG.open_ledger', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.init_sample_outdirs', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.PPR.gen_all_samples_from_soft_and_isamp', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.misc.get_config', autospec=True)
+    @mock.patch('rsempipeline.core.rp_transfer.parse_args_for_rp_transfer', autospec=True)
+    def test_main_multiple_targets(self, mock_parse, mock_get_config, mock_gen,
+                                   mock_init, mock_open_ledger, mock_calc,
+                                   mock_dispatch, mock_find_candidates):
+        config = {
+            'LOCAL_TOP_OUTDIR': 'l_top_outdir',
+            'USERNAME': 'username',
+            'FASTQ2RSEM_RATIO': 5,
+            'REMOTE_TARGETS': self.targets,
+        }
+        mock_get_config.return_value = config
+        RP_T.main()
+        ledger = mock_open_ledger.return_value
+        ledger.set_default_target.assert_called_once_with('genesis')
+        self.assertEqual(mock_dispatch.call_count, 1)
+        self.assertEqual(
+            [_['NAME'] for _ in mock_dispatch.call_args[0][2]], ['genesis', 'nestor'])
+        self.assertFalse(mock_calc.called)
@@ -60,6 +60,22 @@ class SoftParserTestCase(unittest.TestCase):
                 ValueError, 'GSE00000 \(passed samples\: 0\/0\) != GSE43770', soft_parser.parse,
                 'GSE43770_family.soft.subset', ['Homo sapiens', 'Mus musculus'])
 
+    def test_parse_organisms(self):
+        m = mock.mock_open()
+        with mock.patch('rsempipeline.parsers.soft_parser.open', m):
+            m.return_value.__iter__.return_value = [
+                '^SERIES = GSE1\n',
+                '^SAMPLE = GSM1\n',
+                '!Sample_organism_ch1 = Homo sapiens\n',
+                '!Sample_organism_ch2 = Mus musculus\n',
+                '^SAMPLE = GSM2\n',
+                '!Sample_type = SRA\n',
+                '!Sample_organism_ch1 = Drosophila melanogaster\n',
+                '^SAMPLE = GSM3\n']
+            self.assertEqual(soft_parser.parse_organisms('GSE1_family.soft.subset'),
+                             {'GSM1': ['Homo sapiens', 'Mus musculus'],
+                              'GSM2': ['Drosophila melanogaster']})
+
 
 # class SOFTDownloaderTestCase(unittest.TestCase):
 #     gse1 = 'GSE45284'           # a real one
@@ -8,8 +8,6 @@ from testfixtures import log_capture
 # https://pythonhosted.org/testfixtures/logging.html
 # LogCapture and log_capture are used in different ways to achieve the same
 # results
-from bs4 import BeautifulSoup
-
 from rsempipeline.preprocess import rp_prep, gen_csv
 from rsempipeline.conf.settings import (HTML_OUTDIR_BASENAME,
                                         SPECIES_CSV_BASENAME,
@@ -47,14 +45,14 @@ GSE61491,GSM1506106; GSM1506107;
         self.assertEqual(self.temp_outdir,
                          os.path.abspath(gen_csv.gen_outdir(self.options2)))
 
-    @mock.patch('rsempipeline.preprocess.gen_csv.mkdir')
+    @mock.patch('rsempipeline.preprocess.utils.mkdir')
     def test_gen_outdir_without_specified_outdir(self, mock_mkdir):
         p = rp_prep.get_parser()
         options = p.parse_args(['gen-csv', '-f', 'any_dir/input.csv'])
         self.assertEqual('any_dir', gen_csv.gen_outdir(options))
         self.assertFalse(mock_mkdir.called, "mkdir shouldn't have been called with -f is specified")
 
-    @mock.patch('rsempipeline.preprocess.gen_csv.mkdir')
+    @mock.patch('rsempipeline.preprocess.utils.mkdir')
     def test_gen_outdir_with_specified_outdir(self, mock_mkdir):
         p = rp_prep.get_parser()
         options = p.parse_args(['gen-csv', '-f', 'any_dir/input.csv', '--outdir', 'specified_outdir'])
@@ -106,9 +104,9 @@ GSE61491,GSM1506106; GSM1506107;
         gen_csv.download_html(self.gsm, out_html)
         self.assertTrue(os.path.exists(out_html))
 
-    def test_gen_soup(self):
-        self.assertIsInstance(gen_csv.gen_soup(self.gse, self.gsm, self.temp_outdir),
-                              BeautifulSoup)
+    def test_extract_species(self):
+        html = gen_csv.gen_gsm_html(self.temp_outdir, self.gse, self.gsm)
+        self.assertEqual(gen_csv.extract_species(html), 'Homo sapiens')
 
     def test_find_species_homo_sapiens(self):
         self.assertEqual(gen_csv.find_species(self.gse, self.gsm, self.temp_outdir),
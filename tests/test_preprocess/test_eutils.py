@@ -0,0 +1,118 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+import BaseHTTPServer
+
+from rsempipeline.preprocess import eutils
+from rsempipeline.utils.http_client import HTTPClient
+
+
+# canned esummary documents keyed by uid
+DOCS = {
+    '301446812': {'uid': '301446812', 'accession': 'GSM1446812',
+                  'entrytype': 'GSM', 'taxon': 'Homo sapiens'},
+    '301506106': {'uid': '301506106', 'accession': 'GSM1506106',
+                  'entrytype': 'GSM', 'taxon': 'Mus musculus'},
+}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        self.server.requests.append((url.path, params))
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        uids = params['id'][0].split(',')
+        result = {'uids': uids}
+        for uid in uids:
+            result[uid] = DOCS.get(
+                uid, {'uid': uid, 'error': 'cannot get document summary'})
+        body = json.dumps({'header': {'type': 'esummary'}, 'result': result})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EutilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.status = 200
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/entrez/eutils'.format(
+            self.server.server_port)
+        self.client = HTTPClient(rate=1000, max_retries=0)
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.outdir)
+
+    def test_gsm2uid(self):
+        self.assertEqual(eutils.gsm2uid('GSM1446812'), '301446812')
+        self.assertEqual(eutils.gsm2uid('GSM12'), '300000012')
+
+    def test_parse_summary(self):
+        summary = {'result': {
+            'uids': ['301446812', '301446813'],
+            '301446812': DOCS['301446812'],
+            '301446813': {'uid': '301446813', 'error': 'cannot get document summary'}}}
+        self.assertEqual(eutils.parse_summary(summary),
+                         {'GSM1446812': 'Homo sapiens'})
+        self.assertEqual(eutils.parse_summary({}), {})
+
+    def test_parse_summary_multiple_organisms(self):
+        summary = {'result': {
+            'uids': ['301446812'],
+            '301446812': dict(DOCS['301446812'], taxon='Mus musculus; Homo sapiens')}}
+        # formatted the same as the other backends
+        self.assertEqual(eutils.parse_summary(summary),
+                         {'GSM1446812': 'Homo sapiens; Mus musculus'})
+
+    def test_find_species_in_batches(self):
+        gsms = ['GSM1446812', 'GSM1506106', 'GSM1506107']
+        res = eutils.find_species(gsms, self.outdir, self.client, self.url,
+                                  batch_size=2)
+        self.assertEqual(res, {'GSM1446812': 'Homo sapiens',
+                               'GSM1506106': 'Mus musculus'})
+        self.assertEqual(len(self.server.requests), 2)
+        path, params = self.server.requests[0]
+        self.assertEqual(path, '/entrez/eutils/esummary.fcgi')
+        self.assertEqual(params, {'db': ['gds'], 'id': ['301446812,301506106'],
+                                  'retmode': ['json']})
+        self.assertEqual(len(os.listdir(os.path.join(self.outdir, 'esummary'))), 2)
+
+    def test_find_species_cached(self):
+        gsms = ['GSM1446812', 'GSM1506106']
+        eutils.find_species(gsms, self.outdir, self.client, self.url)
+        res = eutils.find_species(gsms, self.outdir, self.client, self.url)
+        self.assertEqual(res, {'GSM1446812': 'Homo sapiens',
+                               'GSM1506106': 'Mus musculus'})
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_find_species_batch_fails(self):
+        self.server.status = 500
+        res = eutils.find_species(['GSM1446812'], self.outdir, self.client,
+                                  self.url)
+        self.assertEqual(res, {})
+        # not cached, so it's retried next time
+        self.assertEqual(os.listdir(os.path.join(self.outdir, 'esummary')), [])
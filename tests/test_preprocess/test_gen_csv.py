@@ -0,0 +1,247 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from rsempipeline.preprocess import gen_csv
+from rsempipeline.preprocess.packed_cache import PackedCache
+
+
+class GenerateCsvTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_outdir = tempfile.mkdtemp()
+        self.input_csv = os.path.join(self.temp_outdir, 'GSE_GSM.csv')
+        with open(self.input_csv, 'wb') as opf:
+            opf.write('GSE59813,GSM1446812;\n'
+                      'GSE61491,GSM1506106; GSM1506107;\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_outdir)
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.write_csv')
+    @mock.patch('rsempipeline.preprocess.gen_csv.find_species')
+    def test_generate_csv_with_errors(self, mock_find_species, mock_write_csv):
+        mock_find_species.side_effect = [
+            'Mus musculus', IOError('connection reset'), 'Homo sapiens']
+        # errors propagated instead of hanging on queue.join
+        self.assertRaises(RuntimeError, gen_csv.generate_csv,
+                          self.input_csv, self.temp_outdir, num_threads=2)
+        self.assertFalse(mock_write_csv.called)
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.find_species')
+    def test_generate_csv(self, mock_find_species):
+        mock_find_species.side_effect = lambda gse, gsm, outdir, client, cache: (
+            None if gsm == 'GSM1506107' else 'Homo sapiens')
+        gen_csv.generate_csv(self.input_csv, self.temp_outdir, num_threads=2)
+        with open(os.path.join(self.temp_outdir, 'GSE_species_GSM.csv')) as inf:
+            self.assertEqual(inf.read(), 'GSE59813,Homo sapiens,GSM1446812\n'
+                             'GSE61491,Homo sapiens,GSM1506106\n')
+        with open(os.path.join(self.temp_outdir, 'GSE_no_species_GSM.csv')) as inf:
+            self.assertEqual(inf.read(), 'GSE61491,,GSM1506107\n')
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.eutils.find_species')
+    @mock.patch('rsempipeline.preprocess.gen_csv.find_species')
+    def test_generate_csv_eutils(self, mock_find_species, mock_eutils_find_species):
+        mock_eutils_find_species.return_value = {
+            'GSM1446812': 'Homo sapiens', 'GSM1506106': 'Mus musculus'}
+        mock_find_species.return_value = 'Mus musculus'
+        gen_csv.generate_csv(self.input_csv, self.temp_outdir, num_threads=2,
+                             backend='eutils')
+        self.assertEqual(mock_eutils_find_species.call_args[0][0],
+                         ['GSM1446812', 'GSM1506106', 'GSM1506107'])
+        # only the one not found in esummary falls back to html
+        self.assertEqual(mock_find_species.call_count, 1)
+        self.assertEqual(mock_find_species.call_args[0][:2],
+                         ('GSE61491', 'GSM1506107'))
+        with open(os.path.join(self.temp_outdir, 'GSE_species_GSM.csv')) as inf:
+            self.assertEqual(inf.read(), 'GSE59813,Homo sapiens,GSM1446812\n'
+                             'GSE61491,Mus musculus,GSM1506106\n'
+                             'GSE61491,Mus musculus,GSM1506107\n')
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.get_soft.download_soft')
+    @mock.patch('rsempipeline.preprocess.gen_csv.find_species')
+    def test_generate_csv_soft(self, mock_find_species, mock_download_soft):
+        soft_outdir = os.path.join(self.temp_outdir, 'soft')
+
+        def download_soft(input_csv, outdir, num_workers):
+            # GSE61491 fails to download
+            with open(os.path.join(outdir, 'GSE59813_family.soft.subset'), 'wb') as opf:
+                opf.write('^SERIES = GSE59813\n'
+                          '^SAMPLE = GSM1446812\n'
+                          '!Sample_organism_ch1 = Homo sapiens\n')
+        mock_download_soft.side_effect = download_soft
+        mock_find_species.return_value = 'Mus musculus'
+        gen_csv.generate_csv(self.input_csv, self.temp_outdir, num_threads=2,
+                             backend='soft')
+        mock_download_soft.assert_called_once_with(self.input_csv, soft_outdir, 2)
+        self.assertEqual(sorted(_[0][1] for _ in mock_find_species.call_args_list),
+                         ['GSM1506106', 'GSM1506107'])
+        with open(os.path.join(self.temp_outdir, 'GSE_species_GSM.csv')) as inf:
+            self.assertEqual(inf.read(), 'GSE59813,Homo sapiens,GSM1446812\n'
+                             'GSE61491,Mus musculus,GSM1506106\n'
+                             'GSE61491,Mus musculus,GSM1506107\n')
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.get_soft.download_soft')
+    def test_find_species_in_softs_multiple_organisms(self, mock_download_soft):
+        soft_outdir = os.path.join(self.temp_outdir, 'soft')
+        os.mkdir(soft_outdir)
+        with open(os.path.join(soft_outdir, 'GSE59813_family.soft.subset'), 'wb') as opf:
+            opf.write('^SAMPLE = GSM1446812\n'
+                      '!Sample_organism_ch1 = Mus musculus\n'
+                      '!Sample_organism_ch1 = Homo sapiens\n'
+                      '^SAMPLE = GSM1446813\n'
+                      '!Sample_organism_ch1 = Mus musculus\n'
+                      '!Sample_organism_ch2 = Homo sapiens\n')
+        # formatted the same as the other backends
+        self.assertEqual(
+            gen_csv.find_species_in_softs(self.input_csv, ['GSE59813'], self.temp_outdir),
+            {'GSM1446812': 'Homo sapiens; Mus musculus',
+             'GSM1446813': 'Homo sapiens; Mus musculus'})
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.get_soft.download_soft')
+    def test_find_species_in_softs_existing(self, mock_download_soft):
+        soft_outdir = os.path.join(self.temp_outdir, 'soft')
+        os.mkdir(soft_outdir)
+        with open(os.path.join(soft_outdir, 'GSE59813_family.soft.subset'), 'wb') as opf:
+            opf.write('^SAMPLE = GSM1446812\n!Sample_organism_ch1 = Homo sapiens\n')
+        self.assertEqual(
+            gen_csv.find_species_in_softs(self.input_csv, ['GSE59813'], self.temp_outdir),
+            {'GSM1446812': 'Homo sapiens'})
+        # reused without connecting to NCBI
+        self.assertFalse(mock_download_soft.called)
+
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.find_species')
+    def test_generate_csv_resumed(self, mock_find_species):
+        journal_file = os.path.join(self.temp_outdir, 'GSE_species_GSM.journal')
+        mock_find_species.side_effect = [
+            'Homo sapiens', IOError('connection reset'), 'Homo sapiens']
+        self.assertRaises(RuntimeError, gen_csv.generate_csv,
+                          self.input_csv, self.temp_outdir, num_threads=1)
+        with open(journal_file) as inf:
+            self.assertEqual(len(inf.readlines()), 2)
+        # interrupted while writing a line
+        with open(journal_file, 'ab') as opf:
+            opf.write('GSE61491,Homo')
+
+        mock_find_species.reset_mock()
+        mock_find_species.side_effect = None
+        mock_find_species.return_value = 'Mus musculus'
+        gen_csv.generate_csv(self.input_csv, self.temp_outdir, num_threads=1)
+        # only the one failed is looked up again
+        self.assertEqual(mock_find_species.call_count, 1)
+        self.assertEqual(mock_find_species.call_args[0][:2],
+                         ('GSE61491', 'GSM1506106'))
+        with open(os.path.join(self.temp_outdir, 'GSE_species_GSM.csv')) as inf:
+            self.assertEqual(inf.read(), 'GSE59813,Homo sapiens,GSM1446812\n'
+                             'GSE61491,Homo sapiens,GSM1506107\n'
+                             'GSE61491,Mus musculus,GSM1506106\n')
+        # merged into the csv
+        self.assertFalse(os.path.exists(journal_file))
+
+    def test_read_journal(self):
+        journal_file = os.path.join(self.temp_outdir, 'GSE_species_GSM.journal')
+        journal = gen_csv.Journal(journal_file)
+        journal.record('GSE1', u'Homo sapiens', 'GSM1')
+        journal.record('GSE1', None, 'GSM2')
+        journal.close()
+        self.assertEqual(gen_csv.read_journal(journal_file),
+                         {'GSM1': 'Homo sapiens', 'GSM2': None})
+        self.assertEqual(gen_csv.read_journal('non_existent'), {})
+
+
+GSM_HTML = """<html><body>
+<table>
+<tr valign="top"><td nowrap>Status</td>
+<td nowrap>Public on Jul 31, 2014</td>
+</tr>
+<tr valign="top"><td nowrap>Organism</td>
+<td><a href="/Taxonomy/Browser/wwwtax.cgi?mode=Info&amp;id=9606" onmouseout="onLinkOut('HelpMessage' , geo_empty_help)">Homo sapiens</a></td>
+</tr>
+</table>
+{0}
+</body></html>
+"""
+
+
+class FindSpeciesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_outdir = tempfile.mkdtemp()
+        self.gse_dir = gen_csv.gen_gse_dir(self.temp_outdir, 'GSE1')
+        self.gsm_html = os.path.join(self.gse_dir, 'GSM1.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_outdir)
+
+    def write_html(self, content):
+        with open(self.gsm_html, 'wb') as opf:
+            opf.write(content)
+
+    def test_extract_species(self):
+        self.write_html(GSM_HTML.format(''))
+        self.assertEqual(gen_csv.extract_species(self.gsm_html), 'Homo sapiens')
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.HTML_CHUNK_SIZE', 50)
+    def test_extract_species_across_chunks(self):
+        self.write_html(GSM_HTML.format('x' * 1000))
+        self.assertEqual(gen_csv.extract_species(self.gsm_html), 'Homo sapiens')
+
+    def test_extract_species_multiple_organisms(self):
+        self.write_html('<tr><td nowrap>Organisms</td>\n<td><a href="#">Homo sapiens</a>'
+                        '<br><a href="#">Mus &amp; musculus</a></td></tr>')
+        self.assertEqual(gen_csv.extract_species(self.gsm_html),
+                         'Homo sapiens; Mus & musculus')
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.HTML_CHUNK_SIZE', 50)
+    def test_extract_species_two_channels(self):
+        self.write_html('<table><tr><td>Channel 1</td></tr>'
+                        '<tr><td nowrap>Organism</td>\n<td><a>Mus musculus</a></td></tr>'
+                        + 'x' * 200 +
+                        '<tr><td>Channel 2</td></tr>'
+                        '<tr><td nowrap>Organism</td>\n<td><a>Homo sapiens</a></td></tr>'
+                        '</table>')
+        self.assertEqual(gen_csv.extract_species(self.gsm_html),
+                         'Homo sapiens; Mus musculus')
+
+    def test_extract_species_not_found(self):
+        # e.g. a private GSM
+        self.write_html('<html>Could not find a public or private accession</html>')
+        self.assertIsNone(gen_csv.extract_species(self.gsm_html))
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.download_html')
+    def test_find_species_cached(self, mock_download_html):
+        self.write_html(GSM_HTML.format(''))
+        self.assertEqual(gen_csv.find_species('GSE1', 'GSM1', self.temp_outdir),
+                         'Homo sapiens')
+        os.remove(self.gsm_html)
+        # from GSM1.species without the html
+        with mock.patch('rsempipeline.preprocess.gen_csv.extract_species') as mock_extract:
+            self.assertEqual(gen_csv.find_species('GSE1', 'GSM1', self.temp_outdir),
+                             'Homo sapiens')
+            self.assertFalse(mock_extract.called)
+        self.assertFalse(mock_download_html.called)
+
+    def test_find_species_not_found_cached(self):
+        self.write_html('<html></html>')
+        self.assertIsNone(gen_csv.find_species('GSE1', 'GSM1', self.temp_outdir))
+        with open(os.path.join(self.gse_dir, 'GSM1.species')) as inf:
+            self.assertEqual(inf.read(), '')
+        self.assertIsNone(gen_csv.find_species('GSE1', 'GSM1', self.temp_outdir))
+
+    @mock.patch('rsempipeline.preprocess.gen_csv.fetch_html')
+    def test_find_species_in_cache(self, mock_fetch_html):
+        cache = PackedCache(os.path.join(self.temp_outdir, 'html_cache.db'))
+        try:
+            mock_fetch_html.return_value = GSM_HTML.format('')
+            self.assertEqual(gen_csv.find_species('GSE1', 'GSM1', self.temp_outdir,
+                                                  cache=cache), 'Homo sapiens')
+            self.assertEqual(cache.get_species('GSM1'), (True, 'Homo sapiens'))
+            self.assertEqual(gen_csv.find_species('GSE1', 'GSM1', self.temp_outdir,
+                                                  cache=cache), 'Homo sapiens')
+            self.assertEqual(mock_fetch_html.call_count, 1)
+            # nothing written to html/GSE1/
+            self.assertEqual(os.listdir(self.gse_dir), [])
+        finally:
+            cache.close()
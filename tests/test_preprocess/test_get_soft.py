@@ -1,5 +1,11 @@
 import os
+import gzip
+import shutil
+import ftplib
+import tempfile
+import threading
 import unittest
+import StringIO
 
 import mock
 from testfixtures import log_capture
@@ -52,135 +58,224 @@ class SOFTDownloaderTestCase(unittest.TestCase):
 
     def test_retrieve(self):
         mock_open = mock.mock_open()
+        content = gen_soft_gz(self.gse1, ['GSM1'])
+        def retrbinary(cmd, callback):
+            # in tiny chunks to split lines and the gzip header
+            for k in range(0, len(content), 7):
+                callback(content[k:k + 7])
+        self.der.ftp_handler.retrbinary.side_effect = retrbinary
+        self.der.ftp_handler.size.return_value = len(content)
         with mock.patch('rsempipeline.preprocess.get_soft.open', mock_open):
             self.der.retrieve('the_path', 'the.soft.gz', 'the_output')
         mock_open.assert_called_once_with('the_output', 'wb')
         self.der.ftp_handler.cwd.assert_called_with('the_path')
+        self.assertEqual(self.der.ftp_handler.retrbinary.call_args[0][0],
+                         'RETR the.soft.gz')
         fd = mock_open.return_value.__enter__.return_value
-        cmd = 'RETR the.soft.gz'
-        self.der.ftp_handler.retrbinary.assert_called_with(cmd, fd.write)
+        self.assertEqual(''.join(_[0][0] for _ in fd.write.call_args_list),
+                         '^SERIES = GSE45284\n^SAMPLE = GSM1\n'
+                         '!Sample_organism_ch1 = Homo sapiens\n')
+        self.assertEqual(self.der.num_bytes, len(content))
 
     @mock.patch('rsempipeline.preprocess.get_soft.open')
-    def test_retrieve2(self, mock_open):
-        """supposed to have the same testing purpose as self.test_retrieve, but using
-        patch as a decorator instead of context manager
-        """
-        # mock_open.return_value = mock.MagicMock(spec=file)
-        self.der.retrieve('the_path', 'the.soft.gz', 'the_output')
-        mock_open.assert_called_once_with('the_output', 'wb')
-        self.der.ftp_handler.cwd.assert_called_with('the_path')
-        cmd = 'RETR the.soft.gz'
-        fd = mock_open.return_value.__enter__.return_value
-        self.der.ftp_handler.retrbinary.assert_called_with(cmd, fd.write)
+    def test_retrieve_truncated(self, mock_open):
+        content = gen_soft_gz(self.gse1, ['GSM1'])
+        self.der.ftp_handler.retrbinary.side_effect = (
+            lambda cmd, callback: callback(content[:-10]))
+        self.der.ftp_handler.size.return_value = len(content)
+        self.assertRaises(IOError, self.der.retrieve,
+                          'the_path', 'the.soft.gz', 'the_output')
 
+    @mock.patch.object(get_soft.os, 'rename')
     @mock.patch.object(get_soft.SOFTDownloader, 'retrieve')
     @log_capture()
-    def test_download_soft_gz(self, mock_retrieve, L):
-        res = self.der.download_soft_gz(self.gse1, 'any_outdir')
-        self.assertEqual(res, 'any_outdir/GSE45284_family.soft.gz')
-        args = ('/geo/series/GSE45nnn/GSE45284/soft', 'GSE45284_family.soft.gz', res)
+    def test_download_soft_subset(self, mock_retrieve, mock_rename, L):
+        subset = 'any_outdir/GSE45284_family.soft.subset'
+        res = self.der.download_soft_subset(self.gse1, subset)
+        self.assertEqual(res, subset)
+        args = ('/geo/series/GSE45nnn/GSE45284/soft', 'GSE45284_family.soft.gz',
+                subset + '.tmp')
         mock_retrieve.assert_called_once_with(*args)
+        mock_rename.assert_called_once_with(subset + '.tmp', subset)
         L.check(('rsempipeline.preprocess.get_soft', 'INFO',
-                 'downloading GSE45284_family.soft.gz from ftp://ftp.ncbi.nlm.nih.gov/geo/series/GSE45nnn/GSE45284/soft/GSE45284_family.soft.gz to any_outdir/GSE45284_family.soft.gz'))
+                 'downloading GSE45284_family.soft.gz from ftp://ftp.ncbi.nlm.nih.gov/geo/series/GSE45nnn/GSE45284/soft/GSE45284_family.soft.gz and extracting to any_outdir/GSE45284_family.soft.subset'))
 
         # when retrieve raises Exception
         mock_retrieve.side_effect = Exception()
-        res = self.der.download_soft_gz(self.gse1, 'any_outdir')
+        res = self.der.download_soft_subset(self.gse1, subset)
         self.assertIsNone(res)
         mock_retrieve.assert_called_with(*args)
         self.assertEqual(mock_retrieve.call_count, 2)
+        self.assertEqual(mock_rename.call_count, 1)
         self.assertIn('error when downloading', str(L))
 
     def test_get_soft_subset(self):
         self.assertEqual(self.der.get_soft_subset(self.gse1, 'any_outdir'),
                          'any_outdir/GSE45284_family.soft.subset')
 
-    @log_capture()
-    def test_gunzip_and_extract_soft(self, L):
-        import StringIO
-        soft_gz = 'any_dir/the.soft.gz'
-        soft_subset = 'any_dir/the.soft.subset'
-        mock_open = mock.mock_open()
-        mock_gzip_open = mock.mock_open(read_data='\n'.join(
-            ['^SERIES = GSE67763',
-             '!Sample_instrument_model = Illumina HiSeq 2000',
-             '!Sample_library_strategy = RNA-Seq']))
-        # NOTE: mock_open() object does indeed not implement iteration, see
-        # http://stackoverflow.com/questions/24779893/customizing-unittest-mock-mock-open-for-iteration
-        mock_gzip_open.return_value.__iter__ = lambda self: StringIO.StringIO(self.read())
-        mock_gzip_open.return_value.__next__ = lambda self: self.readline()
-        with mock.patch('rsempipeline.preprocess.get_soft.open', mock_open):
-            with mock.patch('rsempipeline.preprocess.get_soft.gzip.open', mock_gzip_open):
-                self.der.gunzip_and_extract_soft(soft_gz, soft_subset)
-        mock_open.assert_called_once_with(soft_subset, 'wb')
-        mock_gzip_open.assert_called_once_with(soft_gz, 'rb')
-        handle = mock_open()
-        # print mock_open.mock_calls
-        # print mock_gzip_open.mock_calls
-        self.assertTrue(handle.write.called)
-        L.check(('rsempipeline.preprocess.get_soft', 'INFO',
-                 'gunziping and extracting from any_dir/the.soft.gz to any_dir/the.soft.subset'))
-
-    # def test_gunzip_and_extract_soft_with_real_gz_files(self):
-    #     # to be written
-    #     pass
+    def test_soft_subset_filter(self):
+        opf = StringIO.StringIO()
+        subset_filter = get_soft.SOFTSubsetFilter(opf)
+        # without a trailing newline
+        content = gen_soft_gz(self.gse1, ['GSM1', 'GSM2'], tail='!Sample_type = SRA')
+        for char in content:
+            subset_filter.feed(char)
+        subset_filter.close()
+        self.assertEqual(opf.getvalue(),
+                         '^SERIES = GSE45284\n'
+                         '^SAMPLE = GSM1\n!Sample_organism_ch1 = Homo sapiens\n'
+                         '^SAMPLE = GSM2\n!Sample_organism_ch1 = Homo sapiens\n'
+                         '!Sample_type = SRA')
 
     @mock.patch.object(get_soft.os.path, 'exists')
-    @mock.patch.object(get_soft.SOFTDownloader, 'download_soft_gz', autospec=True)
+    @mock.patch.object(get_soft.SOFTDownloader, 'download_soft_subset', autospec=True)
     @log_capture()
     def test_gen_soft_with_already_existing_soft_subset(
-            self, mock_download_soft_gz, mock_exists, L):
+            self, mock_download_soft_subset, mock_exists, L):
         mock_exists.return_value = True
         self.der.gen_soft(self.gse1, 'any_outdir')
-        self.assertFalse(mock_download_soft_gz.called)
+        self.assertFalse(mock_download_soft_subset.called)
         L.check(('rsempipeline.preprocess.get_soft', 'INFO',
                  'any_outdir/GSE45284_family.soft.subset has already existed'))
 
-
-    @mock.patch.object(get_soft.os, 'remove')
     @mock.patch.object(get_soft.os.path, 'exists')
-    @mock.patch.object(get_soft.SOFTDownloader, 'gunzip_and_extract_soft')
-    @mock.patch.object(get_soft.SOFTDownloader, 'download_soft_gz')
-    @log_capture()
-    def test_gen_soft_without_existing_soft_subset_with_successful_download_soft_gz(
-            self,
-            mock_download_soft_gz,
-            mock_gunzip_and_extract_soft,
-            mock_exists,
-            mock_remove,
-            L):
-        gz = 'any_outdir/GSE45284_family.soft.gz'
+    @mock.patch.object(get_soft.SOFTDownloader, 'download_soft_subset')
+    def test_gen_soft_without_existing_soft_subset(
+            self, mock_download_soft_subset, mock_exists):
         subset = 'any_outdir/GSE45284_family.soft.subset'
         mock_exists.return_value = False
-        mock_download_soft_gz.return_value = gz
+        mock_download_soft_subset.return_value = subset
         res = self.der.gen_soft(self.gse1, 'any_outdir')
         self.assertEqual(res, subset)
-        mock_download_soft_gz.assert_called_with(self.gse1, 'any_outdir')
-        mock_gunzip_and_extract_soft.assert_called_with(gz, subset)
-        mock_remove.assert_called_with(gz)
-        L.check(('rsempipeline.preprocess.get_soft', 'INFO',
-                 'removing any_outdir/GSE45284_family.soft.gz'))
+        mock_download_soft_subset.assert_called_once_with(self.gse1, subset)
 
+        # when downloading fails
+        mock_download_soft_subset.return_value = None
+        self.assertIsNone(self.der.gen_soft(self.gse1, 'any_outdir'))
+
+
+def gen_soft_gz(gse, gsms, tail=''):
+    out = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as opf:
+        opf.write('^SERIES = {0}\n!Series_title = whatever\n'.format(gse))
+        for gsm in gsms:
+            opf.write('^SAMPLE = {0}\n!Sample_organism_ch1 = Homo sapiens\n'
+                      '!Sample_characteristics_ch1 = skipped\n'.format(gsm))
+        opf.write(tail)
+    return out.getvalue()
+
+
+class FakeFTP(object):
+    """
+    a stand-in for ftplib.FTP serving soft.gz files from memory, which fails
+    the first few retrievals of a file as configured
+    """
+    files = {}                  # {remote path: content}
+    failures = {}               # {remote path: number of failures left}
+    num_connections = 0
+    max_connections = 0
+    lock = threading.Lock()
+
+    def __init__(self, host, timeout=None):
+        self.cwd_path = None
+        with self.lock:
+            FakeFTP.num_connections += 1
+            FakeFTP.max_connections = max(FakeFTP.max_connections,
+                                          FakeFTP.num_connections)
+
+    def login(self):
+        pass
+
+    def cwd(self, path):
+        self.cwd_path = path
+
+    def retrbinary(self, cmd, callback, blocksize=8192):
+        path = os.path.join(self.cwd_path, cmd.split()[1])
+        with self.lock:
+            if self.failures.get(path):
+                self.failures[path] -= 1
+                raise ftplib.error_temp('425 Can\'t open data connection')
+        if path not in self.files:
+            raise ftplib.error_perm('550 No such file')
+        content = self.files[path]
+        for k in range(0, len(content), blocksize):
+            # give the other threads a chance to overlap
+            threading.Event().wait(0.001)
+            callback(content[k:k + blocksize])
+
+    def size(self, filename):
+        return len(self.files[os.path.join(self.cwd_path, filename)])
+
+    def quit(self):
+        with self.lock:
+            FakeFTP.num_connections -= 1
+
+
+@mock.patch.object(get_soft, 'BACKOFF', 0)
+@mock.patch.object(get_soft, 'FTP', FakeFTP)
+class DownloadSoftsTestCase(unittest.TestCase):
+    gses = ['GSE45284', 'GSE50000', 'GSE50001', 'GSE61491']
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        FakeFTP.files = dict(
+            ('/geo/series/{0}nnn/{1}/soft/{1}_family.soft.gz'.format(_[:-3], _),
+             gen_soft_gz(_, ['GSM{0}1'.format(_[3:])]))
+            for _ in self.gses)
+        FakeFTP.failures = {}
+        FakeFTP.num_connections = 0
+        FakeFTP.max_connections = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_download_softs_concurrently(self):
+        failed = get_soft.download_softs(self.gses, self.outdir, num_workers=2)
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(os.listdir(self.outdir)),
+                         ['{0}_family.soft.subset'.format(_) for _ in self.gses])
+        with open(os.path.join(self.outdir, 'GSE45284_family.soft.subset')) as inf:
+            self.assertEqual(inf.read(), '^SERIES = GSE45284\n'
+                             '^SAMPLE = GSM452841\n'
+                             '!Sample_organism_ch1 = Homo sapiens\n')
+        # one connection per worker, all closed in the end
+        self.assertEqual(FakeFTP.max_connections, 2)
+        self.assertEqual(FakeFTP.num_connections, 0)
 
-    @mock.patch.object(get_soft.os, 'remove')
-    @mock.patch.object(get_soft.os.path, 'exists')
-    @mock.patch.object(get_soft.SOFTDownloader, 'gunzip_and_extract_soft')
-    @mock.patch.object(get_soft.SOFTDownloader, 'download_soft_gz')
     @log_capture()
-    def test_gen_soft_without_existing_soft_subset_with_unsuccessful_download_soft_gz(
-            self,
-            mock_download_soft_gz,
-            mock_gunzip_and_extract_soft,
-            mock_exists,
-            mock_remove,
-            L):
-        mock_exists.return_value = False
-        mock_download_soft_gz.return_value = None
-        res = self.der.gen_soft(self.gse1, 'any_outdir')
-        self.assertIsNone(res)
-        mock_download_soft_gz.assert_called_with(self.gse1, 'any_outdir')
-        self.assertFalse(mock_gunzip_and_extract_soft.called)
-        self.assertFalse(mock_remove.called)
+    def test_download_softs_retried(self, L):
+        path = '/geo/series/GSE50nnn/GSE50000/soft/GSE50000_family.soft.gz'
+        FakeFTP.failures[path] = 2
+        failed = get_soft.download_softs(self.gses, self.outdir, num_workers=2,
+                                         max_retries=2)
+        self.assertEqual(failed, [])
+        self.assertEqual(FakeFTP.failures[path], 0)
+        self.assertEqual(len(os.listdir(self.outdir)), 4)
+        self.assertIn('retrying GSE50000 in 0s (2/2)', str(L))
+        self.assertIn('4/4 soft files downloaded', str(L))
+
+    def test_download_softs_failed(self):
+        path = '/geo/series/GSE50nnn/GSE50000/soft/GSE50000_family.soft.gz'
+        FakeFTP.failures[path] = 2
+        del FakeFTP.files['/geo/series/GSE61nnn/GSE61491/soft/GSE61491_family.soft.gz']
+        failed = get_soft.download_softs(self.gses, self.outdir, num_workers=3,
+                                         max_retries=1)
+        self.assertEqual(sorted(failed), ['GSE50000', 'GSE61491'])
+        # no partial soft.subset is left behind, nor is any soft.gz written
+        self.assertEqual(sorted(os.listdir(self.outdir)),
+                         ['GSE45284_family.soft.subset',
+                          'GSE50001_family.soft.subset'])
+        self.assertEqual(FakeFTP.num_connections, 0)
+
+    def test_download_soft_skips_existing(self):
+        input_csv = os.path.join(self.outdir, 'GSE_GSM.csv')
+        with open(input_csv, 'wb') as opf:
+            opf.write('GSE45284,GSM452841\nGSE50000,GSM500001; GSM500002\n')
+        open(os.path.join(self.outdir, 'GSE45284_family.soft.subset'), 'wb').close()
+        with mock.patch.object(get_soft, 'download_softs') as mock_download_softs:
+            mock_download_softs.return_value = []
+            get_soft.download_soft(input_csv, self.outdir, 4, 1)
+        mock_download_softs.assert_called_once_with(['GSE50000'], self.outdir, 4, 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from rsempipeline.preprocess import packed_cache as PC
+
+
+class PackedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = PC.PackedCache(os.path.join(self.temp_dir, 'html_cache.db'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_html(self):
+        self.assertIsNone(self.cache.get_html('GSM1'))
+        self.cache.put_html('GSE1', 'GSM1', '<html>GSM1</html>')
+        self.assertEqual(self.cache.get_html('GSM1'), '<html>GSM1</html>')
+
+    def test_species(self):
+        self.assertEqual(self.cache.get_species('GSM1'), (False, None))
+        self.cache.put_html('GSE1', 'GSM1', '<html>GSM1</html>')
+        self.assertEqual(self.cache.get_species('GSM1'), (False, None))
+        self.cache.put_species('GSE1', 'GSM1', 'Homo sapiens')
+        self.assertEqual(self.cache.get_species('GSM1'), (True, 'Homo sapiens'))
+        # e.g. a private GSM
+        self.cache.put_species('GSE1', 'GSM2', None)
+        self.assertEqual(self.cache.get_species('GSM2'), (True, None))
+        # the html is kept
+        self.assertEqual(self.cache.get_html('GSM1'), '<html>GSM1</html>')
+
+    def test_concurrent_writes(self):
+        def put(k):
+            for i in range(50):
+                gsm = 'GSM{0}'.format(k * 100 + i)
+                self.cache.put_html('GSE1', gsm, '<html>{0}</html>'.format(gsm))
+                self.cache.put_species('GSE1', gsm, 'Homo sapiens')
+        threads = [threading.Thread(target=put, args=(_,)) for _ in range(4)]
+        for thrd in threads:
+            thrd.start()
+        for thrd in threads:
+            thrd.join()
+        self.assertEqual(self.cache.get_html('GSM349'), '<html>GSM349</html>')
+        self.assertEqual(self.cache.get_species('GSM0'), (True, 'Homo sapiens'))
+
+    def test_import_export(self):
+        html_dir = os.path.join(self.temp_dir, 'html')
+        os.makedirs(os.path.join(html_dir, 'GSE1'))
+        for basename, content in [('GSM1.html', '<html>GSM1</html>'),
+                                  ('GSM1.species', 'Homo sapiens'),
+                                  ('GSM2.html', '<html>GSM2</html>'),
+                                  ('GSM2.species', ''),
+                                  ('GSM3.html', '<html>GSM3</html>'),
+                                  ('GSM4.html.tmp', 'half written')]:
+            with open(os.path.join(html_dir, 'GSE1', basename), 'wb') as opf:
+                opf.write(content)
+        self.assertEqual(self.cache.import_dir(html_dir), 3)
+        self.assertEqual(self.cache.get_species('GSM1'), (True, 'Homo sapiens'))
+        self.assertEqual(self.cache.get_species('GSM2'), (True, None))
+        self.assertEqual(self.cache.get_species('GSM3'), (False, None))
+        self.assertIsNone(self.cache.get_html('GSM4'))
+
+        out_dir = os.path.join(self.temp_dir, 'exported')
+        self.assertEqual(self.cache.export_dir(out_dir), 3)
+        self.assertEqual(sorted(os.listdir(os.path.join(out_dir, 'GSE1'))),
+                         ['GSM1.html', 'GSM1.species', 'GSM2.html',
+                          'GSM2.species', 'GSM3.html'])
+        with open(os.path.join(out_dir, 'GSE1', 'GSM1.species')) as inf:
+            self.assertEqual(inf.read(), 'Homo sapiens')
+        with open(os.path.join(out_dir, 'GSE1', 'GSM3.html')) as inf:
+            self.assertEqual(inf.read(), '<html>GSM3</html>')
+
+    def test_main(self):
+        os.makedirs(os.path.join(self.temp_dir, 'html', 'GSE1'))
+        with open(os.path.join(self.temp_dir, 'html', 'GSE1', 'GSM1.html'), 'wb') as opf:
+            opf.write('<html>GSM1</html>')
+        PC.main(mock.Mock(outdir=self.temp_dir, action='import'))
+        self.assertEqual(self.cache.get_html('GSM1'), '<html>GSM1</html>')
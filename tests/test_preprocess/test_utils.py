@@ -148,5 +148,15 @@ GSE2,GSM20; GSM21; GSM22;
              'If unsure of the correct format, check {0}'.format(os.path.join(SHARE_DIR, 'GSE_GSM.example.csv'))),
         )
 
+
+class UtilsJoinSpeciesTestCase(unittest.TestCase):
+    def test_join_species(self):
+        self.assertEqual(utils.join_species(['Mus musculus', ' Homo sapiens ',
+                                             'Mus musculus', '']),
+                         'Homo sapiens; Mus musculus')
+        self.assertEqual(utils.join_species(['Homo sapiens']), 'Homo sapiens')
+        self.assertIsNone(utils.join_species([]))
+
+
 if __name__ == "__main__":
     unittest.main()
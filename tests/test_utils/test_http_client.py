@@ -0,0 +1,102 @@
+import time
+import threading
+import unittest
+import BaseHTTPServer
+
+import requests
+
+from rsempipeline.utils import http_client as HC
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.num_requests += 1
+        server.clients.add(self.client_address)
+        status = server.statuses.pop(0) if server.statuses else 200
+        body = 'GSM{0}'.format(server.num_requests)
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.num_requests = 0
+        self.server.clients = set()
+        self.server.statuses = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        client = HC.HTTPClient(rate=1000)
+        for _ in range(5):
+            self.assertEqual(client.get(self.url).status_code, 200)
+        # a single connection reused for all requests
+        self.assertEqual(len(self.server.clients), 1)
+        client.close()
+
+    def test_retry(self):
+        self.server.statuses = [503, 429]
+        client = HC.HTTPClient(rate=1000, backoff=0.01)
+        self.assertEqual(client.get(self.url).text, 'GSM3')
+        client.close()
+
+    def test_retry_exhausted(self):
+        self.server.statuses = [500] * 3
+        client = HC.HTTPClient(rate=1000, max_retries=2, backoff=0.01)
+        self.assertRaises(requests.HTTPError, client.get, self.url)
+        self.assertEqual(self.server.num_requests, 3)
+        client.close()
+
+    def test_not_retried(self):
+        self.server.statuses = [404]
+        client = HC.HTTPClient(rate=1000, backoff=0.01)
+        self.assertRaises(requests.HTTPError, client.get, self.url)
+        self.assertEqual(self.server.num_requests, 1)
+        client.close()
+
+    def test_connection_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        client = HC.HTTPClient(rate=1000, max_retries=1, backoff=0.01)
+        self.assertRaises(requests.ConnectionError, client.get, self.url)
+        # for tearDown
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever).start()
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_rate(self):
+        bucket = HC.TokenBucket(20)
+        bt = time.time()
+        threads = [threading.Thread(target=bucket.acquire) for _ in range(11)]
+        for _ in threads:
+            _.start()
+        for _ in threads:
+            _.join()
+        # the first one is free, the other 10 take 0.5s at 20/s
+        self.assertGreaterEqual(time.time() - bt, 0.45)
+        self.assertLess(time.time() - bt, 2)
+
+    def test_get_retry_after(self):
+        response = requests.Response()
+        self.assertIsNone(HC.get_retry_after(response))
+        response.headers['Retry-After'] = '2'
+        self.assertEqual(HC.get_retry_after(response), 2)
@@ -0,0 +1,125 @@
+import os
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+
+import mock
+import yaml
+
+from rsempipeline.utils import lease as LS
+
+
+class LeaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, '.rp-run.lease')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_lease(self, host, pid, age=0):
+        with open(self.path, 'wb') as opf:
+            yaml.safe_dump({'host': host, 'pid': pid, 'acquired_at': 0}, opf)
+        then = time.time() - age
+        os.utime(self.path, (then, then))
+
+    def test_acquire_and_release(self):
+        lease = LS.Lease(self.path, 60)
+        self.assertTrue(lease.acquire())
+        holder = lease.read()
+        self.assertEqual(holder['pid'], os.getpid())
+        self.assertEqual(holder['host'], socket.gethostname())
+        # not twice
+        self.assertFalse(LS.Lease(self.path, 60).acquire())
+        lease.release()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(LS.Lease(self.path, 60).acquire())
+
+    def test_acquire_held_by_live_holder_on_another_host(self):
+        self.write_lease('another_host', 1)
+        self.assertFalse(LS.Lease(self.path, 60).acquire())
+
+    def test_acquire_expired(self):
+        self.write_lease('another_host', 1, age=120)
+        lease = LS.Lease(self.path, 60)
+        self.assertTrue(lease.acquire())
+        self.assertEqual(lease.read()['pid'], os.getpid())
+        self.assertEqual(os.listdir(self.tmp_dir), ['.rp-run.lease'])
+
+    def test_acquire_expired_broken_by_another_contender_in_between(self):
+        self.write_lease('another_host', 1, age=120)
+        lease_a, lease_b = LS.Lease(self.path, 60), LS.Lease(self.path, 60)
+        read = lease_a.read
+
+        def interleaved_read(path=None):
+            if path is not None:
+                return read(path)
+            # A sees the stale holder, then B breaks it and acquires first
+            holder = read()
+            self.assertTrue(lease_b.acquire())
+            return holder
+        with mock.patch.object(lease_a, 'read', side_effect=interleaved_read):
+            self.assertFalse(lease_a.acquire())
+        self.assertFalse(lease_a.held)
+        # B's lease is put back
+        self.assertEqual(os.listdir(self.tmp_dir), ['.rp-run.lease'])
+        holder = LS.Lease(self.path, 60).read()
+        self.assertEqual(holder['host'], socket.gethostname())
+        self.assertNotEqual(holder['acquired_at'], 0)
+
+    @mock.patch('rsempipeline.utils.lease.is_alive', autospec=True)
+    def test_acquire_held_by_dead_process_on_the_same_host(self, mock_is_alive):
+        mock_is_alive.return_value = False
+        self.write_lease(socket.gethostname(), 99999)
+        self.assertTrue(LS.Lease(self.path, 60).acquire())
+        mock_is_alive.assert_called_once_with(99999)
+
+    def test_renew(self):
+        lease = LS.Lease(self.path, 60)
+        lease.acquire()
+        os.utime(self.path, (0, 0))
+        lease.renew()
+        self.assertGreater(os.path.getmtime(self.path), time.time() - 10)
+
+    def test_is_alive(self):
+        self.assertTrue(LS.is_alive(os.getpid()))
+
+
+class LeaseKeeperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.tmp_dir, _) for _ in ['a', 'b']]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_keeper(self):
+        keeper = LS.LeaseKeeper(60, 0.05)
+        keeper.start()
+        self.assertTrue(keeper.acquire(self.paths[0]))
+        other = LS.LeaseKeeper(60, 0.05)
+        self.assertTrue(other.is_held_by_others(self.paths[0]))
+        self.assertFalse(other.is_held_by_others(self.paths[1]))
+        self.assertFalse(other.acquire(self.paths[0]))
+        # heartbeat
+        os.utime(self.paths[0], (0, 0))
+        time.sleep(0.2)
+        self.assertGreater(os.path.getmtime(self.paths[0]), time.time() - 10)
+        keeper.release_all()
+        self.assertFalse(os.path.exists(self.paths[0]))
+        self.assertTrue(other.acquire(self.paths[0]))
+        other.release_all()
+
+    def test_keeper_release(self):
+        keeper = LS.LeaseKeeper(60, 60)
+        path = self.paths[0]
+        self.assertTrue(keeper.acquire(path))
+        self.assertTrue(keeper.holds(path))
+        # not held by others from the point of view of the holder
+        self.assertFalse(keeper.is_held_by_others(path))
+        self.assertTrue(LS.LeaseKeeper(60, 60).is_held_by_others(path))
+        keeper.release(path)
+        self.assertFalse(keeper.holds(path))
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,190 @@
+import os
+import time
+import shutil
+import sqlite3
+import datetime
+import tempfile
+import unittest
+
+from testfixtures import log_capture
+
+from rsempipeline.utils import ledger as LG
+
+
+class LedgerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'transfer_ledger.db')
+        self.ledger = LG.Ledger(self.db_file)
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record(self):
+        gsm_id = 'rsem_output/GSE1/homo_sapiens/GSM1'
+        self.ledger.record([gsm_id], LG.SELECTED, 100)
+        self.ledger.record([gsm_id], LG.RSYNC_STARTED, 110, bytes_={gsm_id: 1024})
+        self.ledger.record([gsm_id], LG.TRANSFERRED, 150)
+        row = self.ledger.get(gsm_id)
+        self.assertEqual(row['gsm'], 'GSM1')
+        self.assertEqual(row['stage'], LG.TRANSFERRED)
+        self.assertEqual(row['bytes'], 1024)
+        self.assertEqual(row['selected_at'], 100)
+        self.assertEqual(row['transferred_at'], 150)
+        self.assertIsNone(row['submitted_at'])
+
+    def test_record_stage_never_goes_backwards(self):
+        self.ledger.record(['GSM1'], LG.TRANSFERRED, 100)
+        # e.g. selected again after the ledger was imported
+        self.ledger.record(['GSM1'], LG.SELECTED, 200)
+        row = self.ledger.get('GSM1')
+        self.assertEqual(row['stage'], LG.TRANSFERRED)
+        self.assertEqual(row['selected_at'], 200)
+
+    def test_record_failed(self):
+        self.ledger.record(['GSM1'], LG.SUBMITTED, 100)
+        self.ledger.record(['GSM1'], LG.FAILED, 200)
+        self.assertEqual(self.ledger.get('GSM1')['stage'], LG.FAILED)
+        self.assertEqual(self.ledger.get_gsm_ids(LG.SUBMITTED), [])
+        # e.g. rerun on the cluster by hand
+        self.ledger.record(['GSM1'], LG.COMPLETED, 300)
+        self.assertEqual(self.ledger.get('GSM1')['stage'], LG.COMPLETED)
+        self.ledger.record(['GSM1'], LG.FAILED, 400)
+        self.assertEqual(self.ledger.get('GSM1')['stage'], LG.COMPLETED)
+
+    @log_capture('rsempipeline.utils.ledger')
+    def test_log_summary_failed(self, L):
+        self.ledger.record(['GSM1', 'GSM2'], LG.SUBMITTED, 100)
+        self.ledger.record(['GSM1'], LG.FAILED, 200)
+        self.ledger.log_summary()
+        self.assertIn('failed: 1', str(L))
+        self.assertIn('1 GSMs failed remotely without rsem.COMPLETE', str(L))
+
+    def test_record_unknown_stage(self):
+        self.assertRaises(ValueError, self.ledger.record, ['GSM1'], 'whatever')
+
+    def test_get_nonexistent(self):
+        self.assertIsNone(self.ledger.get('GSM1'))
+
+    def test_get_gsms(self):
+        self.ledger.record(['a/GSM1', 'a/GSM2'], LG.SELECTED)
+        self.ledger.record(['a/GSM1'], LG.TRANSFERRED)
+        self.assertEqual(self.ledger.get_gsms(LG.TRANSFERRED), set(['GSM1']))
+        self.assertEqual(self.ledger.get_gsms(LG.SELECTED), set(['GSM1', 'GSM2']))
+        self.assertEqual(self.ledger.get_gsm_ids(LG.SELECTED), ['a/GSM2'])
+
+    def test_count_by_stage(self):
+        self.ledger.record(['GSM1', 'GSM2'], LG.SELECTED)
+        self.ledger.record(['GSM1'], LG.TRANSFERRED)
+        self.assertEqual(self.ledger.count_by_stage(),
+                         {LG.SELECTED: 1, LG.TRANSFERRED: 1})
+
+    def test_get_latencies(self):
+        self.ledger.record(['GSM1', 'GSM2'], LG.RSYNC_STARTED, 100,
+                           bytes_={'GSM1': 10, 'GSM2': 20})
+        self.ledger.record(['GSM1'], LG.TRANSFERRED, 130)
+        self.assertEqual(self.ledger.get_latencies(LG.RSYNC_STARTED, LG.TRANSFERRED),
+                         [('GSM1', 30, 10)])
+
+    def test_persistence(self):
+        self.ledger.record(['GSM1'], LG.TRANSFERRED)
+        self.ledger.close()
+        self.ledger = LG.Ledger(self.db_file)
+        self.assertEqual(self.ledger.get_gsms(LG.TRANSFERRED), set(['GSM1']))
+
+    def test_target(self):
+        self.ledger.record(['a/GSM1'], LG.SUBMITTED)
+        self.ledger.record(['a/GSM2'], LG.SELECTED, target='genesis')
+        self.ledger.record(['a/GSM2'], LG.SUBMITTED)
+        self.ledger.record(['a/GSM3'], LG.SELECTED, target='nestor')
+        self.ledger.record(['a/GSM3'], LG.SUBMITTED)
+        self.assertEqual(self.ledger.get('a/GSM2')['target'], 'genesis')
+        self.assertEqual(self.ledger.get_gsm_ids(LG.SUBMITTED, 'genesis'), ['a/GSM2'])
+        self.ledger.set_default_target('genesis')
+        self.assertEqual(self.ledger.get_gsm_ids(LG.SUBMITTED, 'genesis'),
+                         ['a/GSM1', 'a/GSM2'])
+        self.assertEqual(self.ledger.get_gsm_ids(LG.SUBMITTED, 'nestor'), ['a/GSM3'])
+
+    def test_get_throughput(self):
+        self.assertIsNone(self.ledger.get_throughput())
+        self.ledger.record(['GSM1'], LG.RSYNC_STARTED, 100, bytes_={'GSM1': 100},
+                           target='genesis')
+        self.ledger.record(['GSM2'], LG.RSYNC_STARTED, 100, bytes_={'GSM2': 300},
+                           target='nestor')
+        self.ledger.record(['GSM1', 'GSM2'], LG.TRANSFERRED, 110)
+        self.assertEqual(self.ledger.get_throughput(), 20)
+        self.assertEqual(self.ledger.get_throughput('genesis'), 10)
+        self.assertEqual(self.ledger.get_throughput('nestor'), 30)
+        self.assertIsNone(self.ledger.get_throughput('apollo'))
+
+    def test_get_throughput_of_batches(self):
+        # two GSMs transferred by one rsync in 10s
+        self.ledger.record(['GSM1', 'GSM2'], LG.RSYNC_STARTED, 100,
+                           bytes_={'GSM1': 100, 'GSM2': 100})
+        self.ledger.record(['GSM1', 'GSM2'], LG.TRANSFERRED, 110)
+        # and one more by another in 10s
+        self.ledger.record(['GSM3'], LG.RSYNC_STARTED, 200, bytes_={'GSM3': 200})
+        self.ledger.record(['GSM3'], LG.TRANSFERRED, 210)
+        self.assertEqual(self.ledger.get_throughput(), 20)
+
+    def test_add_target_column(self):
+        self.ledger.close()
+        os.remove(self.db_file)
+        conn = sqlite3.connect(self.db_file)
+        conn.execute('CREATE TABLE gsms (gsm_id TEXT PRIMARY KEY, '
+                     'gsm TEXT NOT NULL, stage TEXT NOT NULL, job_id TEXT, '
+                     'bytes INTEGER, {0})'.format(
+                         ', '.join('{0}_at REAL'.format(_) for _ in LG.LIFECYCLE)))
+        conn.execute("INSERT INTO gsms (gsm_id, gsm, stage) "
+                     "VALUES ('a/GSM1', 'GSM1', 'transferred')")
+        conn.commit()
+        conn.close()
+        self.ledger = LG.Ledger(self.db_file)
+        self.assertIsNone(self.ledger.get('a/GSM1')['target'])
+        self.assertIsNone(self.ledger.get('a/GSM1')['failed_at'])
+        self.ledger.record(['a/GSM1'], LG.SUBMITTED, target='genesis')
+        self.assertEqual(self.ledger.get('a/GSM1')['target'], 'genesis')
+
+
+class RecordFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.record_file = os.path.join(self.tmp_dir, 'transferred_GSMs.txt')
+        with open(self.record_file, 'wb') as opf:
+            opf.write('# 15-07-17 09:04:38\n'
+                      'rsem_output/GSE34736/homo_sapiens/GSM854343\n'
+                      'rsem_output/GSE34736/homo_sapiens/GSM854344\n'
+                      '\n'
+                      '# 15-07-18 10:00:00\n'
+                      'rsem_output/GSE34737/homo_sapiens/GSM854345\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_record_file(self):
+        when1 = time.mktime(datetime.datetime(2015, 7, 17, 9, 4, 38).timetuple())
+        when2 = time.mktime(datetime.datetime(2015, 7, 18, 10, 0, 0).timetuple())
+        self.assertEqual(LG.parse_record_file(self.record_file), [
+            ('rsem_output/GSE34736/homo_sapiens/GSM854343', when1),
+            ('rsem_output/GSE34736/homo_sapiens/GSM854344', when1),
+            ('rsem_output/GSE34737/homo_sapiens/GSM854345', when2)])
+
+    def test_open_ledger_imports_record_file(self):
+        db_file = os.path.join(self.tmp_dir, 'transfer_ledger.db')
+        ledger = LG.open_ledger(db_file, self.record_file)
+        self.assertEqual(ledger.get_gsms(LG.TRANSFERRED),
+                         set(['GSM854343', 'GSM854344', 'GSM854345']))
+        ledger.close()
+        # not imported again once the ledger exists
+        with open(self.record_file, 'ab') as opf:
+            opf.write('rsem_output/GSE34737/homo_sapiens/GSM854346\n')
+        ledger = LG.open_ledger(db_file, self.record_file)
+        self.assertNotIn('GSM854346', ledger.get_gsms(LG.TRANSFERRED))
+        ledger.close()
+
+    def test_open_ledger_without_record_file(self):
+        db_file = os.path.join(self.tmp_dir, 'transfer_ledger.db')
+        ledger = LG.open_ledger(db_file, os.path.join(self.tmp_dir, 'nonexistent.txt'))
+        self.assertEqual(ledger.get_gsms(LG.TRANSFERRED), set())
+        ledger.close()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rsempipeline.utils import metrics
+
+
+USAGE = {'wall': 10.5, 'utime': 8.0, 'stime': 1.25, 'maxrss': 2 ** 20,
+         'read_bytes': None, 'write_bytes': None}
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.top_outdir = tempfile.mkdtemp()
+        self.gsm_dir = os.path.join(
+            self.top_outdir, 'rsem_output', 'GSE1', 'homo_sapiens', 'GSM1')
+        os.makedirs(self.gsm_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.top_outdir)
+
+    def test_parse_flag_file(self):
+        self.assertEqual(
+            metrics.parse_flag_file(
+                os.path.join(self.gsm_dir, 'SRR1.sra.download.COMPLETE')),
+            (self.gsm_dir, 'download', 'SRR1.sra'))
+        self.assertEqual(
+            metrics.parse_flag_file(
+                os.path.join(self.gsm_dir, 'SRX1', 'SRR1', 'SRR1.sra.sra2fastq.COMPLETE')),
+            (self.gsm_dir, 'sra2fastq', 'SRR1.sra'))
+        self.assertEqual(
+            metrics.parse_flag_file(os.path.join(self.gsm_dir, 'rsem.COMPLETE')),
+            (self.gsm_dir, 'rsem', None))
+        self.assertIsNone(metrics.parse_flag_file('some_flag.txt'))
+
+    def test_record_and_load(self):
+        metrics.record(os.path.join(self.gsm_dir, 'SRR1.sra.download.COMPLETE'),
+                       1, USAGE)
+        usage = dict(USAGE, read_bytes=100, write_bytes=200)
+        metrics.record(os.path.join(self.gsm_dir, 'rsem.COMPLETE'), 0, usage)
+        records = metrics.load(self.gsm_dir)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['stage'], 'download')
+        self.assertEqual(records[0]['item'], 'SRR1.sra')
+        self.assertEqual(records[0]['returncode'], 1)
+        self.assertIsNone(records[0]['read_bytes'])
+        self.assertEqual(records[1]['stage'], 'rsem')
+        self.assertIsNone(records[1]['item'])
+        self.assertEqual(records[1]['maxrss'], 2 ** 20)
+        self.assertEqual(records[1]['write_bytes'], 200)
+        # one record per line
+        with open(os.path.join(self.gsm_dir, 'metrics.yaml')) as inf:
+            self.assertEqual(len(inf.readlines()), 2)
+
+    def test_record_not_of_a_gsm(self):
+        self.assertIsNone(metrics.record('some_flag.txt', 0, USAGE))
+
+    def test_load_nonexistent(self):
+        self.assertEqual(metrics.load(self.gsm_dir), [])
+
+    def test_format_usage(self):
+        self.assertEqual(metrics.format_usage(USAGE),
+                         'wall: 10.5s, user: 8.0s, sys: 1.25s, max rss: 1.0 MB')
+        usage = dict(USAGE, read_bytes=0, write_bytes=2 ** 21)
+        self.assertEqual(metrics.format_usage(usage),
+                         'wall: 10.5s, user: 8.0s, sys: 1.25s, max rss: 1.0 MB, '
+                         'read: 0.0 MB, written: 2.0 MB')
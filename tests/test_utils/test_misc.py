@@ -209,36 +209,71 @@ class MiscTestCase(unittest.TestCase):
             L.check(('rsempipeline.utils.misc', 'ERROR',
                      'potentially invalid yaml format in invalid_yaml.yaml'),)
 
-    @mock.patch('rsempipeline.utils.misc.subprocess')
+    @mock.patch('rsempipeline.utils.misc.runner.run')
     @log_capture()
-    def test_execute_fail_to_start(self, mock_subprocess, L):
-        mock_subprocess.call.side_effect = OSError('some err msg')
+    def test_execute_fail_to_start(self, mock_run, L):
+        mock_run.side_effect = OSError('some err msg')
         self.assertIsNone(misc.execute('some cmd', 'msg_id'))
         L.check(('rsempipeline.utils.misc', 'INFO', 'executing CMD: some cmd'),
                 ('rsempipeline.utils.misc', 'ERROR',
                  'msg_id: failed to start, raising OSError some err msg. CMD: "some cmd"'))
 
+    @mock.patch('rsempipeline.utils.misc.record_usage')
     @mock.patch('rsempipeline.utils.misc.touch')
-    @mock.patch('rsempipeline.utils.misc.subprocess')
+    @mock.patch('rsempipeline.utils.misc.runner.run')
     @log_capture()
-    def test_execute_started_but_fail_to_finish(self, mock_subprocess, mock_touch, L):
-        mock_subprocess.call.return_value = 1
+    def test_execute_started_but_fail_to_finish(self, mock_run, mock_touch,
+                                                mock_record_usage, L):
+        mock_run.return_value = mock.Mock(returncode=1)
         self.assertEqual(misc.execute('some cmd', 'msg_id'), 1)
         L.check(('rsempipeline.utils.misc', 'INFO', 'executing CMD: some cmd'),
                 ('rsempipeline.utils.misc', 'ERROR',
                  'msg_id: started, but failed to finish with a returncode of 1. CMD: "some cmd"'))
         self.assertFalse(mock_touch.called)
 
+    @mock.patch('rsempipeline.utils.misc.record_usage')
     @mock.patch('rsempipeline.utils.misc.touch')
-    @mock.patch('rsempipeline.utils.misc.subprocess')
+    @mock.patch('rsempipeline.utils.misc.runner.run')
     @log_capture()
-    def test_execute_started_and_finished_successfully(self, mock_subprocess, mock_touch, L):
-        mock_subprocess.call.return_value = 0
+    def test_execute_started_and_finished_successfully(self, mock_run, mock_touch,
+                                                       mock_record_usage, L):
+        mock_run.return_value = mock.Mock(returncode=0)
         self.assertEqual(misc.execute('some cmd', 'msg_id', 'some_flag.txt'), 0)
         L.check(('rsempipeline.utils.misc', 'INFO', 'executing CMD: some cmd'),
                 ('rsempipeline.utils.misc', 'INFO',
                  'msg_id: execution succeeded with a returncode of 0. CMD: "some cmd"'))
         mock_touch.assert_called_with('some_flag.txt')
+        mock_record_usage.assert_called_once_with(
+            mock_run.return_value, 'msg_id', 'some_flag.txt')
+
+    @mock.patch('rsempipeline.utils.misc.record_usage')
+    @mock.patch('rsempipeline.utils.misc.touch')
+    @mock.patch('rsempipeline.utils.misc.runner.run')
+    @log_capture()
+    def test_execute_log_stdout_stderr_failed_with_log_file(self, mock_run, mock_touch,
+                                                            mock_record_usage, L):
+        mock_run.return_value = mock.Mock(returncode=1, tail=['stderr: oops'])
+        self.assertEqual(misc.execute_log_stdout_stderr(
+            'some cmd', 'msg_id', 'some_flag.txt', log_file='some.out'), 1)
+        mock_run.assert_called_once_with('some cmd', 'msg_id', 'some.out', None)
+        L.check(('rsempipeline.utils.misc', 'INFO', 'some cmd'),
+                ('rsempipeline.utils.misc', 'ERROR',
+                 'msg_id, started, but then failed with returncode: 1. CMD "some cmd"'),
+                ('rsempipeline.utils.misc', 'ERROR',
+                 'last lines of output in some.out:\n    stderr: oops'))
+        self.assertFalse(mock_touch.called)
+
+    @mock.patch('rsempipeline.utils.misc.metrics.record')
+    @mock.patch('rsempipeline.utils.misc.touch')
+    def test_execute_log_stdout_stderr(self, mock_touch, mock_record):
+        self.assertEqual(misc.execute_log_stdout_stderr(
+            'printf "no newline"', 'msg_id', 'some_flag.txt'), 0)
+        mock_touch.assert_called_once_with('some_flag.txt')
+        flag_file, returncode, usage = mock_record.call_args[0]
+        self.assertEqual((flag_file, returncode), ('some_flag.txt', 0))
+        self.assertEqual(sorted(usage.keys()),
+                         ['maxrss', 'read_bytes', 'stime', 'utime', 'wall',
+                          'write_bytes'])
 
     def test_pretty_usage(self):
         self.assertEqual(misc.pretty_usage(1000), '1000.0 bytes')
@@ -314,22 +349,32 @@ class MiscTestCase(unittest.TestCase):
         self.assertFalse(misc.is_empty_dir('/p', ['/p', '/p/a.txt']))
         self.assertTrue(misc.is_empty_dir('/p', ['/p', '/s', '/s/a.txt']))
 
-    @mock.patch('rsempipeline.utils.misc.paramiko')
-    def test_sshexec(self, mock_paramiko):
-        mock_paramiko.Transport().open_session().makefile().readlines.return_value = ['some_output\n']
+    @mock.patch('rsempipeline.utils.misc.ssh.get_session', autospec=True)
+    def test_sshexec(self, mock_get_session):
+        mock_get_session.return_value.execute.return_value = ['some_output\n']
         self.assertEqual(misc.sshexec('cmd', 'host', 'username'), ['some_output\n'])
-        # interestingly, Transpost is called twice while in the code, it's
-        # explicitly called only once
-        self.assertEqual(mock_paramiko.Transport.call_args_list,
-                         [mock.call(), mock.call(('host', 22))])
-
-    @mock.patch('rsempipeline.utils.misc.paramiko')
-    def test_sshexec_execution_failed_remotely(self, mock_paramiko):
-        mock_paramiko.Transport().open_session().makefile().readlines.return_value = None
+        mock_get_session.assert_called_once_with('host', 'username', '~/.ssh/id_rsa')
+        mock_get_session.return_value.execute.assert_called_once_with('cmd')
+
+    @mock.patch('rsempipeline.utils.misc.ssh.get_session', autospec=True)
+    def test_sshexec_execution_failed_remotely(self, mock_get_session):
+        mock_get_session.return_value.execute.return_value = None
         self.assertIsNone(misc.sshexec('cmd', 'host', 'username'))
-        self.assertEqual(mock_paramiko.Transport.call_args_list,
-                         [mock.call(), mock.call(('host', 22))])
 
+    @mock.patch('rsempipeline.utils.misc.ssh.get_session', autospec=True)
+    def test_sshexec_iter(self, mock_get_session):
+        mock_get_session.return_value.execute_iter.return_value = iter(['a\n', 'b\n'])
+        self.assertEqual(list(misc.sshexec_iter('find r_dir', 'host', 'username')),
+                         ['a\n', 'b\n'])
+        mock_get_session.return_value.execute_iter.assert_called_once_with('find r_dir')
+
+    @mock.patch('rsempipeline.utils.misc.ssh.get_session', autospec=True)
+    def test_sshexec_many(self, mock_get_session):
+        mock_get_session.return_value.execute_many.return_value = [['a\n'], ['b\n']]
+        self.assertEqual(misc.sshexec_many(['cmd1', 'cmd2'], 'host', 'username'),
+                         [['a\n'], ['b\n']])
+        mock_get_session.return_value.execute_many.assert_called_once_with(
+            ['cmd1', 'cmd2'])
 
 if __name__ == "__main__":
     unittest.main()
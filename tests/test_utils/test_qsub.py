@@ -0,0 +1,236 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from rsempipeline.utils import qsub
+
+
+SGE_QSUB_SCRIPT = """#!/bin/bash
+
+#$ -S /bin/bash
+#$ -q all.q
+#$ -N GSM1_GSE1
+#$ -pe ncpus 12
+#$ -l mem_free=3.83G,mem_token=3.83G,h_vmem=3.83G
+#$ -j y
+#$ -V
+
+cd ${SGE_O_WORKDIR}
+"""
+
+PBS_QSUB_SCRIPT = """#!/bin/bash
+
+#PBS -l walltime=24:00:00,nodes=1:ppn=8,mem=20GB
+#PBS -N GSM1_GSE1
+#PBS -j eo
+#PBS -V
+
+cd ${PBS_O_WORKDIR}
+"""
+
+
+class QsubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, content, basename='0_submit.sh'):
+        path = os.path.join(self.temp_dir, basename)
+        with open(path, 'wb') as opf:
+            opf.write(content)
+        return path
+
+    def test_get_directives_sge(self):
+        scheduler, directives = qsub.get_directives(self.write(SGE_QSUB_SCRIPT))
+        self.assertEqual(scheduler, 'sge')
+        self.assertEqual(directives, [
+            '#$ -S /bin/bash',
+            '#$ -q all.q',
+            '#$ -pe ncpus 12',
+            '#$ -l mem_free=3.83G,mem_token=3.83G,h_vmem=3.83G',
+            '#$ -j y',
+            '#$ -V'])
+
+    def test_get_directives_pbs(self):
+        scheduler, directives = qsub.get_directives(self.write(PBS_QSUB_SCRIPT))
+        self.assertEqual(scheduler, 'pbs')
+        self.assertEqual(directives, [
+            '#PBS -l walltime=24:00:00,nodes=1:ppn=8,mem=20GB',
+            '#PBS -j eo',
+            '#PBS -V'])
+
+    def test_get_directives_without_directives(self):
+        self.assertRaises(ValueError, qsub.get_directives,
+                          self.write('#!/bin/bash\necho hello\n'))
+
+    def test_write_manifest(self):
+        manifest = os.path.join(self.temp_dir, 'transfer.manifest')
+        qsub.write_manifest(['rsem_output/GSE1/homo_sapiens/GSM1',
+                             'rsem_output/GSE1/homo_sapiens/GSM2'], manifest)
+        with open(manifest) as inf:
+            self.assertEqual(inf.read(),
+                             'rsem_output/GSE1/homo_sapiens/GSM1\n'
+                             'rsem_output/GSE1/homo_sapiens/GSM2\n')
+
+    def test_gen_array_params_sge(self):
+        params = qsub.gen_array_params(
+            self.write(SGE_QSUB_SCRIPT), 'rp_job', 3, 'x.manifest')
+        self.assertEqual(params['directives'][-2:],
+                         ['#$ -N rp_job', '#$ -t 1-3'])
+        self.assertEqual(params['task_id'], '${SGE_TASK_ID}')
+        self.assertEqual(params['workdir_var'], 'SGE_O_WORKDIR')
+        self.assertEqual(params['manifest'], 'x.manifest')
+
+    def test_gen_array_params_pbs(self):
+        params = qsub.gen_array_params(
+            self.write(PBS_QSUB_SCRIPT), 'rp_job', 3, 'x.manifest')
+        # Torque
+        self.assertEqual(params['directives'][-2:],
+                         ['#PBS -N rp_job', '#PBS -t 1-3'])
+        self.assertEqual(params['workdir_var'], 'PBS_O_WORKDIR')
+
+    def test_gen_array_params_pbspro(self):
+        params = qsub.gen_array_params(
+            self.write(PBS_QSUB_SCRIPT.replace(
+                'nodes=1:ppn=8,mem=20GB\n', 'mem=20GB\n#PBS -l select=1:ncpus=8\n')),
+            'rp_job', 3, 'x.manifest')
+        self.assertEqual(params['directives'][-2:],
+                         ['#PBS -N rp_job', '#PBS -J 1-3'])
+
+    def test_get_flavour(self):
+        self.assertEqual(qsub.get_flavour('sge', []), 'sge')
+        self.assertEqual(qsub.get_flavour(
+            'pbs', ['#PBS -l walltime=24:00:00,nodes=1:ppn=8']), 'torque')
+        self.assertEqual(qsub.get_flavour(
+            'pbs', ['#PBS -l select=2:ncpus=8:mem=20gb']), 'pbspro')
+
+    def test_gen_job_name(self):
+        self.assertEqual(qsub.gen_job_name('transfer.15-01-01_01:01:01'),
+                         'rp_transfer.15-01-01_01-01-01')
+
+    def test_get_resources(self):
+        self.assertEqual(qsub.get_resources(self.write(SGE_QSUB_SCRIPT)),
+                         dict(ncpus=12, mem=3.83, walltime=None))
+        self.assertEqual(qsub.get_resources(self.write(PBS_QSUB_SCRIPT)),
+                         dict(ncpus=8, mem=20, walltime=86400))
+
+    def test_merge_resources_sge(self):
+        scripts = [self.write(SGE_QSUB_SCRIPT),
+                   self.write(SGE_QSUB_SCRIPT.replace('ncpus 12', 'ncpus 4')
+                              .replace('3.83G', '2G'), '1_submit.sh')]
+        self.assertEqual(qsub.merge_resources(scripts),
+                         dict(ncpus=12, mem=3.83, walltime=None))
+        # mem is per slot, which adds up with ncpus
+        self.assertEqual(qsub.merge_resources(scripts, parallel=True),
+                         dict(ncpus=16, mem=3.83, walltime=None))
+
+    def test_merge_resources_pbs(self):
+        scripts = [self.write(PBS_QSUB_SCRIPT),
+                   self.write(PBS_QSUB_SCRIPT.replace('24:00:00', '36:00:00')
+                              .replace('ppn=8', 'ppn=2').replace('mem=20', 'mem=4'),
+                              '1_submit.sh')]
+        self.assertEqual(qsub.merge_resources(scripts),
+                         dict(ncpus=8, mem=20, walltime=129600))
+        self.assertEqual(qsub.merge_resources(scripts, parallel=True),
+                         dict(ncpus=10, mem=24, walltime=129600))
+
+    def test_set_resources(self):
+        _, directives = qsub.get_directives(self.write(SGE_QSUB_SCRIPT))
+        directives = qsub.set_resources(directives, 'sge', ncpus=4, mem=7.66)
+        self.assertIn('#$ -pe ncpus 4', directives)
+        self.assertIn('#$ -l mem_free=7.66G,mem_token=7.66G,h_vmem=7.66G', directives)
+        _, directives = qsub.get_directives(self.write(PBS_QSUB_SCRIPT))
+        self.assertEqual(
+            qsub.set_resources(directives, 'pbs', walltime=3600, mem=8.0)[0],
+            '#PBS -l walltime=01:00:00,nodes=1:ppn=8,mem=8GB')
+
+    @mock.patch('rsempipeline.utils.qsub.Environment', autospec=True)
+    def test_get_template_cached(self, mock_env):
+        qsub.jinja2_templates.clear()
+        template1 = qsub.get_template('0_submit_genesis.jinja2')
+        template2 = qsub.get_template('0_submit_genesis.jinja2')
+        self.assertIs(template1, template2)
+        self.assertEqual(mock_env.call_count, 1)
+        qsub.jinja2_templates.clear()
+
+    def test_calc_qsub_resources_not_configured(self):
+        self.assertEqual(qsub.calc_qsub_resources(['GSM1/SRR1_1.fastq.gz'], None, []),
+                         (None, None, None))
+
+    def test_gen_bundle_params(self):
+        params = qsub.gen_bundle_params(self.write(SGE_QSUB_SCRIPT), 'rp_bundle')
+        self.assertEqual(params['directives'][-1], '#$ -N rp_bundle')
+        self.assertEqual(params['workdir_var'], 'SGE_O_WORKDIR')
+
+    def test_pack_bundles(self):
+        runtimes = [('GSM1', 10), ('GSM2', 50), ('GSM3', 30),
+                    ('GSM4', 100), ('GSM5', 20)]
+        self.assertEqual(qsub.pack_bundles(runtimes, 60),
+                         [['GSM4'], ['GSM2', 'GSM1'], ['GSM3', 'GSM5']])
+
+    def test_get_walltime(self):
+        self.assertEqual(qsub.get_walltime(self.write(PBS_QSUB_SCRIPT)), '24:00:00')
+        self.assertIsNone(qsub.get_walltime(self.write(SGE_QSUB_SCRIPT)))
+
+    def test_set_walltime(self):
+        self.assertEqual(
+            qsub.set_walltime(['#PBS -l walltime=24:00:00,nodes=1:ppn=8', '#PBS -V'],
+                              'pbs', '48:00:00'),
+            ['#PBS -l walltime=48:00:00,nodes=1:ppn=8', '#PBS -V'])
+        self.assertEqual(
+            qsub.set_walltime(['#$ -l h_rt=01:00:00'], 'sge', '02:00:00'),
+            ['#$ -l h_rt=02:00:00'])
+
+    def test_parse_job_id(self):
+        self.assertEqual(
+            qsub.parse_job_id('Your job 1234 ("GSM1_GSE1") has been submitted\n'), '1234')
+        self.assertEqual(
+            qsub.parse_job_id('Your job-array 1235.1-10:1 ("rp_x") has been submitted'), '1235')
+        self.assertEqual(qsub.parse_job_id('1236.server.domain\n'), '1236')
+        self.assertEqual(qsub.parse_job_id('1237[].server'), '1237')
+        self.assertIsNone(qsub.parse_job_id('qsub: command not found'))
+
+    def test_parse_qstat(self):
+        sge = [
+            'job-ID  prior   name       user   state submit/start at     queue  slots ja-task-ID\n',
+            '-----------------------------------------------------------------------\n',
+            '   1234 0.50500 GSM1_GSE1  user   r     07/17/2015 09:04:38 all.q@n1  12\n',
+            '   1235 0.50500 rp_x       user   qw    07/17/2015 09:04:38           12 1-10:1\n']
+        self.assertEqual(qsub.parse_qstat(sge), set(['1234', '1235']))
+        pbs = [
+            'Job ID                    Username Queue    Jobname    SessID NDS TSK Memory Time  S Time\n',
+            '1236.server.domain        user     batch    GSM2_GSE1   1234   1   8   20gb 24:00 R 01:00\n',
+            '1237[].server.domain      user     batch    rp_y          --   1   8   20gb 24:00 Q   --\n']
+        self.assertEqual(qsub.parse_qstat(pbs), set(['1236', '1237']))
+
+    def test_count_array_tasks(self):
+        self.assertEqual(qsub.count_array_tasks('1-10:1'), 10)
+        self.assertEqual(qsub.count_array_tasks('4-10:2'), 4)
+        self.assertEqual(qsub.count_array_tasks('1,3,5'), 3)
+        self.assertEqual(qsub.count_array_tasks('1-3:1,7'), 4)
+
+    def test_parse_qstat_states(self):
+        sge = [
+            'job-ID  prior   name       user   state submit/start at     queue  slots ja-task-ID\n',
+            '-----------------------------------------------------------------------\n',
+            '   1234 0.50500 GSM1_GSE1  user   r     07/17/2015 09:04:38 all.q@n1  12\n',
+            '   1235 0.50500 rp_x       user   r     07/17/2015 09:04:38 all.q@n2  12 1\n',
+            '   1235 0.50500 rp_x       user   qw    07/17/2015 09:04:38           12 2-10:1\n',
+            '   1236 0.50500 GSM2_GSE1  user   hqw   07/17/2015 09:04:38           12\n',
+            '   1237 0.50500 GSM3_GSE1  user   Eqw   07/17/2015 09:04:38           12\n']
+        self.assertEqual(qsub.parse_qstat_states(sge),
+                         {'pending': 10, 'running': 2})
+        pbs = [
+            'Job ID                    Username Queue    Jobname    SessID NDS TSK Memory Time  S Time\n',
+            '------------------------- -------- -------- ---------- ------ --- --- ------ ----- - -----\n',
+            '1236.server.domain        user     batch    GSM2_GSE1   1234   1   8   20gb 24:00 R 01:00\n',
+            '1237[].server.domain      user     batch    rp_y          --   1   8   20gb 24:00 Q   --\n',
+            '1238.server.domain        user     batch    GSM3_GSE1     --   1   8   20gb 24:00 H   --\n']
+        self.assertEqual(qsub.parse_qstat_states(pbs),
+                         {'pending': 2, 'running': 1})
+        self.assertEqual(qsub.parse_qstat_states([]), {'pending': 0, 'running': 0})
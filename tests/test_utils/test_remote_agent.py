@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rsempipeline.utils import remote_agent as RA
+
+
+class RemoteAgentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.top_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top_dir)
+
+    def test_get_gsm_state(self):
+        self.assertEqual(RA.get_gsm_state([]), RA.EMPTY)
+        self.assertEqual(RA.get_gsm_state(['SRR1_1.fastq.gz']), RA.TRANSFERRED)
+        self.assertEqual(RA.get_gsm_state(['SRR1_1.fastq.gz', 'rsem.log']), RA.RUNNING)
+        self.assertEqual(RA.get_gsm_state(['rsem.log', 'rsem.COMPLETE']), RA.COMPLETE)
+
+    def test_encode_decode(self):
+        status = {'usage': 1, 'free': 2, 'gsms': {'GSM1': {'state': 'empty', 'usage': 0}}}
+        self.assertEqual(RA.decode(RA.encode(status)), status)
+
+    def test_walk(self):
+        gsm_dir = os.path.join(self.top_dir, 'GSE1', 'homo_sapiens', 'GSM1')
+        os.makedirs(gsm_dir)
+        with open(os.path.join(gsm_dir, 'rsem.COMPLETE'), 'wb') as opf:
+            opf.write('a' * 10000)
+        # not a GSM dir
+        os.makedirs(os.path.join(self.top_dir, 'GSE1', 'homo_sapiens', 'GSM1x'))
+        total, gsms = RA.walk(self.top_dir)
+        self.assertEqual(gsms.keys(), [os.path.join('GSE1', 'homo_sapiens', 'GSM1')])
+        self.assertEqual(gsms.values()[0]['state'], RA.COMPLETE)
+        self.assertGreaterEqual(gsms.values()[0]['usage'], 10000)
+        self.assertGreater(total, gsms.values()[0]['usage'])
+
+    def test_main_nonexistent_top_dir(self):
+        self.assertEqual(RA.main([os.path.join(self.top_dir, 'nonexistent')]), 1)
@@ -0,0 +1,48 @@
+import unittest
+
+from rsempipeline.utils.remote_tree import RemoteTree
+
+
+FIND_OUTPUT = [
+    '/path/to/rsemoutput\n',
+    '/path/to/rsemoutput/GSE1\n',
+    '/path/to/rsemoutput/GSE1/homo_sapiens\n',
+    '/path/to/rsemoutput/GSE1/homo_sapiens/GSM1\n',
+    '/path/to/rsemoutput/GSE1/homo_sapiens/GSM1/rsem.COMPLETE\n',
+    '/path/to/rsemoutput/GSE1/homo_sapiens/GSM12\n',
+    '/path/to/rsemoutput/GSE2\n',
+    '/path/to/rsemoutput/GSE2/homo_sapiens\n',
+    '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2\n',
+    '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2/SRR1_1.fastq.gz\n',
+    '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2/GSM2.stat\n',
+]
+
+
+class RemoteTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tree = RemoteTree(FIND_OUTPUT)
+
+    def test_len(self):
+        self.assertEqual(len(self.tree), 11)
+
+    def test_gsm_dirs(self):
+        self.assertEqual(self.tree.gsm_dirs, [
+            '/path/to/rsemoutput/GSE1/homo_sapiens/GSM1',
+            '/path/to/rsemoutput/GSE1/homo_sapiens/GSM12',
+            '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2'])
+
+    def test_is_empty_dir(self):
+        self.assertFalse(self.tree.is_empty_dir('/path/to/rsemoutput/GSE1/homo_sapiens/GSM1'))
+        # GSM1 is a prefix of GSM12, which used to confuse a substring scan
+        self.assertTrue(self.tree.is_empty_dir('/path/to/rsemoutput/GSE1/homo_sapiens/GSM12'))
+        self.assertFalse(self.tree.is_empty_dir('/path/to/rsemoutput/GSE2/homo_sapiens/GSM2'))
+
+    def test_has_file(self):
+        self.assertTrue(self.tree.has_file(
+            '/path/to/rsemoutput/GSE1/homo_sapiens/GSM1', 'rsem.COMPLETE'))
+        self.assertFalse(self.tree.has_file(
+            '/path/to/rsemoutput/GSE2/homo_sapiens/GSM2', 'rsem.COMPLETE'))
+        self.assertFalse(self.tree.has_file('/nonexistent', 'rsem.COMPLETE'))
+
+    def test_blank_lines_ignored(self):
+        self.assertEqual(len(RemoteTree(['\n', '/path\n'])), 1)
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rsempipeline.utils import resources as RES
+
+
+RSEM_LOG = """return code: 0
+ncpus: 8
+1.5G	./SRR1557065_1.fastq.gz
+512M	./SRR1557065_2.fastq.gz
+4.0K	./SRX685892/SRR1557065/SRR1557065.sra
+"""
+
+
+class ResourcesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.top_outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top_outdir)
+
+    def write_rsem_log(self, gsm_dir, content):
+        rsem_log = os.path.join(gsm_dir, 'rsem.log')
+        with open(rsem_log, 'wb') as opf:
+            opf.write(content)
+        return rsem_log
+
+    def test_parse_du_size(self):
+        self.assertEqual(RES.parse_du_size('1.5G'), 1.5 * 2 ** 30)
+        self.assertEqual(RES.parse_du_size('512K'), 512 * 2 ** 10)
+        self.assertEqual(RES.parse_du_size('0'), 0)
+
+    def test_parse_rsem_log(self):
+        rsem_log = self.write_rsem_log(self.top_outdir, RSEM_LOG)
+        self.assertEqual(RES.parse_rsem_log(rsem_log), (2 * 2 ** 30, 8))
+
+    def test_parse_rsem_log_without_ncpus(self):
+        rsem_log = self.write_rsem_log(self.top_outdir, '1G\t./SRR1_1.fastq.gz\n')
+        self.assertEqual(RES.parse_rsem_log(rsem_log), (2 ** 30, None))
+
+    def test_collect_cpu_rates(self):
+        gsm_dir = os.path.join(self.top_outdir, 'rsem_output', 'GSE1', 'homo_sapiens', 'GSM1')
+        os.makedirs(gsm_dir)
+        self.write_rsem_log(gsm_dir, RSEM_LOG)
+        with open(os.path.join(gsm_dir, 'GSM1.time'), 'wb') as opf:
+            opf.write('Aligning reads: 2048 s.\n')
+        self.assertEqual(RES.collect_cpu_rates(self.top_outdir, 12),
+                         [2048 * 8 / float(2 * 2 ** 30)])
+
+    def test_median(self):
+        self.assertEqual(RES.median([3, 1, 2]), 2)
+        self.assertEqual(RES.median([4, 1, 2, 3]), 2.5)
+
+    def test_format_and_parse_walltime(self):
+        self.assertEqual(RES.format_walltime(3661), '01:01:01')
+        self.assertEqual(RES.format_walltime(100 * 3600), '100:00:00')
+        self.assertEqual(RES.parse_walltime('01:01:01'), 3661)
+
+    def test_calc_resources(self):
+        limits = {'ncpus': [2, 12], 'mem': [2, 4], 'walltime': [1, 72]}
+        # 1 cpu second per 1 MB fastq.gz
+        rates = [1. / 2 ** 20]
+        res = RES.calc_resources(8 * 2 ** 30, rates, limits)
+        self.assertEqual(res['ncpus'], 4)
+        self.assertEqual(res['mem'], 2.4)
+        # 8192 cpu seconds / 4 cpus * 1.5
+        self.assertEqual(res['walltime'], '01:00:00')
+        res = RES.calc_resources(100 * 2 ** 30, rates, limits)
+        self.assertEqual(res['ncpus'], 12)
+        self.assertEqual(res['mem'], 4)
+        self.assertEqual(res['walltime'], '03:33:20')
+
+    def test_calc_resources_without_history(self):
+        limits = {'ncpus': [2, 12], 'mem': [3.83, 3.83], 'walltime': [1, 72]}
+        self.assertEqual(RES.calc_resources(2 ** 30, [], limits),
+                         {'ncpus': 2, 'mem': 3.83, 'walltime': '72:00:00'})
@@ -0,0 +1,110 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from testfixtures import log_capture
+
+from rsempipeline.utils import runner
+
+
+class RunnerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmp_dir, 'task.out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_log(self):
+        with open(self.log_file) as inf:
+            return inf.read()
+
+    def test_run_to_log_file(self):
+        task = runner.run('echo a; echo b >&2; echo c', log_file=self.log_file)
+        self.assertEqual(task.returncode, 0)
+        content = self.read_log()
+        self.assertIn('stdout: a\n', content)
+        self.assertIn('stderr: b\n', content)
+        self.assertEqual(task.num_lines, 3)
+
+    def test_run_partial_line(self):
+        # the last line without a newline is neither blocking nor dropped
+        task = runner.run('printf "progress 50%%"; sleep 0.2; printf " 100%%"; '
+                          'exit 3', log_file=self.log_file)
+        self.assertEqual(task.returncode, 3)
+        self.assertEqual(self.read_log(), 'stdout: progress 50% 100%\n')
+
+    def test_tail_is_bounded(self):
+        task = runner.Task('seq 1 1000', log_file=self.log_file, tail_size=5)
+        task.start().wait()
+        self.assertEqual(list(task.tail), ['stdout: {0}'.format(_)
+                                           for _ in range(996, 1001)])
+        self.assertEqual(task.num_lines, 1000)
+
+    @log_capture('rsempipeline.utils.runner')
+    def test_run_without_log_file(self, L):
+        runner.run('echo a')
+        L.check(('rsempipeline.utils.runner', 'INFO', 'stdout: a'))
+
+    def test_timeout(self):
+        bt = time.time()
+        task = runner.run('sleep 30', log_file=self.log_file, timeout=0.5)
+        self.assertTrue(task.timed_out)
+        self.assertNotEqual(task.returncode, 0)
+        self.assertLess(time.time() - bt, 10)
+
+    def test_interrupted_wait_kills_child(self):
+        task = runner.Task('sleep 30', log_file=self.log_file).start()
+        with mock.patch.object(task, '_wait', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, task.wait)
+        self.assertEqual(task.returncode, -15)
+        self.assertNotIn(task, runner.live_tasks)
+
+    def test_kill_all(self):
+        task = runner.Task('sleep 30', log_file=self.log_file).start()
+        waiter = threading.Thread(target=task.wait)
+        waiter.start()
+        self.assertIn(task, runner.live_tasks)
+        runner.kill_all()
+        waiter.join(10)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(task.returncode, -15)
+        self.assertNotIn(task, runner.live_tasks)
+
+    def test_write_after_close(self):
+        task = runner.run('echo a', log_file=self.log_file)
+        # e.g. from a grandchild still holding the pipe after the drainer
+        # is given up on
+        task._write('stdout', ['late'])
+        self.assertEqual(self.read_log(), 'stdout: a\n')
+
+    @log_capture('rsempipeline.utils.runner')
+    def test_summary(self, L):
+        task = runner.Task('echo a; sleep 0.5', log_file=self.log_file,
+                           summary_interval=0.2).start()
+        task.wait()
+        self.assertTrue(any('1 lines of output in {0}, last: stdout: a'.format(
+            self.log_file) in _.getMessage() for _ in L.records))
+
+    def test_usage(self):
+        task = runner.run('python -c "x = bytearray(50 * 2 ** 20)"; '
+                          'head -c 1048576 /dev/zero > {0}/blob'.format(self.tmp_dir),
+                          log_file=self.log_file)
+        usage = task.get_usage()
+        self.assertGreater(usage['maxrss'], 50 * 2 ** 20)
+        self.assertGreaterEqual(usage['wall'], usage['utime'] - 1)
+        self.assertEqual(sorted(usage.keys()),
+                         ['maxrss', 'read_bytes', 'stime', 'utime', 'wall',
+                          'write_bytes'])
+
+    def test_read_proc_io(self):
+        if not os.path.exists('/proc/self/io'):
+            self.skipTest('/proc/<pid>/io is not available')
+        read_bytes, write_bytes = runner.read_proc_io(os.getpid())
+        self.assertGreaterEqual(write_bytes, 0)
+        self.assertIsNone(runner.read_proc_io(-1))
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from rsempipeline.utils import runtime as RT
+
+
+def create_gsm_dir(top_outdir, gse, species, gsm, size, time_content=None):
+    gsm_dir = os.path.join(top_outdir, 'rsem_output', gse, species, gsm)
+    os.makedirs(gsm_dir)
+    with open(os.path.join(gsm_dir, 'sras_info.yaml'), 'wb') as opf:
+        opf.write('- SRX000001/SRR000001/SRR000001.sra:\n'
+                  '    readable_size: whatever\n'
+                  '    size: {0}\n'.format(size))
+    if time_content is not None:
+        with open(os.path.join(gsm_dir, '{0}.time'.format(gsm)), 'wb') as opf:
+            opf.write(time_content)
+    return gsm_dir
+
+
+class RuntimeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.top_outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top_outdir)
+
+    def test_get_rsem_time_file(self):
+        self.assertEqual(RT.get_rsem_time_file('rsem_output/GSE1/homo_sapiens/GSM1'),
+                         'rsem_output/GSE1/homo_sapiens/GSM1/GSM1.time')
+
+    def test_parse_rsem_time(self):
+        gsm_dir = create_gsm_dir(
+            self.top_outdir, 'GSE1', 'homo_sapiens', 'GSM1', 100,
+            'Aligning reads: 3146 s.\n'
+            'Estimating expression levels: 1530 s.\n'
+            'Calculating credibility intervals: 0 s.\n')
+        self.assertEqual(RT.parse_rsem_time(RT.get_rsem_time_file(gsm_dir)), 4676)
+
+    def test_parse_rsem_time_nonexistent_file(self):
+        self.assertIsNone(RT.parse_rsem_time('nonexistent.time'))
+
+    def test_collect_history(self):
+        create_gsm_dir(self.top_outdir, 'GSE1', 'homo_sapiens', 'GSM1', 100,
+                       'Aligning reads: 200 s.\n')
+        # not finished yet, so no .time file
+        create_gsm_dir(self.top_outdir, 'GSE1', 'homo_sapiens', 'GSM2', 300)
+        self.assertEqual(RT.collect_history(self.top_outdir),
+                         [('homo_sapiens', 100, 200)])
+
+    def test_fit_linear(self):
+        slope, intercept = RT.fit_linear([(1, 12), (2, 22), (3, 32)])
+        self.assertAlmostEqual(slope, 10)
+        self.assertAlmostEqual(intercept, 2)
+
+    def test_fit_linear_single_point(self):
+        self.assertEqual(RT.fit_linear([(2, 10)]), (5, 0))
+
+    def test_fit_runtime_model(self):
+        records = [('homo_sapiens', 1, 10), ('homo_sapiens', 2, 20),
+                   ('mus_musculus', 1, 30)]
+        model = RT.fit_runtime_model(records)
+        self.assertEqual(sorted(model.keys()),
+                         ['__all__', 'homo_sapiens', 'mus_musculus'])
+        self.assertAlmostEqual(RT.predict_runtime(model, 'homo_sapiens', 4), 40)
+        self.assertAlmostEqual(RT.predict_runtime(model, 'mus_musculus', 2), 60)
+
+    def test_fit_runtime_model_without_records(self):
+        self.assertEqual(RT.fit_runtime_model([]), {})
+
+    def test_predict_runtime_falls_back_to_all_species(self):
+        model = {'__all__': (2., 1.)}
+        self.assertEqual(RT.predict_runtime(model, 'rattus_norvegicus', 10), 21)
+        self.assertIsNone(RT.predict_runtime({}, 'rattus_norvegicus', 10))
+
+    def test_sort_by_predicted_runtime(self):
+        m1, m2, m3 = mock.Mock(), mock.Mock(), mock.Mock()
+        m1.outdir = create_gsm_dir(self.top_outdir, 'GSE1', 'homo_sapiens', 'GSM1', 10)
+        m2.outdir = create_gsm_dir(self.top_outdir, 'GSE1', 'homo_sapiens', 'GSM2', 30)
+        m3.outdir = create_gsm_dir(self.top_outdir, 'GSE2', 'mus_musculus', 'GSM3', 20)
+        model = {'homo_sapiens': (1., 0.), 'mus_musculus': (10., 0.)}
+        self.assertEqual(RT.sort_by_predicted_runtime([m1, m2, m3], model),
+                         [m3, m2, m1])
+        # without a model, sort by sras size
+        self.assertEqual(RT.sort_by_predicted_runtime([m1, m2, m3], {}),
+                         [m2, m3, m1])
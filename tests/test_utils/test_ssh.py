@@ -0,0 +1,99 @@
+import unittest
+
+import mock
+
+from rsempipeline.utils import ssh
+
+
+class SSHSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        ssh.close_all()
+
+    def tearDown(self):
+        ssh.close_all()
+
+    @mock.patch('rsempipeline.utils.ssh.paramiko')
+    def test_execute(self, mock_paramiko):
+        mock_paramiko.Transport.return_value.open_session.return_value.makefile.return_value.readlines.return_value = ['some_output\n']
+        session = ssh.SSHSession('host', 'username')
+        self.assertEqual(session.execute('cmd'), ['some_output\n'])
+        mock_paramiko.Transport.assert_called_once_with(('host', 22))
+        transport = mock_paramiko.Transport.return_value
+        transport.set_keepalive.assert_called_once_with(ssh.KEEPALIVE_INTERVAL)
+        transport.open_session.return_value.exec_command.assert_called_once_with('cmd')
+
+    @mock.patch('rsempipeline.utils.ssh.paramiko')
+    def test_execute_iter(self, mock_paramiko):
+        channel = mock_paramiko.Transport.return_value.open_session.return_value
+        channel.makefile.return_value = iter(['line1\n', 'line2\n'])
+        session = ssh.SSHSession('host', 'username')
+        lines = session.execute_iter('find r_dir')
+        self.assertEqual(next(lines), 'line1\n')
+        self.assertFalse(channel.close.called)
+        self.assertEqual(list(lines), ['line2\n'])
+        channel.exec_command.assert_called_once_with('find r_dir')
+        channel.close.assert_called_once_with()
+
+    @mock.patch('rsempipeline.utils.ssh.paramiko')
+    def test_transport_reused_across_commands(self, mock_paramiko):
+        session = ssh.SSHSession('host', 'username')
+        mock_paramiko.Transport.return_value.is_active.return_value = True
+        session.execute('du -s r_dir')
+        session.execute('find r_dir')
+        session.execute('df -k -P r_dir')
+        self.assertEqual(mock_paramiko.Transport.call_count, 1)
+        self.assertEqual(mock_paramiko.RSAKey.from_private_key_file.call_count, 1)
+        self.assertEqual(
+            mock_paramiko.Transport.return_value.open_session.call_count, 3)
+
+    @mock.patch('rsempipeline.utils.ssh.paramiko')
+    def test_lazy_reconnect_when_transport_inactive(self, mock_paramiko):
+        session = ssh.SSHSession('host', 'username')
+        mock_paramiko.Transport.return_value.is_active.return_value = False
+        session.execute('cmd1')
+        session.execute('cmd2')
+        self.assertEqual(mock_paramiko.Transport.call_count, 2)
+        # the key is loaded only once
+        self.assertEqual(mock_paramiko.RSAKey.from_private_key_file.call_count, 1)
+
+    @mock.patch('rsempipeline.utils.ssh.paramiko')
+    def test_reconnect_when_failed_to_open_channel(self, mock_paramiko):
+        class FakeSSHException(Exception):
+            pass
+        mock_paramiko.SSHException = FakeSSHException
+        transport = mock_paramiko.Transport.return_value
+        transport.is_active.return_value = True
+        transport.open_session.side_effect = [FakeSSHException(), mock.MagicMock()]
+        session = ssh.SSHSession('host', 'username')
+        session.execute('cmd')
+        self.assertEqual(mock_paramiko.Transport.call_count, 2)
+
+    @mock.patch('rsempipeline.utils.ssh.paramiko')
+    def test_execute_many(self, mock_paramiko):
+        session = ssh.SSHSession('host', 'username')
+        with mock.patch.object(session, 'execute') as mock_execute:
+            mock_execute.side_effect = lambda cmd: [cmd + ' output\n']
+            self.assertEqual(session.execute_many(['cmd1', 'cmd2', 'cmd3']),
+                             [['cmd1 output\n'], ['cmd2 output\n'], ['cmd3 output\n']])
+
+    @mock.patch('rsempipeline.utils.ssh.paramiko')
+    def test_execute_many_with_error(self, mock_paramiko):
+        session = ssh.SSHSession('host', 'username')
+        with mock.patch.object(session, 'execute') as mock_execute:
+            mock_execute.side_effect = ValueError('failed')
+            self.assertRaises(ValueError, session.execute_many, ['cmd1', 'cmd2'])
+
+    def test_get_session(self):
+        session1 = ssh.get_session('host', 'username')
+        session2 = ssh.get_session('host', 'username')
+        session3 = ssh.get_session('another_host', 'username')
+        self.assertIs(session1, session2)
+        self.assertIsNot(session1, session3)
+
+    def test_close_all(self):
+        session = ssh.get_session('host', 'username')
+        session.transport = mock.Mock()
+        transport = session.transport
+        ssh.close_all()
+        transport.close.assert_called_once_with()
+        self.assertEqual(ssh.sessions, {})
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from rsempipeline.utils.state_cache import StateCache
+
+
+class StateCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmp_dir, 'remote_state_cache.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get(self):
+        fetch = mock.Mock(return_value=[1, 2, 3])
+        cache = StateCache(self.cache_file, 600)
+        self.assertEqual(cache.get('remote', 'usage:/r_dir', fetch), [1, 2, 3])
+        # persists between invocations
+        cache = StateCache(self.cache_file, 600)
+        self.assertEqual(cache.get('remote', 'usage:/r_dir', fetch), [1, 2, 3])
+        self.assertEqual(fetch.call_count, 1)
+
+    @mock.patch('rsempipeline.utils.state_cache.time.time', autospec=True)
+    def test_get_expired(self, mock_time):
+        fetch = mock.Mock(side_effect=[{'pending': 1}, {'pending': 2}])
+        cache = StateCache(self.cache_file, 600)
+        mock_time.return_value = 1000
+        self.assertEqual(cache.get('remote', 'queue:user', fetch), {'pending': 1})
+        mock_time.return_value = 1599
+        self.assertEqual(cache.get('remote', 'queue:user', fetch), {'pending': 1})
+        mock_time.return_value = 1600
+        self.assertEqual(cache.get('remote', 'queue:user', fetch), {'pending': 2})
+
+    def test_get_disabled(self):
+        fetch = mock.Mock(return_value=[1, 2, 3])
+        cache = StateCache(self.cache_file, 0)
+        cache.get('remote', 'usage:/r_dir', fetch)
+        cache.get('remote', 'usage:/r_dir', fetch)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_invalidate(self):
+        fetch = mock.Mock(return_value=[1, 2, 3])
+        cache = StateCache(self.cache_file, 600)
+        cache.get('remote1', 'usage:/r_dir', fetch)
+        cache.get('remote2', 'usage:/r_dir', fetch)
+        cache.invalidate('remote1')
+        cache.get('remote1', 'usage:/r_dir', fetch)
+        cache.get('remote2', 'usage:/r_dir', fetch)
+        self.assertEqual(fetch.call_count, 3)
+
+    def test_corrupted(self):
+        with open(self.cache_file, 'wb') as opf:
+            opf.write('remote: [unclosed')
+        fetch = mock.Mock(return_value=[1, 2, 3])
+        cache = StateCache(self.cache_file, 600)
+        self.assertEqual(cache.get('remote', 'usage:/r_dir', fetch), [1, 2, 3])
+        self.assertEqual(cache.read()['remote']['usage:/r_dir']['state'], [1, 2, 3])
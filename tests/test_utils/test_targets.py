@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rsempipeline.utils import targets as TG
+
+
+CONFIG = {
+    'REMOTE_HOST': 'genesis.bcgsc.ca',
+    'USERNAME': 'username',
+    'REMOTE_TOP_OUTDIR': '/genesis/batch',
+    'REMOTE_CMD_DF': 'df -k -P /genesis',
+    'REMOTE_MAX_USAGE': '1 TB',
+    'REMOTE_MIN_FREE': '100 GB',
+    'REMOTE_REFERENCE_NAMES': {'homo_sapiens': '/genesis/ref/hg19'},
+}
+
+
+class TargetsTestCase(unittest.TestCase):
+    def test_get_targets_without_remote_targets(self):
+        targets = TG.get_targets(CONFIG)
+        self.assertEqual(len(targets), 1)
+        self.assertEqual(targets[0]['NAME'], 'genesis.bcgsc.ca')
+        self.assertEqual(targets[0]['REMOTE_TOP_OUTDIR'], '/genesis/batch')
+        self.assertEqual(targets[0]['REMOTE_PYTHON'], 'python')
+        self.assertIsNone(targets[0]['QSUB_TEMPLATE'])
+
+    def test_get_targets(self):
+        config = dict(CONFIG)
+        config['REMOTE_TARGETS'] = [
+            {'NAME': 'genesis', 'QSUB_TEMPLATE': '0_submit_genesis.jinja2'},
+            {'NAME': 'nestor', 'REMOTE_HOST': 'nestor.westgrid.ca',
+             'REMOTE_TOP_OUTDIR': '/nestor/batch',
+             'REMOTE_MAX_USAGE': '2 TB',
+             'QSUB_TEMPLATE': '0_submit_nestor.jinja2'}]
+        genesis, nestor = TG.get_targets(config)
+        self.assertEqual(genesis['REMOTE_HOST'], 'genesis.bcgsc.ca')
+        self.assertEqual(nestor['REMOTE_HOST'], 'nestor.westgrid.ca')
+        self.assertEqual(nestor['REMOTE_TOP_OUTDIR'], '/nestor/batch')
+        self.assertEqual(nestor['REMOTE_MAX_USAGE'], '2 TB')
+        # taken from the top level
+        self.assertEqual(nestor['REMOTE_MIN_FREE'], '100 GB')
+        self.assertEqual(nestor['USERNAME'], 'username')
+
+    def test_get_targets_without_qsub_template(self):
+        config = dict(CONFIG)
+        config['REMOTE_TARGETS'] = [{'NAME': 'genesis'}]
+        self.assertRaises(ValueError, TG.get_targets, config)
+
+    def test_get_targets_duplicated_names(self):
+        config = dict(CONFIG)
+        config['REMOTE_TARGETS'] = [
+            {'QSUB_TEMPLATE': '0_submit_genesis.jinja2'},
+            {'QSUB_TEMPLATE': '0_submit_genesis.jinja2'}]
+        self.assertRaises(ValueError, TG.get_targets, config)
+
+    def test_score(self):
+        state = dict(free_to_use=100, queue_depth=0, throughput=None)
+        self.assertEqual(TG.score(state, None), 100)
+        state = dict(free_to_use=100, queue_depth=3, throughput=5)
+        self.assertEqual(TG.score(state, 10), 12.5)
+
+    def test_place(self):
+        states = {
+            'genesis': dict(free_to_use=100, queue_depth=0, throughput=10),
+            'nestor': dict(free_to_use=100, queue_depth=0, throughput=5),
+        }
+        placement = TG.place([('GSM1', 60), ('GSM2', 30), ('GSM3', 80),
+                              ('GSM4', 50)], states)
+        # GSM1 => genesis for faster transfer, GSM2 => nestor as genesis has
+        # less space and a deeper queue now, GSM3 fits none, and GSM4 only
+        # fits nestor
+        self.assertEqual(placement, {'genesis': ['GSM1'],
+                                     'nestor': ['GSM2', 'GSM4']})
+        # states passed in are not changed
+        self.assertEqual(states['genesis']['free_to_use'], 100)
+
+    def test_calc_capacity(self):
+        # nothing pending or running
+        self.assertIsNone(TG.calc_capacity(0, 0, 3600, 24))
+        self.assertEqual(TG.calc_capacity(0, 0, 3600, 24, ceiling=50), 50)
+        # nothing pending, but still bounded by what finishes within 24h
+        self.assertEqual(TG.calc_capacity(0, 10, 3600, 24), 240)
+        self.assertEqual(TG.calc_capacity(0, 10, 3600, 24, ceiling=50), 50)
+        self.assertEqual(TG.calc_capacity(0, 10, None, 24, ceiling=50), 50)
+        # stuck
+        self.assertEqual(TG.calc_capacity(5, 0, 3600, 24), 0)
+        # 10 running jobs of 2h each, 50 start within 10h
+        self.assertEqual(TG.calc_capacity(20, 10, 7200, 10), 30)
+        self.assertEqual(TG.calc_capacity(60, 10, 7200, 10), 0)
+        # no history
+        self.assertEqual(TG.calc_capacity(4, 10, None, 10), 6)
+
+    def test_place_with_capacity(self):
+        states = {
+            'genesis': dict(free_to_use=100, queue_depth=0, throughput=None,
+                            capacity=1),
+            'nestor': dict(free_to_use=10, queue_depth=0, throughput=None,
+                           capacity=0),
+        }
+        self.assertEqual(TG.place([('GSM1', 5), ('GSM2', 5)], states),
+                         {'genesis': ['GSM1']})
+
+    def test_place_nothing_fits(self):
+        states = {'genesis': dict(free_to_use=10, queue_depth=0, throughput=None)}
+        self.assertEqual(TG.place([('GSM1', 60)], states), {})
+
+
+class RenderQsubScriptTestCase(unittest.TestCase):
+    def setUp(self):
+        self.top_outdir = tempfile.mkdtemp()
+        self.gsm_dir = os.path.join(
+            self.top_outdir, 'rsem_output', 'GSE1', 'homo_sapiens', 'GSM1')
+        os.makedirs(self.gsm_dir)
+        for _ in ['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz']:
+            with open(os.path.join(self.gsm_dir, _), 'wb') as opf:
+                opf.write('a' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.top_outdir)
+
+    def test_render_qsub_script(self):
+        qsub_script = TG.render_qsub_script(
+            self.gsm_dir, '0_submit_genesis.jinja2',
+            {'homo_sapiens': '/genesis/ref/hg19'})
+        self.assertEqual(qsub_script, os.path.join(self.gsm_dir, '0_submit.sh'))
+        with open(qsub_script) as inf:
+            content = inf.read()
+        self.assertIn('#$ -N GSM1_GSE1', content)
+        self.assertIn('/genesis/ref/hg19', content)
+        self.assertIn('--paired-end <(/bin/zcat SRR1_1.fastq.gz) '
+                      '<(/bin/zcat SRR1_2.fastq.gz)', content)
+        # the default of the template
+        self.assertIn('-pe ncpus 12', content)
+
+    def test_render_qsub_script_with_limits(self):
+        limits = {'ncpus': [2, 8], 'mem': [8, 20], 'walltime': [2, 72]}
+        qsub_script = TG.render_qsub_script(
+            self.gsm_dir, '0_submit_genesis.jinja2',
+            {'homo_sapiens': '/genesis/ref/hg19'}, limits, [])
+        with open(qsub_script) as inf:
+            content = inf.read()
+        self.assertIn('-pe ncpus 2', content)
+        self.assertIn('h_rt=72:00:00', content)